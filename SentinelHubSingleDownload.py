@@ -5,7 +5,7 @@ Created on Tue Sep 11 14:40:39 2018
 @author: Josie
 """
 
-from sentinelhub import AwsProductRequest, AwsTile, DataSource, AwsTileRequest
+from sentinelhub import AwsProductRequest, AwsTile, DataSource
 
 downloadloc = r'D:/yuhanyuhan/pythonserver'
 s2tile = '49MDV'
@@ -18,5 +18,11 @@ def downloadS2asSAFE(downloadfolder, tilename,tiledate):
 
     product_request = AwsProductRequest(product_id=productid, data_folder=downloadfolder, safe_format=True)
     product_request.save_data()
-    
-downloadS2asSAFE(downloadloc, s2tile, s2tiledate)
\ No newline at end of file
+
+# Fetch the product of a tile and date through a product_store.ProductStore, only downloaded when not already stored
+def downloadS2toStore(store, tilename, tiledate, tileindex=0):
+    productid = AwsTile(tile_name=tilename, time=tiledate, aws_index=tileindex, data_source=DataSource.SENTINEL2_L1C).get_product_id()
+    return store.get(productid)
+
+if __name__ == '__main__':
+    downloadS2asSAFE(downloadloc, s2tile, s2tiledate)
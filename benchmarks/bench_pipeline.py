@@ -0,0 +1,339 @@
+"""
+Description     : Benchmark suite of the index pipeline on synthetic inputs.
+                  Every stage runs in a fresh process so its peak RSS is its
+                  own; results (wall time, peak RSS, pixels/s) are written
+                  to JSON and two result files can be compared to catch
+                  regressions. Run from the repository root with
+                  python benchmarks/bench_pipeline.py run [--size N]
+                      [--repeat N] [--output results.json] [stage ...]
+                  python benchmarks/bench_pipeline.py compare base.json
+                      new.json [--threshold 0.1]
+"""
+
+
+import argparse
+from collections import OrderedDict
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import sentinel2index_py3 as s2  # noqa: E402
+from synthetic import make_dataset  # noqa: E402
+import timeseries  # noqa: E402
+
+
+# stage name -> function(dataset, work) returning (function to time,
+# pixels it processes); the setup done before returning is not timed
+STAGES = OrderedDict()
+
+
+def stage(name):
+    def decorator(setup):
+        STAGES[name] = setup
+        return setup
+    return decorator
+
+
+def aoi_pixels(dataset):
+    img, out_transform, out_meta = s2.raster_mask(dataset["bands"]["nir"],
+                                                  dataset["aoi"])
+    return img.size
+
+
+def index_array(dataset):
+    bands = {name: s2.raster_mask(dataset["bands"][name], dataset["aoi"])[0]
+             for name in ("nir", "red")}
+    return s2.evaluate_indices(["NDVI"], bands)["NDVI"]
+
+
+@stage("raster_mask")
+def _raster_mask(dataset, work):
+    return (lambda: s2.raster_mask(dataset["bands"]["nir"], dataset["aoi"]),
+            aoi_pixels(dataset))
+
+
+@stage("std_array")
+def _std_array(dataset, work):
+    values = index_array(dataset)
+    return lambda: s2.std_array(values, -1.0, 1.0), values.size
+
+
+@stage("natural_breaks")
+def _natural_breaks(dataset, work):
+    values = index_array(dataset)
+    return lambda: s2.natural_breaks(values, cache=None), values.size
+
+
+@stage("classify_index")
+def _classify_index(dataset, work):
+    values = index_array(dataset)
+    classes = s2.natural_breaks(values, cache=None)
+    return lambda: s2.classify_index(values, classes), values.size
+
+
+def _index_stage(name, function):
+    spec = s2.INDEX_REGISTRY[name]
+
+    def setup(dataset, work):
+        bands = [dataset["bands"][band] for band in spec.bands]
+        return (lambda: function(*bands, dataset["aoi"], dataset["tiles"]),
+                aoi_pixels(dataset))
+    stage(function.__name__)(setup)
+
+
+for _name, _function in (("wNDWI", s2.wndwi_f), ("WDRVI", s2.wdrvi_f),
+                         ("EVI", s2.evi_f), ("NDVI", s2.ndvi_f),
+                         ("OSAVI", s2.osavi_f), ("PSRI", s2.psri_f),
+                         ("IRECI", s2.ireci_f), ("FCD", s2.fcd_f)):
+    _index_stage(_name, _function)
+
+
+@stage("raster_resampling")
+def _raster_resampling(dataset, work):
+    # resampling replaces the bands, so it works on a copy
+    safe = os.path.join(work, "safe")
+    shutil.copytree(dataset["safe"], safe)
+    return lambda: s2.raster_resampling(safe), dataset["size"] ** 2 * 6
+
+
+def _raw_index(dataset, work):
+    values = index_array(dataset)
+    img, out_transform, out_meta = s2.raster_mask(dataset["bands"]["nir"],
+                                                  dataset["aoi"])
+    raw = os.path.join(work, "raw_ndvi.tif")
+    s2.imager(values, out_transform, out_meta.copy(), raw)
+    return raw, values.size
+
+
+@stage("renderer")
+def _renderer(dataset, work):
+    raw, pixels = _raw_index(dataset, work)
+    ramp = os.path.join("ramps", s2.INDEX_REGISTRY["NDVI"].ramp)
+    rendered = os.path.join(work, "rendered_ndvi.tif")
+    return lambda: s2.renderer(raw, rendered, ramp, alpha=True), pixels
+
+
+@stage("tiler")
+def _tiler(dataset, work):
+    raw, pixels = _raw_index(dataset, work)
+    ramp = os.path.join("ramps", s2.INDEX_REGISTRY["NDVI"].ramp)
+    rendered = os.path.join(work, "rendered_ndvi.tif")
+    tiles = os.path.join(work, "tiles")
+    os.makedirs(tiles)
+    return lambda: s2.tiler(raw, rendered, ramp, tiles), pixels
+
+
+@stage("yield_f")
+def _yield_f(dataset, work):
+    bands = dataset["bands"]
+    return (lambda: s2.yield_f(bands["nir"], bands["red"], bands["green"],
+                               bands["blue"], bands["re5"], bands["re6"],
+                               bands["swir11"], dataset["aoi"],
+                               dataset["tiles"]),
+            aoi_pixels(dataset))
+
+
+# the season of the synthetic bands repeated over dates, so that peak RSS
+# can be compared across the number of dates
+def _series_stage(dates):
+    def setup(dataset, work):
+        scenes = [("2018-{:02d}-{:02d}".format(1 + day // 28, 1 + day % 28),
+                   dataset["bands"]) for day in range(0, 5 * dates, 5)]
+
+        def run():
+            series = timeseries.TimeSeries.build(
+                os.path.join(work, "series"), scenes, dataset["aoi"],
+                memory_limit=64 * 1024 ** 2)
+            series.composites(memory_limit=64 * 1024 ** 2)
+        return run, aoi_pixels(dataset) * dates
+    return setup
+
+
+for _dates in (4, 16):
+    stage("timeseries_{}".format(_dates))(_series_stage(_dates))
+
+
+def peak_rss():
+    # kilobytes on linux, bytes on macos
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+# run one stage in this process and print its measures as JSON
+def run_stage(name, data_folder, skip_tiling):
+    with open(os.path.join(data_folder, "dataset.json")) as src:
+        dataset = json.load(src)
+    if skip_tiling:
+        s2.generate_tiles = lambda rendered, folder, workers=None: None
+    work = tempfile.mkdtemp(prefix=name + "_", dir=data_folder)
+    # the pipeline reads its ramps and writes its temp files under cwd
+    os.chdir(data_folder)
+    try:
+        function, pixels = STAGES[name](dataset, work)
+        rss_before = peak_rss()
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        function()
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - start_cpu
+        result = {"wall": wall, "cpu": cpu, "pixels": pixels,
+                  "pixels_per_s": pixels / wall if wall else None,
+                  "peak_rss": peak_rss(),
+                  "peak_rss_delta": peak_rss() - rss_before}
+    except Exception as error:
+        result = {"error": repr(error)}
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    print(json.dumps(result))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(stages, size, repeat, output, data_folder, skip_tiling):
+    own_folder = data_folder is None
+    if own_folder:
+        data_folder = tempfile.mkdtemp(prefix="bench_pipeline_")
+    data_folder = os.path.abspath(data_folder)
+    if not os.path.exists(os.path.join(data_folder, "dataset.json")):
+        make_dataset(data_folder, size)
+
+    if not skip_tiling:
+        try:
+            import gdal2tiles  # noqa: F401
+        except ImportError:
+            print("gdal2tiles is not installed, tiling is skipped")
+            skip_tiling = True
+
+    results = OrderedDict()
+    for name in stages or STAGES:
+        runs = []
+        for i in range(repeat):
+            command = [sys.executable, os.path.abspath(__file__), "_stage",
+                       name, data_folder]
+            if skip_tiling:
+                command.append("--skip-tiling")
+            reply = subprocess.run(command, stdout=subprocess.PIPE,
+                                   universal_newlines=True)
+            lines = reply.stdout.strip().splitlines()
+            runs.append(json.loads(lines[-1]) if lines else
+                        {"error": "exit code {}".format(reply.returncode)})
+        # the fastest run, with the highest peak memory of all runs
+        ok = [measure for measure in runs if "error" not in measure]
+        if ok:
+            best = dict(min(ok, key=lambda measure: measure["wall"]))
+            best["peak_rss"] = max(measure["peak_rss"] for measure in ok)
+            best["runs"] = len(ok)
+        else:
+            best = runs[0]
+        results[name] = best
+        if "error" in best:
+            print("{:<20} {}".format(name, best["error"]))
+        else:
+            print("{:<20} {:>9.3f} s {:>8.1f} MB {:>14.0f} px/s".format(
+                name, best["wall"], best["peak_rss"] / 1024 ** 2,
+                best["pixels_per_s"]))
+
+    report = {"meta": {"commit": git_commit(),
+                       "date": datetime.datetime.now().isoformat(),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "machine": platform.machine(),
+                       "cpus": os.cpu_count(),
+                       "size": size,
+                       "repeat": repeat,
+                       "tiling": not skip_tiling},
+              "results": results}
+    with open(output, "w") as dst:
+        json.dump(report, dst, indent=1)
+    print("results written to {}".format(output))
+    if own_folder:
+        shutil.rmtree(data_folder, ignore_errors=True)
+    return report
+
+
+# compare two result files, returns the stages that got slower
+def compare(base_file, new_file, threshold=0.1):
+    with open(base_file) as src:
+        base = json.load(src)
+    with open(new_file) as src:
+        new = json.load(src)
+    print("{:<20} {:>10} {:>10} {:>8} {:>10}".format(
+        "stage", "base s", "new s", "ratio", "rss ratio"))
+    regressions = []
+    for name, measure in new["results"].items():
+        old = base["results"].get(name)
+        if old is None or "error" in old or "error" in measure:
+            continue
+        ratio = measure["wall"] / old["wall"]
+        rss_ratio = measure["peak_rss"] / old["peak_rss"]
+        flag = ""
+        if ratio > 1 + threshold or rss_ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<20} {:>10.3f} {:>10.3f} {:>8.2f} {:>10.2f}{}".format(
+            name, old["wall"], measure["wall"], ratio, rss_ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("stages", nargs="*", metavar="stage",
+                            help="one of {}, all when none".format(
+                                ", ".join(STAGES)))
+    run_parser.add_argument("--size", type=int, default=2000)
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--output", default="bench_pipeline.json")
+    run_parser.add_argument("--data", help="folder of the synthetic inputs, "
+                            "generated when missing")
+    run_parser.add_argument("--skip-tiling", action="store_true")
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    stage_parser = commands.add_parser("_stage")
+    stage_parser.add_argument("stage", choices=list(STAGES))
+    stage_parser.add_argument("data")
+    stage_parser.add_argument("--skip-tiling", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        unknown = [name for name in args.stages if name not in STAGES]
+        if unknown:
+            parser.error("unknown stage(s) {}".format(", ".join(unknown)))
+        run(args.stages, args.size, args.repeat, args.output, args.data,
+            args.skip_tiling)
+    elif args.command == "compare":
+        if compare(args.base, args.new, args.threshold):
+            sys.exit(1)
+    elif args.command == "_stage":
+        run_stage(args.stage, args.data, args.skip_tiling)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
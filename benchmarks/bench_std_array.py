@@ -0,0 +1,63 @@
+"""
+Description     : Benchmark of std_array against the previous np.vectorize
+                  implementation, run from the repository root with
+                  python benchmarks/bench_std_array.py [size]
+"""
+
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sentinel2index_py3 import std_array  # noqa: E402
+
+
+# the np.vectorize implementation std_array replaced
+def std_array_vectorize(in_array, d_min=None, d_max=None, f_min=0, f_max=100):
+    if d_min is None:
+        d_min = np.min(in_array)
+    if d_max is None:
+        d_max = np.amax(in_array)
+
+    def scaler(x): return (((x - d_min)
+                            / (d_max - d_min))
+                           * (f_max - f_min)
+                           + f_min)
+    vfunc = np.vectorize(scaler)
+    return vfunc(in_array)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(size=2000):
+    rng = np.random.RandomState(0)
+    index = (rng.random_sample((1, size, size)) * 2 - 1).astype(np.float32)
+
+    old, t_old = timed(std_array_vectorize, index, d_min=-1.0, d_max=1.0)
+    new, t_new = timed(std_array, index, d_min=-1.0, d_max=1.0)
+    chunked, t_chunked = timed(std_array, index, chunk_rows=256)
+    data_range, t_range = timed(std_array, index)
+
+    assert np.allclose(old, new, atol=1e-4)
+    assert np.allclose(std_array_vectorize(index), data_range, atol=1e-4)
+
+    pixels = index.size
+    print("pixels                {:>12d}".format(pixels))
+    for label, seconds in (("np.vectorize", t_old),
+                           ("std_array", t_new),
+                           ("std_array chunked", t_chunked),
+                           ("std_array data range", t_range)):
+        print("{:<21} {:>10.4f} s {:>12.0f} px/s".format(
+            label, seconds, pixels / seconds))
+    print("speed-up              {:>10.1f} x".format(t_old / t_new))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
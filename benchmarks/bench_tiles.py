@@ -0,0 +1,247 @@
+"""
+Description     : Benchmark of the map tiles of an index, pre-generated
+                  against rendered on request by tile_server. On the same
+                  synthetic NDVI image it measures the time to the first
+                  map view (the tiles of a browser viewport fitting the
+                  image) and the storage taken by the tiles:
+                  - pregenerated: the zoom 8 to max zoom pyramid, with
+                    gdal2tiles as tiler does, or with tile_server when
+                    gdal2tiles is not installed
+                  - on_demand: a cold tile_server, a viewport at the
+                    first view zoom then every second zoom to max zoom,
+                    browsed again from the memory and disk caches
+                  - prewarmed: the first view after prewarming zooms 8 to
+                    12, or to the first view zoom when it is higher
+                  Run from the repository root with
+                  python benchmarks/bench_tiles.py [--size N]
+                      [--max-zoom N] [--viewport 5x3] [--output file]
+"""
+
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import sentinel2index_py3 as s2  # noqa: E402
+import tile_server  # noqa: E402
+from bench_pipeline import git_commit, index_array  # noqa: E402
+from synthetic import make_dataset  # noqa: E402
+
+
+JOB = "bench"
+INDEX = "ndvi"
+# parallel requests of a browser to one host
+BROWSER_CONNECTIONS = 6
+
+
+# the classified NDVI image of a job, as _finish_index writes it
+def job_image(dataset, work_root):
+    values = index_array(dataset)
+    breaks = s2.natural_breaks(values, cache=None)
+    class_array = s2.classify_index(values, breaks)
+    img, out_transform, out_meta = s2.raster_mask(dataset["bands"]["nir"],
+                                                  dataset["aoi"])
+    folder = os.path.join(work_root, JOB)
+    os.makedirs(folder, exist_ok=True)
+    spec = s2.INDEX_REGISTRY["NDVI"]
+    image = os.path.join(folder, spec.image)
+    s2.imager(class_array, out_transform, out_meta.copy(), image,
+              palette=s2.class_palette(os.path.join("ramps", spec.ramp)))
+    return image
+
+
+def folder_size(folder):
+    files = 0
+    size = 0
+    for root, dirs, names in os.walk(folder):
+        for name in names:
+            if name.endswith(".png"):
+                files += 1
+                size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+# the tiles of a viewport centered on the image
+def viewport(bounds, z, width, height):
+    size = 2 * tile_server.ORIGIN / 2 ** z
+    cx = int(((bounds[0] + bounds[2]) / 2 + tile_server.ORIGIN) // size)
+    cy = int((tile_server.ORIGIN - (bounds[1] + bounds[3]) / 2) // size)
+    return [(z, x, y)
+            for x in range(cx - width // 2, cx - width // 2 + width)
+            for y in range(cy - height // 2, cy - height // 2 + height)]
+
+
+# the highest zoom showing the whole image in the viewport
+def first_view_zoom(bounds, width, height):
+    for z in range(tile_server.MAX_ZOOM, -1, -1):
+        tiles = list(tile_server.tiles_covering(bounds, z))
+        if (len(set(x for x, y in tiles)) <= width
+                and len(set(y for x, y in tiles)) <= height):
+            return z
+    return 0
+
+
+# fetch the tiles of a view as a browser would, returns the wall time and
+# the time of every tile
+def fetch_view(server, view):
+    def fetch(tile):
+        start = time.perf_counter()
+        server.tile(JOB, INDEX, *tile)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=BROWSER_CONNECTIONS) as pool:
+        latencies = list(pool.map(fetch, view))
+    return time.perf_counter() - start, latencies
+
+
+def browse(server, views):
+    walls = []
+    latencies = []
+    for view in views:
+        wall, view_latencies = fetch_view(server, view)
+        walls.append(wall)
+        latencies.extend(view_latencies)
+    return {"first_view_s": walls[0],
+            "views_s": walls,
+            "tiles": len(latencies),
+            "tile_p50_ms": float(np.percentile(latencies, 50)) * 1000,
+            "tile_p99_ms": float(np.percentile(latencies, 99)) * 1000}
+
+
+def pregenerated(image, ramps, work, max_zoom):
+    try:
+        import gdal2tiles  # noqa: F401
+        method = "gdal2tiles"
+    except ImportError:
+        method = "tile_server"
+    tiles = os.path.join(work, "pregenerated")
+    os.makedirs(tiles)
+    start = time.perf_counter()
+    if method == "gdal2tiles":
+        rendered = os.path.join(work, "rendered_ndvi.tif")
+        s2.tiler(image, rendered, os.path.join(ramps, "ndvi_color.txt"),
+                 tiles)
+    else:
+        server = tile_server.TileServer(os.path.dirname(os.path.dirname(
+            image)), tiles, ramps, disk_bytes=2 ** 62)
+        server.prewarm(JOB, (8, max_zoom))
+    wall = time.perf_counter() - start
+    files, size = folder_size(tiles)
+    # nothing is shown before the pyramid is uploaded
+    return {"method": method, "first_view_s": wall, "tiles_written": files,
+            "storage_bytes": size,
+            "zooms": [8, 18 if method == "gdal2tiles" else max_zoom]}
+
+
+def run(size, max_zoom, width, height, output, data_folder):
+    own_folder = data_folder is None
+    if own_folder:
+        data_folder = tempfile.mkdtemp(prefix="bench_tiles_")
+    data_folder = os.path.abspath(data_folder)
+    if not os.path.exists(os.path.join(data_folder, "dataset.json")):
+        make_dataset(data_folder, size)
+    with open(os.path.join(data_folder, "dataset.json")) as src:
+        dataset = json.load(src)
+    work = tempfile.mkdtemp(prefix="tiles_", dir=data_folder)
+    os.chdir(data_folder)
+    ramps = os.path.join(data_folder, "ramps")
+    try:
+        work_root = os.path.join(work, "jobs")
+        image = job_image(dataset, work_root)
+        results = {"pregenerated": pregenerated(image, ramps, work,
+                                                max_zoom)}
+
+        def new_server(cache):
+            return tile_server.TileServer(work_root,
+                                          os.path.join(work, cache), ramps)
+
+        server = new_server("on_demand")
+        bounds = server.layer(JOB, INDEX).bounds
+        first = first_view_zoom(bounds, width, height)
+        views = [viewport(bounds, z, width, height)
+                 for z in range(first, max_zoom + 1, 2)]
+
+        cold = browse(server, views)
+        memory = browse(server, views)
+        disk = browse(new_server("on_demand"), views)
+        files, stored = folder_size(os.path.join(work, "on_demand"))
+        results["on_demand"] = dict(cold, first_view_zoom=first,
+                                    memory_hit=memory, disk_hit=disk,
+                                    tiles_written=files,
+                                    storage_bytes=stored)
+
+        # the first view of a small image can be above the prewarmed zooms
+        zooms = (tile_server.PREWARM_ZOOMS[0],
+                 max(tile_server.PREWARM_ZOOMS[-1], first))
+        server = new_server("prewarmed")
+        start = time.perf_counter()
+        server.prewarm(JOB, zooms)
+        prewarm_s = time.perf_counter() - start
+        files, stored = folder_size(os.path.join(work, "prewarmed"))
+        results["prewarmed"] = dict(browse(server, views[:1]),
+                                    prewarm_s=prewarm_s,
+                                    tiles_written=files,
+                                    storage_bytes=stored,
+                                    zooms=list(zooms))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        if own_folder:
+            shutil.rmtree(data_folder, ignore_errors=True)
+
+    print("{:<14} {:>14} {:>8} {:>12}".format(
+        "", "first view s", "tiles", "storage MB"))
+    for name, result in results.items():
+        print("{:<14} {:>14.3f} {:>8} {:>12.2f}".format(
+            name, result["first_view_s"], result["tiles_written"],
+            result["storage_bytes"] / 1024 ** 2))
+    on_demand = results["on_demand"]
+    for name, result in (("cold", on_demand), ("memory", on_demand[
+            "memory_hit"]), ("disk", on_demand["disk_hit"])):
+        print("{:<14} tile p50 {:>8.2f} ms p99 {:>8.2f} ms".format(
+            name, result["tile_p50_ms"], result["tile_p99_ms"]))
+
+    report = {"meta": {"commit": git_commit(),
+                       "date": datetime.datetime.now().isoformat(),
+                       "python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "cpus": os.cpu_count(),
+                       "size": size,
+                       "max_zoom": max_zoom,
+                       "viewport": [width, height]},
+              "results": results}
+    with open(output, "w") as dst:
+        json.dump(report, dst, indent=1)
+    print("results written to {}".format(output))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--max-zoom", type=int, default=18)
+    parser.add_argument("--viewport", default="5x3",
+                        help="tiles across and down of the first view")
+    parser.add_argument("--output", default="bench_tiles.json")
+    parser.add_argument("--data", help="folder of the synthetic inputs, "
+                        "generated when missing")
+    args = parser.parse_args(argv)
+    width, height = (int(side) for side in args.viewport.split("x"))
+    run(args.size, args.max_zoom, width, height,
+        os.path.abspath(args.output), args.data)
+
+
+if __name__ == "__main__":
+    main()
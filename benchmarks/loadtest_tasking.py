@@ -0,0 +1,173 @@
+"""
+Description     : Load test of the /tasking endpoint of a running server,
+                  reporting requests per second and latency percentiles,
+                  per response status: once the job queue is full the
+                  server answers 429 at once, so accepted jobs (202) are
+                  reported apart from the rejections. Every client thread
+                  keeps one connection alive.
+                  The server only accepts the request when a script serves
+                  its analysis keys and the region has an AOI, so on a
+                  new checkout prepare a working folder with a script
+                  serving them (doing nothing) and a synthetic Johor AOI
+                  python benchmarks/loadtest_tasking.py setup [folder]
+                  start the server from that folder, e.g.
+                  ADATOS_SERVER=threaded python <repository>/main.py
+                  with ADATOS_QUEUE_SIZE above the number of requests to
+                  measure the accepting path only, and run
+                  python benchmarks/loadtest_tasking.py [url] [requests]
+                  [concurrency]
+                  One request is sent first and the run stops with the
+                  reply when the server rejects it.
+                  With ADATOS_SERVER=processes every worker process keeps
+                  its own job queue, the rejections start once the queue of
+                  the worker answering is full
+"""
+
+
+from collections import Counter
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import write_aoi  # noqa: E402
+
+
+REQUEST = {
+    "api_key": "",
+    "job_id": 6,
+    "organization_id": 1,
+    "organization_key": "demo",
+    "region_key": "Johor",
+    "mode": "s2",
+    "analysis_key": ["flood_risk", "plant_productivity", "foilar_moisture"],
+    "data_s2": [{
+        "product_name": "S2A_MSIL1C_20180903T031541_N0206_R118_T48NUH_"
+                        "20180903T061615",
+        "utm_zone": 48,
+        "latitude_band": "N",
+        "grid_square": "UH"
+    }]
+}
+
+
+# a script serving the analysis keys of REQUEST, its jobs do no analysis
+SCRIPT = """
+ANALYSIS_KEYS = {!r}
+ANALYSIS_INDICES = {{}}
+
+
+def run(job, l2a_folders):
+    return {{}}
+"""
+
+
+def setup(folder="loadtest"):
+    """
+    Writes the scripts and the AOI the server needs to accept REQUEST into
+    folder/awspyscript and folder/aoi
+    """
+    scripts = os.path.join(folder, "awspyscript")
+    aoi = os.path.join(folder, "aoi")
+    os.makedirs(scripts, exist_ok=True)
+    os.makedirs(aoi, exist_ok=True)
+    with open(os.path.join(scripts, "loadtest_analyses.py"), "w") as dst:
+        dst.write(SCRIPT.format(REQUEST["analysis_key"]))
+    write_aoi(os.path.join(aoi, "{}.shp".format(REQUEST["region_key"])), 2000)
+    print("start the server from {}, e.g.".format(os.path.abspath(folder)))
+    print("cd {} && ADATOS_SERVER=threaded ADATOS_QUEUE_SIZE=100000 "
+          "python {}".format(folder, os.path.join(ROOT, "main.py")))
+
+
+# one request first, the run would only measure rejections otherwise
+def preflight(url, body):
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+    try:
+        connection.request('POST', parts.path, body,
+                           {'Content-Type': 'application/json'})
+        reply = connection.getresponse()
+        status, text = reply.status, reply.read().decode(errors='replace')
+    except (OSError, http.client.HTTPException) as error:
+        sys.exit("no server at {}: {!r}".format(url, error))
+    finally:
+        connection.close()
+    if status not in (202, 429):
+        sys.exit("{} answered {} {}\nthe server needs a script serving {} "
+                 "and an AOI for region {}, see "
+                 "python benchmarks/loadtest_tasking.py setup".format(
+                     url, status, text, REQUEST["analysis_key"],
+                     REQUEST["region_key"]))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def client(url, count, body, latencies):
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+    headers = {'Content-Type': 'application/json'}
+    for i in range(count):
+        start = time.perf_counter()
+        try:
+            connection.request('POST', parts.path, body, headers)
+            reply = connection.getresponse()
+            reply.read()
+            status = reply.status
+        except (OSError, http.client.HTTPException):
+            # the server dropped the connection, open a new one
+            connection.close()
+            connection = http.client.HTTPConnection(parts.hostname,
+                                                    parts.port or 80)
+            status = 'error'
+        latencies.append((status, time.perf_counter() - start))
+    connection.close()
+
+
+def main(url="http://localhost:8000/tasking", requests=2000, concurrency=16):
+    body = json.dumps(REQUEST)
+    preflight(url, body)
+    latencies = []
+    per_client = [requests // concurrency + (i < requests % concurrency)
+                  for i in range(concurrency)]
+    threads = [threading.Thread(target=client,
+                                args=(url, count, body, latencies))
+               for count in per_client]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    statuses = Counter(status for status, latency in latencies)
+    print("url                   {}".format(url))
+    print("requests              {:>10d}".format(len(latencies)))
+    print("concurrency           {:>10d}".format(concurrency))
+    print("requests/s            {:>10.1f}".format(len(latencies) / seconds))
+    print("accepted/s            {:>10.1f}".format(statuses[202] / seconds))
+    print("statuses              {}".format(dict(statuses)))
+    print("{:<10} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "status", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for status in sorted(statuses, key=str):
+        values = [latency for code, latency in latencies if code == status]
+        print("{:<10} {:>8d} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            str(status), len(values),
+            *[percentile(values, fraction) * 1000
+              for fraction in (0.5, 0.9, 0.99)], max(values) * 1000))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["setup"]:
+        setup(*sys.argv[2:3])
+        sys.exit()
+    args = sys.argv[1:4]
+    main(*(args[:1] + [int(arg) for arg in args[1:]]))
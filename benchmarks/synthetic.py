@@ -0,0 +1,118 @@
+"""
+Description     : Synthetic Sentinel 2 inputs for the benchmarks, so they
+                  run offline at any size: the index bands as GeoTIFFs on a
+                  common 10 m grid, a SAFE like folder of bands at their
+                  native resolution for raster_resampling, an estate AOI
+                  shapefile and the color ramps of the indices. Run from
+                  the repository root with
+                  python benchmarks/synthetic.py folder [size]
+"""
+
+
+import json
+import os
+import sys
+
+import fiona
+import numpy as np
+import rasterio
+import rasterio.windows
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sentinel2index_py3 import (CONSOLIDATED_BANDS, INDEX_BANDS,  # noqa: E402
+                                INDEX_REGISTRY)
+
+
+PRODUCT = "T48NUH_20180903T031541"
+EPSG = 32648
+ORIGIN = (300000.0, 200000.0)
+RAMP = ("nv 0 0 0 0\n"
+        "0% 215 25 28\n"
+        "25% 253 174 97\n"
+        "50% 255 255 191\n"
+        "75% 166 217 106\n"
+        "100% 26 150 65\n")
+
+
+# reflectance like values: smooth fields with noise, different per band
+def band_rows(size, band, seed, row_start, rows):
+    rng = np.random.RandomState(seed * 1000 + row_start + sum(map(ord, band)))
+    y = np.arange(row_start, row_start + rows, dtype=np.float32)[:, None]
+    x = np.arange(size, dtype=np.float32)[None, :]
+    phase = (sum(map(ord, band)) % 17) / 17.0 * np.pi
+    fields = (np.sin(x / 97.0 + phase) * np.cos(y / 131.0 - phase) + 1) / 2
+    noise = rng.random_sample((rows, size)).astype(np.float32)
+    return (fields * 3500 + noise * 1500 + 100).astype(np.uint16)
+
+
+def write_band(path, size, band, resolution, seed, chunk_rows=512):
+    transform = from_origin(ORIGIN[0], ORIGIN[1], resolution, resolution)
+    # GeoTIFF content, also when named .jp2 like the sen2corr outputs
+    with rasterio.open(path, "w", driver="GTiff", height=size, width=size,
+                       count=1, dtype="uint16", crs="EPSG:{}".format(EPSG),
+                       transform=transform, tiled=True) as dst:
+        for row in range(0, size, chunk_rows):
+            rows = min(chunk_rows, size - row)
+            dst.write(band_rows(size, band, seed, row, rows), 1,
+                      window=rasterio.windows.Window(0, row, size, rows))
+    return path
+
+
+def write_aoi(path, size, resolution=10):
+    extent = size * resolution
+    x0, y0 = ORIGIN
+    # an irregular quadrilateral covering most of the tile
+    ring = [(x0 + 0.05 * extent + 3.3, y0 - 0.03 * extent - 1.7),
+            (x0 + 0.93 * extent - 7.1, y0 - 0.08 * extent - 3.9),
+            (x0 + 0.90 * extent + 1.3, y0 - 0.96 * extent + 4.4),
+            (x0 + 0.09 * extent + 2.2, y0 - 0.80 * extent - 2.1)]
+    ring.append(ring[0])
+    with fiona.open(path, "w", driver="ESRI Shapefile",
+                    crs="EPSG:{}".format(EPSG),
+                    schema={"geometry": "Polygon", "properties": {}}) as dst:
+        dst.write({"geometry": {"type": "Polygon", "coordinates": [ring]},
+                   "properties": {}})
+    return path
+
+
+def make_dataset(folder, size=2000, seed=0):
+    """
+    folder          ->      where the inputs are written
+    size            ->      width and height of the 10 m bands in pixels
+
+    Returns the dataset description, also saved as folder/dataset.json
+    """
+    for sub in ("bands", "safe", "ramps", "temp", "tiles"):
+        os.makedirs(os.path.join(folder, sub), exist_ok=True)
+
+    bands = {}
+    for name, (band, resolution) in INDEX_BANDS.items():
+        path = os.path.join(folder, "bands", "{}_{}_10m.tif".format(
+            PRODUCT, band))
+        bands[name] = write_band(path, size, band, 10, seed)
+
+    safe = os.path.join(folder, "safe")
+    for band, resolution in CONSOLIDATED_BANDS:
+        img_folder = os.path.join(safe, "GRANULE", "IMG_DATA",
+                                  "R{}m".format(resolution))
+        os.makedirs(img_folder, exist_ok=True)
+        write_band(os.path.join(img_folder, "{}_{}_{}m.jp2".format(
+            PRODUCT, band, resolution)),
+            size * 10 // resolution, band, resolution, seed)
+
+    ramps = [spec.ramp for spec in INDEX_REGISTRY.values()]
+    for ramp in ramps + ["yield_color.txt"]:
+        with open(os.path.join(folder, "ramps", ramp), "w") as dst:
+            dst.write(RAMP)
+
+    dataset = {"size": size, "seed": seed, "bands": bands, "safe": safe,
+               "aoi": write_aoi(os.path.join(folder, "aoi.shp"), size),
+               "tiles": os.path.join(folder, "tiles")}
+    with open(os.path.join(folder, "dataset.json"), "w") as dst:
+        json.dump(dataset, dst, indent=1)
+    return dataset
+
+
+if __name__ == "__main__":
+    make_dataset(sys.argv[1], *[int(arg) for arg in sys.argv[2:3]])
@@ -1,24 +1,42 @@
-from bottle import run, get, post, request
+from bottle import get, post, request, response
+import os
 
-animals = [{'name' : 'Ellie', 'type' : 'Elephant'},
+from job_store import ResourceStore
+from server import serve
+
+animals = ResourceStore(os.environ.get('ADATOS_RESOURCE_DB', './adatos_resources.db'), 'animal')
+if not len(animals):
+	for animal in [{'name' : 'Ellie', 'type' : 'Elephant'},
 			{'name' : 'Python', 'type' : 'Snake'},
-			{'name' : 'Zed', 'type' : 'Zebra'}]
+			{'name' : 'Zed', 'type' : 'Zebra'}]:
+		animals.put(animal['name'], animal)
 
+# a page of animals, e.g. /animal?limit=2 then /animal?limit=2&cursor=<next_cursor>
 @get('/animal')
 def getAll():
-	return {'animals' : animals}
+	try:
+		limit = min(max(int(request.query.get('limit', 50)), 1), 500)
+		cursor = int(request.query.get('cursor') or 0)
+	except ValueError:
+		response.status = 400
+		return {'error' : 'limit and cursor must be integers'}
+	page, next_cursor = animals.list(limit, cursor)
+	return {'animals' : page, 'next_cursor' : next_cursor}
 
 @get('/animal/<name>')
 def getOne(name):
-	the_animal = [animal for animal in animals if animal['name'] == name]
-	return {'animal' : the_animal[0]}
+	the_animal = animals.get(name)
+	if the_animal is None:
+		response.status = 404
+		return {'error' : 'no animal {}'.format(name)}
+	return {'animal' : the_animal}
 
 @post('/animal')
 def addOne():
 	new_animal = {'name' : request.json.get('name'), 'type' : request.json.get('type')}
-	animals.append(new_animal)
-	return {'animals' : animals}
+	animals.put(new_animal['name'], new_animal)
+	return {'animal' : new_animal}
 
 
 
-run(host='localhost', port=8000, reloader=True, debug=True)
\ No newline at end of file
+serve()
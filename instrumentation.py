@@ -0,0 +1,230 @@
+"""
+Description     : Spans around the pipeline stages recording wall time, CPU
+                  time, peak RSS growth and bytes read and written. Spans
+                  are aggregated per stage into histograms exposed in the
+                  Prometheus text format, and the spans of a job can be
+                  collected into a trace and dumped to JSON
+Libraries       : bisect, contextlib, functools, json, os, resource,
+                  threading, time
+"""
+
+
+import bisect
+from contextlib import contextmanager
+import functools
+import json
+import os
+import resource
+import threading
+import time
+
+from locks import atomic_write
+# ---------------------
+
+
+# seconds, from a window read to a full tile of a product
+SECONDS_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+                   120, 300, 600, 1800)
+# bytes, from a few blocks to a full product
+BYTES_BUCKETS = tuple(2 ** power for power in range(16, 36, 2))
+
+
+def _io_counters():
+    # characters read and written by the process, cached reads included;
+    # zeros where /proc is not available
+    try:
+        with open('/proc/self/io') as src:
+            counters = dict(line.split(':') for line in src)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _peak_rss():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# cumulative histogram of observations
+class Histogram(object):
+    """
+    buckets         ->      the upper bounds of the buckets
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+# the histograms of every stage
+class Metrics(object):
+    """
+    Each span feeds the stage histograms of wall time, CPU time, peak RSS
+    growth and bytes read and written; failed spans are also counted
+    """
+    series = (('wall', 'adatos_stage_seconds', SECONDS_BUCKETS,
+               'Wall time of the pipeline stages'),
+              ('cpu', 'adatos_stage_cpu_seconds', SECONDS_BUCKETS,
+               'CPU time of the thread running the stage'),
+              ('peak_rss_delta', 'adatos_stage_peak_rss_growth_bytes',
+               BYTES_BUCKETS, 'Growth of the process peak RSS in the stage'),
+              ('read_bytes', 'adatos_stage_read_bytes', BYTES_BUCKETS,
+               'Bytes read by the process during the stage'),
+              ('write_bytes', 'adatos_stage_write_bytes', BYTES_BUCKETS,
+               'Bytes written by the process during the stage'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._errors = {}
+
+    def record(self, span):
+        with self._lock:
+            for field, metric, buckets, text in self.series:
+                key = (metric, span['name'])
+                if key not in self._histograms:
+                    self._histograms[key] = Histogram(buckets)
+                self._histograms[key].observe(span[field])
+            if span['error'] is not None:
+                self._errors[span['name']] = (
+                    self._errors.get(span['name'], 0) + 1)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._errors.clear()
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            for field, metric, buckets, text in self.series:
+                lines.append("# HELP {} {}".format(metric, text))
+                lines.append("# TYPE {} histogram".format(metric))
+                for (name, stage), histogram in sorted(
+                        self._histograms.items()):
+                    if name != metric:
+                        continue
+                    for bound, total in histogram.cumulative():
+                        le = ("+Inf" if bound == float('inf')
+                              else repr(float(bound)))
+                        lines.append(
+                            '{}_bucket{{stage="{}",le="{}"}} {}'.format(
+                                metric, stage, le, total))
+                    lines.append('{}_sum{{stage="{}"}} {!r}'.format(
+                        metric, stage, float(histogram.sum)))
+                    lines.append('{}_count{{stage="{}"}} {}'.format(
+                        metric, stage, histogram.count))
+            lines.append("# HELP adatos_stage_errors_total Failed stages")
+            lines.append("# TYPE adatos_stage_errors_total counter")
+            for stage, count in sorted(self._errors.items()):
+                lines.append(
+                    'adatos_stage_errors_total{{stage="{}"}} {}'.format(
+                        stage, count))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+_local = threading.local()
+
+
+# time a stage
+@contextmanager
+def span(name, **labels):
+    """
+    name            ->      the stage, e.g. raster_mask
+    labels          ->      extra fields kept in the trace, e.g. the index
+
+    Peak RSS and bytes are process wide, so they include the work of other
+    threads running at the same time
+    """
+    parent = getattr(_local, 'stack', None)
+    if parent is None:
+        parent = _local.stack = []
+    record = {'name': name, 'labels': labels, 'depth': len(parent),
+              'start': time.time(), 'error': None}
+    parent.append(name)
+    read_start, write_start = _io_counters()
+    rss_start = _peak_rss()
+    cpu_start = time.thread_time()
+    wall_start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as error:
+        record['error'] = repr(error)
+        raise
+    finally:
+        record['wall'] = time.perf_counter() - wall_start
+        record['cpu'] = time.thread_time() - cpu_start
+        record['peak_rss_delta'] = _peak_rss() - rss_start
+        read_end, write_end = _io_counters()
+        record['read_bytes'] = read_end - read_start
+        record['write_bytes'] = write_end - write_start
+        parent.pop()
+        METRICS.record(record)
+        spans = getattr(_local, 'trace', None)
+        if spans is not None:
+            spans.append(record)
+
+
+# decorator timing every call of a function as a stage
+# nested=False is for kernels called once per block, e.g. std_array: they
+# are timed only when called outside any stage and otherwise count in the
+# stage calling them, instead of a span for every block
+def instrumented(name=None, nested=True):
+    def decorator(function):
+        stage = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not nested and getattr(_local, 'stack', None):
+                return function(*args, **kwargs)
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# collect the spans of the current thread, e.g. of a job
+@contextmanager
+def trace():
+    """
+    Yields the list the spans finished inside the block are appended to,
+    innermost first
+    """
+    previous = getattr(_local, 'trace', None)
+    spans = _local.trace = []
+    try:
+        yield spans
+    finally:
+        _local.trace = previous
+        if previous is not None:
+            previous.extend(spans)
+
+
+def dump_trace(spans, path, **meta):
+    """
+    Writes the spans of a trace, ordered by start time, to a JSON file
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    with atomic_write(path) as dst:
+        json.dump(dict(meta, spans=sorted(spans,
+                                          key=lambda record: record['start'])),
+                  dst, indent=1, default=str)
+    return path
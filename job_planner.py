@@ -0,0 +1,196 @@
+"""
+Description     : Planning of a tasking job. Parses the data_s2 products,
+                  collapses duplicates and works out the smallest set of
+                  downloads, sen2cor runs, band reads and index
+                  computations covering every requested analysis
+Libraries       : collections, datetime, re
+"""
+
+
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+import re
+# ---------------------
+
+
+# Sentinel 2 product names, e.g.
+# S2A_MSIL1C_20180903T031541_N0206_R118_T48NUH_20180903T061615
+PRODUCT_NAME = re.compile(r'^(?P<mission>S2[AB])_MSI(?P<level>L1C|L2A)_'
+                          r'(?P<sensing>\d{8}T\d{6})_N(?P<baseline>\d{4})_'
+                          r'R(?P<orbit>\d{3})_T(?P<tile>(?P<utm_zone>\d{2})'
+                          r'(?P<latitude_band>[C-X])(?P<grid_square>[A-Z]{2}))'
+                          r'_(?P<discriminator>\d{8}T\d{6})(?:\.SAFE)?$')
+
+# sensing date of any product name
+SENSING_DATE = re.compile(r'_([0-9]{8})T')
+
+# indices needed by the analysis_key values of the scripts that do not list
+# their own, YIELD needs every index of the yield propensity score
+ANALYSIS_INDICES = OrderedDict([
+    ('flood_risk', ('wNDWI',)),
+    ('foilar_moisture', ('wNDWI',)),
+    ('plant_productivity', ('YIELD',)),
+])
+
+# a parsed data_s2 product
+ProductRecord = namedtuple('ProductRecord', [
+    'product_name', 'mission', 'level', 'sensing', 'date', 'baseline',
+    'orbit', 'tile', 'utm_zone', 'latitude_band', 'grid_square'])
+
+
+# sensing date of a product name as YYYY-MM-DD
+def sensing_date(product_name):
+    match = SENSING_DATE.search(product_name)
+    if match is None:
+        raise ValueError("no sensing date in {}".format(product_name))
+    return datetime.strptime(match.group(1), '%Y%m%d').strftime('%Y-%m-%d')
+
+
+# parse a data_s2 entry, or a bare product name, into a ProductRecord
+def parse_product(entry):
+    product_name = entry if isinstance(entry, str) else entry['product_name']
+    match = PRODUCT_NAME.match(product_name)
+    if match is None:
+        raise ValueError("{} is not a Sentinel 2 product name".format(
+            product_name))
+    sensing = datetime.strptime(match.group('sensing'), '%Y%m%dT%H%M%S')
+    record = ProductRecord(product_name=product_name,
+                           mission=match.group('mission'),
+                           level=match.group('level'),
+                           sensing=sensing,
+                           date=sensing.strftime('%Y-%m-%d'),
+                           baseline=match.group('baseline'),
+                           orbit=int(match.group('orbit')),
+                           tile=match.group('tile'),
+                           utm_zone=int(match.group('utm_zone')),
+                           latitude_band=match.group('latitude_band'),
+                           grid_square=match.group('grid_square'))
+
+    # the tile given next to the name must be the tile of the product
+    if not isinstance(entry, str):
+        for key in ('utm_zone', 'latitude_band', 'grid_square'):
+            if key in entry and str(entry[key]) != str(getattr(record, key)):
+                raise ValueError("{} of {} is {}, not {}".format(
+                    key, product_name, getattr(record, key), entry[key]))
+    return record
+
+
+# indices and yield components of the index registry
+def _index_bands():
+    from sentinel2index_py3 import INDEX_BANDS, INDEX_REGISTRY, YIELD_INDICES
+    bands = OrderedDict((name, tuple(INDEX_BANDS[band][0]
+                                     for band in spec.bands))
+                        for name, spec in INDEX_REGISTRY.items())
+    return bands, YIELD_INDICES
+
+
+# the work of a tasking job
+class JobPlan(object):
+    """
+    products        ->      the distinct products, by product name
+    downloads       ->      products to download
+    sen2cor         ->      L1C products to convert to L2A
+    indices         ->      the indices computed for every product
+    yield_score     ->      True when the yield propensity is requested
+    band_reads      ->      the Sentinel 2 bands read for every product
+    analyses        ->      analysis_key to the indices it needs
+    unknown         ->      analysis_key values no script serves
+    requested       ->      the work a naive run of the request would do
+    """
+
+    def __init__(self, products, analyses, indices, band_reads, unknown,
+                 requested):
+        self.products = products
+        self.downloads = list(products.values())
+        self.sen2cor = [record for record in products.values()
+                        if record.level == 'L1C']
+        self.analyses = analyses
+        self.indices = indices
+        self.band_reads = band_reads
+        self.unknown = unknown
+        self.requested = requested
+        self.yield_score = any('YIELD' in names
+                               for names in analyses.values())
+
+    def planned(self):
+        return {'downloads': len(self.downloads),
+                'sen2cor_runs': len(self.sen2cor),
+                'band_reads': len(self.band_reads) * len(self.products),
+                'index_computations': (len(self.indices)
+                                       * len(self.products))}
+
+    def summary(self):
+        planned = self.planned()
+        return {'requested': self.requested,
+                'planned': planned,
+                'saved': {key: self.requested[key] - planned[key]
+                          for key in planned}}
+
+    def to_dict(self):
+        return {'products': [dict(record._asdict(),
+                                  sensing=record.sensing.isoformat())
+                             for record in self.products.values()],
+                'analyses': self.analyses,
+                'unknown_analyses': self.unknown,
+                'indices': self.indices,
+                'yield_score': self.yield_score,
+                'band_reads': self.band_reads,
+                'summary': self.summary()}
+
+
+# plan a tasking request
+def plan_job(req, known=None):
+    """
+    req             ->      the tasking request, its data_s2 entries and
+                            analysis_key values
+    known           ->      analysis_key to the indices it needs, for the
+                            keys a loaded script serves, see
+                            PluginSet.indices; ANALYSIS_INDICES when None
+
+    Returns a JobPlan, raises ValueError on an unparsable product
+    """
+    records = [parse_product(entry) for entry in req['data_s2']]
+    products = OrderedDict()
+    for record in records:
+        products.setdefault(record.product_name, record)
+
+    if known is None:
+        known = ANALYSIS_INDICES
+    index_bands, yield_indices = _index_bands()
+    analyses = OrderedDict()
+    unknown = []
+    for key in req['analysis_key']:
+        # a key needing an index the registry does not have is unknown too
+        if key in known and all(name == 'YIELD' or name in index_bands
+                                for name in known[key]):
+            analyses[key] = list(known[key])
+        else:
+            unknown.append(key)
+
+    # what a naive run reads: every index of every analysis of every
+    # data_s2 entry reads its own bands
+    naive_indices = 0
+    naive_reads = 0
+    indices = []
+    for names in analyses.values():
+        for name in names:
+            components = yield_indices if name == 'YIELD' else (name,)
+            naive_indices += len(components)
+            naive_reads += sum(len(index_bands[c]) for c in components)
+            for component in components:
+                if component not in indices:
+                    indices.append(component)
+
+    band_reads = []
+    for name in indices:
+        for band in index_bands[name]:
+            if band not in band_reads:
+                band_reads.append(band)
+
+    requested = {'downloads': len(records),
+                 'sen2cor_runs': len([r for r in records
+                                      if r.level == 'L1C']),
+                 'band_reads': naive_reads * len(records),
+                 'index_computations': naive_indices * len(records)}
+    return JobPlan(products, analyses, indices, band_reads, unknown,
+                   requested)
@@ -0,0 +1,146 @@
+"""
+Description     : Bounded priority queue of tasking jobs and the pool of
+                  worker threads running them, so the server never blocks
+                  on a Sentinel 2 job
+Libraries       : itertools, queue, threading, time, traceback, uuid
+"""
+
+
+import itertools
+import queue
+import threading
+import time
+import traceback
+import uuid
+# ---------------------
+
+
+# raised when the queue cannot take another job
+class QueueFull(Exception):
+    pass
+
+
+# a tasking request and its progress
+class Job(object):
+    """
+    request         ->      the validated tasking request
+    priority        ->      jobs with a lower priority run first
+    context         ->      anything else the handler needs, e.g. the plan
+    status          ->      queued, running, done or failed
+    """
+
+    def __init__(self, request, priority=0, context=None):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.priority = priority
+        self.context = context or {}
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.result = None
+
+    def to_dict(self):
+        return {'job_id': self.id,
+                'tasking_job_id': self.request.get('job_id'),
+                'organization_key': self.request.get('organization_key'),
+                'region_key': self.request.get('region_key'),
+                'priority': self.priority,
+                'status': self.status,
+                'submitted': self.submitted,
+                'started': self.started,
+                'finished': self.finished,
+                'error': self.error}
+
+
+# queue of jobs served by a pool of worker threads
+class JobQueue(object):
+    """
+    handler         ->      function(job) running the job pipeline, its
+                            return value is kept as the job result
+    workers         ->      number of jobs running at the same time
+    maxsize         ->      number of jobs waiting before submit raises
+                            QueueFull
+    store           ->      a job_store.JobStore every status change is
+                            saved to, finished jobs are then only kept
+                            there
+    """
+
+    def __init__(self, handler, workers=2, maxsize=32, store=None):
+        self.handler = handler
+        self.workers = workers
+        self.store = store
+        self.jobs = {}
+        self._queue = queue.PriorityQueue(maxsize)
+        self._order = itertools.count()
+        self._threads = []
+
+    def submit(self, request, priority=0, **context):
+        """
+        Queues a job without blocking, raises QueueFull when the queue is
+        full. Returns the job
+        """
+        job = Job(request, priority, context)
+        self.jobs[job.id] = job
+        self._save(job)
+        try:
+            self._queue.put_nowait((priority, next(self._order), job))
+        except queue.Full:
+            del self.jobs[job.id]
+            if self.store is not None:
+                self.store.delete(job.id)
+            raise QueueFull("{} jobs are already waiting".format(
+                self._queue.maxsize))
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _save(self, job):
+        if self.store is not None:
+            self.store.save(job)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name="job-worker-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        # a None job after every queued job ends each worker
+        for thread in self._threads:
+            self._queue.put((float('inf'), next(self._order), None))
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()[2]
+            if job is None:
+                return
+            job.status = 'running'
+            job.started = time.time()
+            self._save(job)
+            try:
+                job.result = self.handler(job)
+                job.status = 'done'
+            except Exception as error:
+                job.error = repr(error)
+                job.status = 'failed'
+                traceback.print_exc()
+            finally:
+                job.finished = time.time()
+                try:
+                    self._save(job)
+                    if self.store is not None:
+                        del self.jobs[job.id]
+                except Exception:
+                    traceback.print_exc()
+                self._queue.task_done()
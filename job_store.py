@@ -0,0 +1,258 @@
+"""
+Description     : SQLite stores of the tasking jobs and of the crud
+                  resources, in WAL mode so status reads do not wait on
+                  writes. Records are looked up by id through the primary
+                  key, filtered through secondary indexes and listed newest
+                  first with cursor pagination
+Libraries       : json, os, sqlite3, threading
+"""
+
+
+import json
+import os
+import sqlite3
+import threading
+# ---------------------
+
+
+# whether a process is still running
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# one connection per thread on a WAL database
+class _SqliteStore(object):
+    """
+    path            ->      the database file, created with its tables and
+                            indexes on first use
+    """
+    schema = ()
+
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as connection:
+            for statement in self.schema:
+                connection.execute(statement)
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _page(rows, limit, decode):
+        """
+        Returns (records, cursor of the next page or None) from up to
+        limit + 1 rows
+        """
+        rows = list(rows)
+        cursor = rows[limit - 1]['seq'] if len(rows) > limit else None
+        return [decode(row) for row in rows[:limit]], cursor
+
+
+# store of the tasking jobs
+class JobStore(_SqliteStore):
+    """
+    Every job is kept with its status, request and result, so job status
+    survives restarts
+    """
+    schema = (
+        """CREATE TABLE IF NOT EXISTS jobs (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               id TEXT NOT NULL UNIQUE,
+               organization_key TEXT,
+               region_key TEXT,
+               status TEXT NOT NULL,
+               priority INTEGER,
+               submitted REAL,
+               started REAL,
+               finished REAL,
+               error TEXT,
+               request TEXT,
+               result TEXT,
+               worker INTEGER)""",
+        "CREATE INDEX IF NOT EXISTS jobs_organization "
+        "ON jobs (organization_key, seq)",
+        "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq)",
+        "CREATE INDEX IF NOT EXISTS jobs_region ON jobs (region_key, seq)",
+    )
+    filters = (('organization', 'organization_key'), ('status', 'status'),
+               ('region', 'region_key'))
+
+    def __init__(self, path):
+        super(JobStore, self).__init__(path)
+        # databases created before jobs recorded their worker
+        with self._connect() as connection:
+            columns = [row['name'] for row in
+                       connection.execute("PRAGMA table_info(jobs)")]
+            if 'worker' not in columns:
+                connection.execute(
+                    "ALTER TABLE jobs ADD COLUMN worker INTEGER")
+
+    def save(self, job):
+        """
+        Inserts or updates a job_queue.Job, recording the process holding
+        it in its queue
+        """
+        status = job.to_dict()
+        values = (status['organization_key'], status['region_key'],
+                  status['status'], status['priority'], status['submitted'],
+                  status['started'], status['finished'], status['error'],
+                  json.dumps(job.request),
+                  json.dumps(job.result, default=str), os.getpid())
+        with self._connect() as connection:
+            connection.execute(
+                """INSERT INTO jobs (organization_key, region_key, status,
+                       priority, submitted, started, finished, error,
+                       request, result, worker, id)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (id) DO UPDATE SET
+                       status = excluded.status,
+                       started = excluded.started,
+                       finished = excluded.finished,
+                       error = excluded.error,
+                       result = excluded.result,
+                       worker = excluded.worker""",
+                values + (job.id,))
+
+    def delete(self, job_id):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def get(self, job_id):
+        row = self._connect().execute(
+            "SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._decode(row) if row is not None else None
+
+    def list(self, organization=None, status=None, region=None, limit=50,
+             cursor=None):
+        """
+        Returns (jobs newest first, cursor of the next page or None)
+        organization, status, region    ->  optional filters
+        cursor                          ->  the cursor of the previous page
+        """
+        arguments = {'organization': organization, 'status': status,
+                     'region': region}
+        clauses = []
+        values = []
+        for argument, column in self.filters:
+            if arguments[argument] is not None:
+                clauses.append("{} = ?".format(column))
+                values.append(arguments[argument])
+        if cursor is not None:
+            clauses.append("seq < ?")
+            values.append(int(cursor))
+        where = "WHERE " + " AND ".join(clauses) if clauses else ""
+        rows = self._connect().execute(
+            "SELECT * FROM jobs {} ORDER BY seq DESC LIMIT ?".format(where),
+            values + [limit + 1])
+        return self._page(rows, limit, self._decode)
+
+    def counts(self):
+        """
+        Returns the number of jobs in every status
+        """
+        return dict(self._connect().execute(
+            "SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def interrupt(self, dead_only=False):
+        """
+        Marks the jobs left queued or running by a previous process as
+        failed, returns how many there were
+        dead_only       ->      only the jobs of worker processes that
+                                exited, e.g. when a server process
+                                restarts one of its workers while the
+                                others keep running their jobs
+        """
+        where = "status IN ('queued', 'running')"
+        values = []
+        if dead_only:
+            workers = [row[0] for row in self._connect().execute(
+                "SELECT DISTINCT worker FROM jobs WHERE " + where)]
+            dead = [worker for worker in workers
+                    if worker is not None and not _alive(worker)]
+            if not dead:
+                return 0
+            where += " AND worker IN ({})".format(
+                ", ".join("?" * len(dead)))
+            values = dead
+        with self._connect() as connection:
+            return connection.execute(
+                """UPDATE jobs SET status = 'failed',
+                       error = 'interrupted by a restart'
+                   WHERE """ + where, values).rowcount
+
+    @staticmethod
+    def _decode(row):
+        job = {key: row[key] for key in row.keys()
+               if key not in ('seq', 'id', 'request', 'result', 'worker')}
+        job['job_id'] = row['id']
+        job['request'] = json.loads(row['request'])
+        job['result'] = json.loads(row['result'])
+        job['tasking_job_id'] = job['request'].get('job_id')
+        return job
+
+
+# store of named json resources of one kind, e.g. the crud animals
+class ResourceStore(_SqliteStore):
+    """
+    kind            ->      the kind of resource, several kinds share one
+                            database
+    """
+    schema = (
+        """CREATE TABLE IF NOT EXISTS resources (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               kind TEXT NOT NULL,
+               name TEXT NOT NULL,
+               data TEXT NOT NULL,
+               UNIQUE (kind, name))""",
+    )
+
+    def __init__(self, path, kind):
+        self.kind = kind
+        super(ResourceStore, self).__init__(path)
+
+    def __len__(self):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM resources WHERE kind = ?",
+            (self.kind,)).fetchone()[0]
+
+    def put(self, name, data):
+        with self._connect() as connection:
+            connection.execute(
+                """INSERT INTO resources (kind, name, data) VALUES (?, ?, ?)
+                   ON CONFLICT (kind, name) DO UPDATE SET
+                       data = excluded.data""",
+                (self.kind, name, json.dumps(data)))
+
+    def get(self, name):
+        row = self._connect().execute(
+            "SELECT data FROM resources WHERE kind = ? AND name = ?",
+            (self.kind, name)).fetchone()
+        return json.loads(row['data']) if row is not None else None
+
+    def list(self, limit=50, cursor=None):
+        """
+        Returns (resources in insertion order, cursor of the next page or
+        None)
+        """
+        if cursor is None:
+            cursor = 0
+        rows = self._connect().execute(
+            """SELECT seq, data FROM resources WHERE kind = ? AND seq > ?
+               ORDER BY seq LIMIT ?""", (self.kind, int(cursor), limit + 1))
+        return self._page(rows, limit, lambda row: json.loads(row['data']))
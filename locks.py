@@ -0,0 +1,74 @@
+"""
+Description     : Advisory file locks shared by the processes serving the
+                  app, e.g. the gunicorn workers. Downloads, sen2cor runs,
+                  the product store index and the script sync are
+                  coordinated through lock files next to the data they
+                  guard; threads of one process contend for them too.
+                  Files read by other processes are written atomically
+Libraries       : contextlib, fcntl, os, threading
+"""
+
+
+from contextlib import contextmanager
+import fcntl
+import os
+import threading
+# ---------------------
+
+
+# hold a lock file
+@contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """
+    path            ->      the lock file, created if missing
+    shared          ->      take a shared lock, exclusive locks wait for
+                            every shared one
+    blocking        ->      wait for the lock, otherwise give up at once
+
+    Yields True when the lock is held, False when blocking is off and
+    another holder has it
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+# temporary name next to path, unique to the process and thread writing it
+def temp_path(path, suffix=".tmp"):
+    return "{}.{}.{}{}".format(path, os.getpid(), threading.get_ident(),
+                               suffix)
+
+
+# write a file atomically
+@contextmanager
+def atomic_write(path, mode="w"):
+    """
+    Yields a file open on a temp_path of path, moved over path once the
+    block completes, so readers see either the previous file or the whole
+    new one; the temporary file is removed if the block fails
+    """
+    temp = temp_path(path)
+    try:
+        with open(temp, mode) as dst:
+            yield dst
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
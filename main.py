@@ -1,77 +1,427 @@
-from bottle import run, get, post, request  
-from datetime import datetime
-import importlib 
+import time
+STARTED = time.time()
+
+from bottle import get, post, request, response
 import json
+import socket
 import subprocess
-import re 
 import os
+import threading
+
+from job_planner import ANALYSIS_INDICES, parse_product, plan_job
+from job_queue import JobQueue, QueueFull
+from job_store import JobStore
+from locks import file_lock
+from instrumentation import METRICS, dump_trace, span, trace
+from plugins import PluginRegistry
+from schema import compile_schema
+from server import HOST, PORT, serve
+from product_store import AwsBackend, ProductStore
+from sen2cor_runner import Sen2CorRunner
+from tile_server import JOB_ID, TileServer
+import sentinel2index_py3
+from sentinel2index_py3 import (INDEX_BANDS, YIELD_INDICES, BandCache, ProductCatalog, indices_f, job_work_dir,
+                                raster_resampling, yield_f)
+
+# seconds spent importing the modules of the server
+IMPORTED = time.time() - STARTED
+
+# Settings of the job queue, from the environment
+WORKERS = int(os.environ.get('ADATOS_WORKERS', 2))
+QUEUE_SIZE = int(os.environ.get('ADATOS_QUEUE_SIZE', 32))
+# SQLite database keeping the status of every job across restarts
+JOB_DB = os.environ.get('ADATOS_JOB_DB', './adatos_jobs.db')
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# folder the span trace of every job is dumped to, no traces when unset
+TRACE_DIR = os.environ.get('ADATOS_TRACE_DIR')
+# every job writes its temporary and raw images under <work dir>/<job id>
+WORK_DIR = os.environ.get('ADATOS_WORK_DIR', './work')
+# Tiles of the job indices rendered on request: cache folder, memory and disk budgets, browser cache lifetime
+TILE_CACHE = os.environ.get('ADATOS_TILE_CACHE', './tilecache')
+TILE_MEMORY = int(os.environ.get('ADATOS_TILE_MEMORY', 64 * 1024 ** 2))
+TILE_DISK = int(os.environ.get('ADATOS_TILE_DISK', 10 * 1024 ** 3))
+TILE_MAX_AGE = int(os.environ.get('ADATOS_TILE_MAX_AGE', 3600))
+# estate AOI of every region_key, read from <AOI dir>/<region_key>.shp
+AOI_DIR = os.environ.get('ADATOS_AOI_DIR', './aoi')
+# tiles pre-rendered when ADATOS_PRETILE=1, under <tile dir>/<layer>/<index folder>
+TILE_DIR = os.environ.get('ADATOS_TILE_DIR', './tiles')
+# zooms rendered to the tile cache when a job finishes, e.g. '8,12', none when empty
+TILE_PREWARM = [int(zoom) for zoom in os.environ.get('ADATOS_TILE_PREWARM', '8,12').split(',') if zoom]
+# organization_key -> priority, lower runs first, e.g. '{"demo": 20}'
+PRIORITIES = json.loads(os.environ.get('ADATOS_PRIORITIES', '{}'))
+DEFAULT_PRIORITY = 10
+# Size budget of the local product store and number of files downloaded at the same time
+STORE_BYTES = int(os.environ.get('ADATOS_STORE_BYTES', 200 * 1024 ** 3))
+DOWNLOAD_WORKERS = int(os.environ.get('ADATOS_DOWNLOAD_WORKERS', 4))
+# sen2cor command (a stub script works offline), its output folder and the peak memory of one run
+SEN2COR = os.environ.get('ADATOS_SEN2COR', 'L2A_Process').split()
+SEN2COR_CACHE = os.environ.get('ADATOS_SEN2COR_CACHE', './l2afolder')
+SEN2COR_MEMORY = int(os.environ.get('ADATOS_SEN2COR_MEMORY', 4 * 1024 ** 3))
+
+# Schema of a tasking request, compiled once
+TASKING_SCHEMA = {
+    'type': 'object',
+    'required': ['organization_key', 'region_key', 'analysis_key', 'data_s2'],
+    'properties': {
+        'organization_key': {'type': 'string'},
+        'region_key': {'type': 'string'},
+        'analysis_key': {'type': 'array', 'items': {'type': 'string'}},
+        'data_s2': {'type': 'array', 'minItems': 1, 'items': {
+            'type': 'object',
+            'required': ['product_name', 'utm_zone', 'latitude_band', 'grid_square'],
+            'properties': {
+                'product_name': {'type': 'string'},
+                'utm_zone': {'type': 'integer'},
+                'latitude_band': {'type': 'string'},
+                'grid_square': {'type': 'string'}}}}}}
+check_tasking = compile_schema(TASKING_SCHEMA)
+
+# Validate a tasking request, returns the list of problems found
+def validate_tasking(req):
+    errors = check_tasking(req)
+    if errors:
+        return errors
+    for i, product in enumerate(req['data_s2']):
+        try:
+            parse_product(product)
+        except ValueError as error:
+            errors.append('data_s2[{}]: {}'.format(i, error))
+    return errors
+
+# JSON body of a request, None when it is not valid JSON. request.json answers bad JSON with an HTML error page
+def request_json():
+    try:
+        return json.loads(request.body.read().decode('utf-8') or 'null')
+    except ValueError:
+        return None
+
+# AOI of a region, raises KeyError when the region has none
+def region_aoi(region_key):
+    path = os.path.join(AOI_DIR, '{}.shp'.format(region_key))
+    if not JOB_ID.match(region_key) or not os.path.exists(path):
+        raise KeyError('no AOI for region_key {}'.format(region_key))
+    return path
 
-req = {
-    "api_key": "",
-    "job_id": 6,
-    "organization_id": 1,
-    "organization_key": "demo",
-    "region_key": "Johor",
-    "mode": "s2",
-    "analysis_key": ["flood_risk", "plant_productivity", "foilar_moisture"],
-    "data_s2": [{
-        "product_name": "S2A_MSIL1C_20180903T031541_N0206_R118_T48NUH_20180903T061615",
-        "utm_zone": 48,
-        "latitude_band": "N",
-        "grid_square": "UH"
-    }, {
-        "product_name": "S2A_MSIL1C_20180903T031541_N0206_R118_T48NUH_20180903T061615",
-        "utm_zone": 48,
-        "latitude_band": "N",
-        "grid_square": "UH"
-    }]
-}
-
-# POST Request from Tasking_server Scripts from S3 Based on the tasking_server's analysis key 
+# POST Request from Tasking_server, queued for the worker pool. Replies at once with the job id
 @post('/tasking')
-def postReq(): 
-	req = request.json
-	print (req) 
-	return "task request received!"
+def postReq():
+    req = request_json()
+    errors = validate_tasking(req)
+    if errors:
+        response.status = 400
+        return {'errors': errors}
+    # the job keeps the scripts loaded when it was submitted, and is planned with them
+    pinned = current_scripts()
+    plan = plan_job(req, pinned.indices(ANALYSIS_INDICES))
+    if plan.unknown:
+        response.status = 400
+        return {'errors': ['unknown analysis_key {}'.format(key)
+                           for key in plan.unknown]}
+    if plan.indices:
+        try:
+            region_aoi(req['region_key'])
+        except KeyError as error:
+            response.status = 400
+            return {'errors': [error.args[0]]}
+    priority = PRIORITIES.get(req['organization_key'], DEFAULT_PRIORITY)
+    try:
+        job = jobs.submit(req, priority, plan=plan, plugins=pinned)
+    except QueueFull as error:
+        response.status = 429
+        response.set_header('Retry-After', '60')
+        return {'error': str(error)}
+    response.status = 202
+    return {'job_id': job.id, 'status': job.status}
+
+# GET the status of a job, from memory while it is queued or running and from the job store after
+@get('/tasking/<job_id>')
+def getJob(job_id):
+    job = jobs.get(job_id)
+    if job is not None:
+        status = job.to_dict()
+        status['plugins'] = job.context['plugins'].versions()
+        return status
+    status = job_store.get(job_id)
+    if status is None:
+        response.status = 404
+        return {'error': 'no job {}'.format(job_id)}
+    del status['request']
+    return status
+
+# GET the plan of a job, planned again from the stored request once the job is finished
+@get('/tasking/<job_id>/plan')
+def getPlan(job_id):
+    job = jobs.get(job_id)
+    if job is not None:
+        return job.context['plan'].to_dict()
+    status = job_store.get(job_id)
+    if status is None:
+        response.status = 404
+        return {'error': 'no job {}'.format(job_id)}
+    return plan_job(status['request'], current_scripts().indices(ANALYSIS_INDICES)).to_dict()
+
+# GET a page of jobs, newest first, filtered by organization, status and region, e.g. /jobs?status=failed&limit=20
+@get('/jobs')
+def getJobs():
+    try:
+        limit = min(int(request.query.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE)
+        cursor = request.query.get('cursor')
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        response.status = 400
+        return {'error': 'limit and cursor must be integers'}
+    page, next_cursor = job_store.list(organization=request.query.get('organization'),
+                                       status=request.query.get('status'),
+                                       region=request.query.get('region'),
+                                       limit=max(limit, 1), cursor=cursor)
+    for status in page:
+        del status['request'], status['result']
+    return {'jobs': page, 'next_cursor': next_cursor}
+
+# GET the number of jobs in every status
+@get('/jobs/summary')
+def getJobSummary():
+    return {'statuses': job_store.counts(), 'pending': jobs.pending()}
+
+# POST a tasking request to see its plan without queueing it
+@post('/tasking/plan')
+def postPlan():
+    req = request_json()
+    errors = validate_tasking(req)
+    if errors:
+        response.status = 400
+        return {'errors': errors}
+    return plan_job(req, current_scripts().indices(ANALYSIS_INDICES)).to_dict()
+
+# GET a tile of an index of a job, e.g. /tiles/<job_id>/ndvi/12/3223/2028.png, rendered from the job's image on first request
+@get('/tiles/<job_id>/<index>/<z:int>/<x:int>/<y:int>.png')
+def getTile(job_id, index, z, x, y):
+    try:
+        png, token = tiles.tile(job_id, index, z, x, y)
+    except (KeyError, ValueError) as error:
+        response.status = 404
+        return {'error': error.args[0]}
+    etag = '"{}"'.format(token)
+    response.set_header('ETag', etag)
+    response.set_header('Cache-Control', 'public, max-age={}'.format(TILE_MAX_AGE))
+    if request.headers.get('If-None-Match') == etag:
+        response.status = 304
+        return b''
+    response.content_type = 'image/png'
+    return png
+
+# GET the hits and sizes of the tile caches
+@get('/tiles/stats')
+def getTileStats():
+    return tiles.status()
+
+# Startup phases in seconds, reported by GET /startup
+startup = {'imports': IMPORTED, 'listening': None, 'script_sync': None, 'script_import': None, 'error': None}
+
+# Folder of the synced scripts. One process syncs at a time and marks the folder, the other processes serving requests load the new scripts when they see the mark
+SCRIPT_FOLDER = 'awspyscript'
+SYNC_LOCK = os.path.join(SCRIPT_FOLDER, '.sync.lock')
+SYNC_MARK = os.path.join(SCRIPT_FOLDER, '.synced')
 
 # Command to sync S3 Bucket, using Subprocess module popen. output should download script in awscriptpy folder
-p = subprocess.Popen(['aws', 's3', 'sync','s3://adatos-agri-services/scripts','awspyscript'], stdout=subprocess.PIPE)
-print (p.communicate())
+def sync_scripts():
+    start = time.time()
+    try:
+        with span('s3_sync'), file_lock(SYNC_LOCK, blocking=False) as syncing:
+            if syncing:
+                p = subprocess.Popen(['aws', 's3', 'sync','s3://adatos-agri-services/scripts',SCRIPT_FOLDER], stdout=subprocess.PIPE)
+                print (p.communicate())
+                with open(SYNC_MARK, 'w'):
+                    pass
+        if not syncing:
+            # another process is syncing, its scripts are loaded once it is done
+            with file_lock(SYNC_LOCK):
+                pass
+    except OSError as error:
+        # the scripts already in the folder are still loaded
+        startup['error'] = repr(error)
+    startup['script_sync'] = time.time() - start
+
+    return load_scripts()
+
+def sync_mark():
+    try:
+        return os.stat(SYNC_MARK).st_mtime_ns
+    except OSError:
+        return None
+
+# Load the scripts that changed, new jobs use them while running jobs keep theirs
+def load_scripts():
+    start = time.time()
+    with span('plugin_reload'):
+        loaded['mark'] = sync_mark()
+        changed = plugins.reload()
+    startup['script_import'] = time.time() - start
+    return changed
 
-# Import Dynamically to main.py to import Josie's Script from S3 Bucket 
-sample = importlib.import_module(".sample","awspyscript")
-josie_script = importlib.import_module(".SentinelHubSingleDownload","awspyscript")
+# The scripts new jobs pin, loaded again first when another process synced since
+def current_scripts():
+    if sync_mark() != loaded['mark']:
+        load_scripts()
+    return plugins.current()
 
-# Define tasking_server json as required variable 
-date = req['data_s2'][0]['product_name'] 
+# The scripts are synced in the background once the server accepts connections
+def sync_when_listening():
+    while True:
+        try:
+            socket.create_connection((HOST, PORT), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    startup['listening'] = time.time() - STARTED
+    try:
+        sync_scripts()
+    except Exception as error:
+        startup['error'] = repr(error)
 
-def date_check(date):
-    pattern = '_([0-9]{8})T'
-    dtd_list = re.findall(pattern, date)
-    dtd = dtd_list[0]
-    f_dtd = datetime.strptime(dtd, '%Y%m%d').strftime('%Y-%m-%d')
-    return f_dtd
+# Josie's and Hafiz's scripts from the S3 Bucket, by analysis_key. The scripts of the last sync are loaded before serving, so the first jobs find their analyses
+plugins = PluginRegistry(SCRIPT_FOLDER)
+loaded = {'mark': None}
+load_scripts()
 
-tiledate = date_check(date)
- 
-utm = str(req['data_s2'][0]['utm_zone'])
-lat = req['data_s2'][0]['latitude_band']
-grid = req['data_s2'][0]['grid_square']
+# GET the loaded scripts and their versions
+@get('/plugins')
+def getPlugins():
+    current = current_scripts()
+    return {'versions': current.versions(),
+            'analyses': {key: plugin.name for key, plugin in current.analyses.items()},
+            'errors': plugins.errors}
 
-tilename = utm + lat + grid
+# POST to sync the scripts again and swap the new versions in, without restarting the server
+@post('/plugins/reload')
+def postReload():
+    threading.Thread(target=sync_scripts, name='script-sync', daemon=True).start()
+    response.status = 202
+    return {'status': 'reloading'}
+
+# GET the stage histograms in the Prometheus text format, those of the process answering when ADATOS_SERVER=processes
+@get('/metrics')
+def getMetrics():
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return METRICS.render()
+
+# GET where the startup time went, the geo libraries are only imported by the first job using them
+@get('/startup')
+def getStartup():
+    report = dict(startup)
+    report['lazy_imports'] = dict(sentinel2index_py3.IMPORT_TIMES)
+    return report
 
 # create a file to store josie's script 
 downloadloc = r'./awsfolder'
 if not os.path.exists(downloadloc):
     os.makedirs(downloadloc)
 
-# Parse in variable as argument in josie function and Run Async Josie's Script 
+# Products are kept across jobs in the download folder, each one is only fetched once
+store = ProductStore(downloadloc, AwsBackend(), max_bytes=STORE_BYTES, workers=DOWNLOAD_WORKERS)
+
+# L2A outputs are cached by product and sen2cor version, resampled once before they are cached
+sen2cor = Sen2CorRunner(SEN2COR_CACHE, executable=SEN2COR, mem_per_run=SEN2COR_MEMORY, postprocess=raster_resampling)
+
+# Tiles are rendered from the images the jobs leave in their work folders
+tiles = TileServer(WORK_DIR, TILE_CACHE, ramp_folder='ramps', memory_bytes=TILE_MEMORY, disk_bytes=TILE_DISK)
+
+# Pipeline of a tasking job, run by the worker pool. Every distinct product of the plan is processed once
+def process_job(job):
+    if TRACE_DIR is None:
+        with span('job'):
+            return run_pipeline(job)
+    # the spans of the job are dumped even when it fails
+    with trace() as spans:
+        try:
+            with span('job'):
+                return run_pipeline(job)
+        finally:
+            dump_trace(spans, os.path.join(TRACE_DIR, '{}.json'.format(job.id)),
+                       job_id=job.id, request=job.request)
+
+def run_pipeline(job):
+    with job_work_dir(os.path.join(WORK_DIR, job.id)):
+        result = run_stages(job)
+    # The first views of the job's maps are served from the tile cache
+    if TILE_PREWARM:
+        for layer in result['layers'].values():
+            tiles.prewarm_later(layer, TILE_PREWARM)
+    return result
+
+# Tile layer of the index images of a product of a job, e.g. /tiles/<job id>-48NUH-20180903T031541/ndvi/...
+def product_layer(job_id, record):
+    return '{}-{}-{}'.format(job_id, record.tile, record.sensing.strftime('%Y%m%dT%H%M%S'))
+
+# Indices of the plan for every product over the AOI, each product in its own work folder and tile layer
+def index_stage(job, l2a_folders, aoi):
+    plan = job.context['plan']
+    layers = {}
+    # the yield computes its components itself
+    names = [name for name in plan.indices if not (plan.yield_score and name in YIELD_INDICES)]
+    cache = BandCache()
+    try:
+        for record in plan.downloads:
+            catalog = ProductCatalog.load(l2a_folders[record.product_name])
+            band_paths = {name: catalog.path(band, resolution) for name, (band, resolution) in INDEX_BANDS.items()}
+            layer = product_layer(job.id, record)
+            tile_folder = os.path.join(TILE_DIR, layer)
+            os.makedirs(tile_folder, exist_ok=True)
+            with job_work_dir(os.path.join(WORK_DIR, layer)), span('indices', product=record.product_name):
+                if plan.yield_score:
+                    yield_f(*[band_paths[band] for band in ('nir', 'red', 'green', 'blue', 're5', 're6', 'swir11')],
+                            aoi, tile_folder, cache=cache)
+                if names:
+                    indices_f(names, band_paths, aoi, tile_folder, cache)
+            layers[record.product_name] = layer
+    finally:
+        cache.clear()
+    return layers
+
+def run_stages(job):
+    plan = job.context['plan']
+    # Every analysis of the job needs its script, checked before any download
+    missing = [key for key in plan.analyses if not hasattr(job.context['plugins'].analysis(key), 'run')]
+    if missing:
+        raise KeyError('no script runs analysis_key {}'.format(', '.join(missing)))
+    aoi = region_aoi(job.request['region_key']) if plan.indices else None
+    # Fetch the products of the job at the same time, kept from eviction until every one went through sen2cor
+    l2a_folders = {}
+    with store.pinned(product.product_name for product in plan.downloads) as product_names:
+        with span('download'):
+            safe_folders = store.prefetch(product_names)
+
+        # Run Output in sen2Cor
+        for product_name, safe_folder in zip(product_names, safe_folders):
+            with span('sen2cor', product=product_name):
+                l2a_folders[product_name] = sen2cor.run(safe_folder, product_name)
+
+    # The indices the analyses need, rendered to tiles, before the analyses read them
+    layers = index_stage(job, l2a_folders, aoi) if plan.indices else {}
+    job.context['layers'] = layers
+
+    # Run Hafiz's Script, with the script versions pinned by the job
+    analyses = {}
+    for key in plan.analyses:
+        with span('analysis', analysis_key=key):
+            analyses[key] = job.context['plugins'].analysis(key).run(job, l2a_folders)
 
-# Run Output in sen2Cor 
+    # timings of the sen2cor stage are kept as the job result
+    timings = [timing._asdict() for timing in list(sen2cor.timings) if timing.product_id in l2a_folders]
+    return {'l2a': l2a_folders, 'sen2cor': timings, 'analyses': analyses, 'layers': layers}
 
-# Run Hafiz's Script 
+# Jobs left unfinished by the previous process are marked failed, before any worker starts
+job_store = JobStore(JOB_DB)
+job_store.interrupt()
+jobs = JobQueue(process_job, workers=WORKERS, maxsize=QUEUE_SIZE, store=job_store)
 
-# *NEW REQUEST PENDING* 
+# The job workers and the script sync run in every process serving requests, the products, the sen2cor runs and the sync are shared through file locks
+# Every process keeps its own job queue, the jobs a restarted worker process had queued or running are failed when its replacement starts
+def start_background():
+    job_store.interrupt(dead_only=True)
+    jobs.start()
+    threading.Thread(target=sync_when_listening, name='script-sync', daemon=True).start()
 
 # Error Handler to end script and notify josie & hafiz error** 
 
@@ -81,4 +431,5 @@ if not os.path.exists(downloadloc):
 # Post to mapping_server
 # python post to completejobrequest, parse in api keys and jobid to trigger email 
 
-run(host='localhost', port=8000, reloader=True, debug=True)
\ No newline at end of file
+# ADATOS_SERVER picks the development server or a production one
+serve(on_start=start_background)
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+Description     : Registry of the analysis scripts synced from S3. Modules
+                  are loaded by content hash, so a script is only imported
+                  again when it changes, and new versions are swapped in
+                  for new jobs while running jobs keep the version they
+                  started with
+Libraries       : collections, glob, hashlib, importlib, os, threading,
+                  time
+"""
+
+
+from collections import namedtuple
+import glob
+import hashlib
+import importlib.util
+import os
+import threading
+import time
+# ---------------------
+
+
+# a loaded version of a script
+Plugin = namedtuple('Plugin', ['name', 'path', 'digest', 'module',
+                               'analysis_keys', 'loaded'])
+
+
+# the scripts of a job, frozen when the job is submitted
+class PluginSet(object):
+    """
+    modules         ->      module name to Plugin
+    analyses        ->      analysis_key to Plugin
+    """
+
+    def __init__(self, modules, analyses):
+        self.modules = modules
+        self.analyses = analyses
+
+    def analysis(self, key):
+        plugin = self.analyses.get(key)
+        return plugin.module if plugin is not None else None
+
+    def module(self, name):
+        plugin = self.modules.get(name)
+        return plugin.module if plugin is not None else None
+
+    def indices(self, defaults):
+        """
+        defaults        ->      analysis_key to the indices it needs, e.g.
+                                job_planner.ANALYSIS_INDICES
+
+        Returns the indices needed by every analysis_key the scripts
+        serve. A script may list them in an ANALYSIS_INDICES dictionary,
+        the defaults are used otherwise and no indices without either
+        """
+        indices = {}
+        for key, plugin in self.analyses.items():
+            declared = getattr(plugin.module, 'ANALYSIS_INDICES', {})
+            indices[key] = tuple(declared.get(key, defaults.get(key, ())))
+        return indices
+
+    def versions(self):
+        return {name: plugin.digest[:12]
+                for name, plugin in self.modules.items()}
+
+
+# registry of the scripts of a folder
+class PluginRegistry(object):
+    """
+    folder          ->      folder of the scripts, e.g. the awspyscript
+                            folder synced from S3
+
+    A script serves the analysis_key values listed in its ANALYSIS_KEYS
+    and runs them with run(job, l2a_folders), the indices they need may
+    be listed in ANALYSIS_INDICES; every script is also
+    available by module name, e.g. SentinelHubSingleDownload
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._modules = {}
+        self._digests = {}
+        self._current = PluginSet({}, {})
+        self.errors = {}
+
+    def current(self):
+        """
+        Returns the PluginSet new jobs should pin
+        """
+        return self._current
+
+    def reload(self):
+        """
+        Loads the scripts that changed since the last call and swaps the
+        new PluginSet in. Returns the names of the modules that changed
+        """
+        with self._lock:
+            modules = {}
+            for path in sorted(glob.glob(os.path.join(self.folder,
+                                                      '*.py'))):
+                name = os.path.splitext(os.path.basename(path))[0]
+                if name.startswith('_'):
+                    continue
+                digest = self._digest(path)
+                plugin = self._modules.get(digest)
+                if plugin is None:
+                    try:
+                        plugin = self._load(name, path, digest)
+                    except Exception as error:
+                        # a broken script keeps its last working version
+                        self.errors[name] = repr(error)
+                        plugin = self._current.modules.get(name)
+                        if plugin is None:
+                            continue
+                    else:
+                        self.errors.pop(name, None)
+                    self._modules[plugin.digest] = plugin
+                modules[name] = plugin
+
+            analyses = {}
+            for plugin in modules.values():
+                for key in plugin.analysis_keys:
+                    analyses[key] = plugin
+            previous = self._current.modules
+            self._current = PluginSet(modules, analyses)
+            # versions no running job can pin again are dropped
+            self._modules = {plugin.digest: plugin
+                             for plugin in modules.values()}
+        return sorted(name for name, plugin in modules.items()
+                      if name not in previous
+                      or previous[name].digest != plugin.digest)
+
+    def _digest(self, path):
+        # a file is only hashed again when its size or mtime changed
+        stat = os.stat(path)
+        identity = (stat.st_size, stat.st_mtime_ns)
+        cached = self._digests.get(path)
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+        with open(path, 'rb') as src:
+            digest = hashlib.sha256(src.read()).hexdigest()
+        self._digests[path] = (identity, digest)
+        return digest
+
+    @staticmethod
+    def _load(name, path, digest):
+        # a unique module name per version, so tracebacks tell versions
+        # apart
+        spec = importlib.util.spec_from_file_location(
+            "adatos_plugin_{}_{}".format(name, digest[:12]), path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return Plugin(name, path, digest, module,
+                      tuple(getattr(module, 'ANALYSIS_KEYS', ())),
+                      time.time())
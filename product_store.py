@@ -0,0 +1,294 @@
+"""
+Description     : Local store of Sentinel 2 SAFE products keyed by product
+                  id, so a product is only fetched once across jobs.
+                  Downloads run concurrently on a bounded pool, resume
+                  partial files and are moved into place atomically; the
+                  least recently used products are evicted once the store
+                  outgrows its size budget. The processes sharing a store
+                  coordinate through file locks: one download per
+                  product, one index and no eviction of a product pinned
+                  by any of them
+Libraries       : concurrent, contextlib, json, os, requests, sentinelhub,
+                  shutil, threading, time
+"""
+
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+import json
+import os
+import shutil
+import threading
+import time
+
+from locks import atomic_write, file_lock
+# ---------------------
+
+
+# where the files of a product are fetched from
+class FetchBackend(object):
+    """
+    list_files(product_id)  ->  [(path relative to the SAFE folder, size
+                                 in bytes or None), ...]
+    fetch(product_id, path, dst, offset)
+                            ->  writes the bytes of the file from offset
+                                onwards to the open file dst
+    """
+
+    def list_files(self, product_id):
+        raise NotImplementedError
+
+    def fetch(self, product_id, path, dst, offset=0):
+        raise NotImplementedError
+
+
+# a folder of SAFE products standing in for AWS, e.g. for offline tests
+class LocalBackend(FetchBackend):
+    """
+    root            ->      folder holding <product_id>.SAFE folders
+    """
+
+    def __init__(self, root, chunk_size=1024 ** 2):
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def _product(self, product_id):
+        return os.path.join(self.root, "{}.SAFE".format(product_id))
+
+    def list_files(self, product_id):
+        product = self._product(product_id)
+        if not os.path.isdir(product):
+            raise KeyError("no product {} in {}".format(product_id,
+                                                        self.root))
+        files = []
+        for root, dirs, afiles in os.walk(product):
+            for afile in afiles:
+                path = os.path.join(root, afile)
+                files.append((os.path.relpath(path, product),
+                              os.path.getsize(path)))
+        return files
+
+    def fetch(self, product_id, path, dst, offset=0):
+        with open(os.path.join(self._product(product_id), path), "rb") as src:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst, self.chunk_size)
+
+
+# the Sentinel 2 products on AWS, listed by sentinelhub
+class AwsBackend(FetchBackend):
+    """
+    Files are downloaded with HTTP range requests so partial files resume
+    where they stopped
+    """
+
+    def __init__(self, chunk_size=1024 ** 2, timeout=60):
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._urls = {}
+
+    def list_files(self, product_id):
+        from sentinelhub import AwsProductRequest
+        request = AwsProductRequest(product_id=product_id, data_folder='',
+                                    safe_format=True)
+        files = []
+        for url, filename in zip(request.get_url_list(),
+                                 request.get_filename_list()):
+            # names start with the SAFE folder of the product
+            parts = filename.replace('\\', '/').split('/')
+            if parts[0].endswith('.SAFE'):
+                parts = parts[1:]
+            path = os.path.join(*parts)
+            self._urls[(product_id, path)] = url
+            files.append((path, None))
+        return files
+
+    def fetch(self, product_id, path, dst, offset=0):
+        import requests
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        url = self._urls[(product_id, path)]
+        with requests.get(url, headers=headers, stream=True,
+                          timeout=self.timeout) as reply:
+            if reply.status_code == 416:
+                # the partial file is already complete
+                return
+            reply.raise_for_status()
+            if offset and reply.status_code != 206:
+                # no range support, start the file again
+                dst.seek(0)
+                dst.truncate()
+            for chunk in reply.iter_content(self.chunk_size):
+                dst.write(chunk)
+
+
+# local store of SAFE products
+class ProductStore(object):
+    """
+    root            ->      folder of the store, products are kept as
+                            root/<product_id>.SAFE
+    backend         ->      the FetchBackend products are fetched from
+    max_bytes       ->      size budget, least recently used products are
+                            evicted beyond it
+    workers         ->      number of files downloaded at the same time
+    """
+    index_name = "index.json"
+
+    def __init__(self, root, backend, max_bytes=200 * 1024 ** 3, workers=4):
+        self.root = root
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(os.path.join(root, ".incoming"), exist_ok=True)
+        self._index = self._read_index()
+
+    def path(self, product_id):
+        return os.path.join(self.root, "{}.SAFE".format(product_id))
+
+    def _lock_path(self, name):
+        return os.path.join(self.root, ".locks", name)
+
+    def __contains__(self, product_id):
+        return product_id in self._read_index()
+
+    def size(self):
+        return sum(entry['bytes'] for entry in self._read_index().values())
+
+    def _read_index(self):
+        # the index is replaced atomically, so it is read without a lock
+        index_file = os.path.join(self.root, self.index_name)
+        if not os.path.exists(index_file):
+            return {}
+        with open(index_file) as src:
+            return json.load(src)
+
+    @contextmanager
+    def _indexed(self):
+        # the index as the other processes left it, saved on the way out
+        with self._lock, file_lock(self._lock_path(self.index_name)):
+            self._index = self._read_index()
+            yield self._index
+            self._save_index()
+
+    def get(self, product_id):
+        """
+        Returns the SAFE folder of the product, fetching it when it is not
+        in the store. Concurrent calls for one product share one download
+        """
+        with self._indexed() as index:
+            if product_id in index:
+                index[product_id]['last_used'] = time.time()
+                return self.path(product_id)
+            event = self._inflight.get(product_id)
+            owner = event is None
+            if owner:
+                event = self._inflight[product_id] = threading.Event()
+
+        if not owner:
+            event.wait()
+            if product_id not in self:
+                raise RuntimeError("download of {} failed".format(product_id))
+            return self.path(product_id)
+
+        try:
+            # one process downloads a product, the others wait for it
+            with file_lock(self._lock_path(product_id + ".fetch")):
+                if product_id not in self:
+                    size = self._download(product_id)
+                    with self._indexed() as index:
+                        index[product_id] = {'bytes': size,
+                                             'fetched': time.time(),
+                                             'last_used': time.time()}
+                        self._evict(keep=product_id)
+        finally:
+            with self._lock:
+                del self._inflight[product_id]
+            event.set()
+        return self.path(product_id)
+
+    def prefetch(self, product_ids):
+        """
+        Fetches several products at the same time, returns their folders.
+        The products are pinned until every one is fetched, so they do not
+        evict each other
+        """
+        product_ids = list(product_ids)
+        if not product_ids:
+            return []
+        with self.pinned(product_ids):
+            with ThreadPoolExecutor(max_workers=len(product_ids)) as pool:
+                return list(pool.map(self.get, product_ids))
+
+    @contextmanager
+    def pinned(self, product_ids):
+        """
+        Keeps products from being evicted while in use, e.g. every product
+        of a job from its download to its last stage
+        """
+        product_ids = list(product_ids)
+        # a shared lock per pin, eviction needs the lock exclusively
+        with ExitStack() as pins:
+            for product_id in product_ids:
+                pins.enter_context(file_lock(
+                    self._lock_path(product_id + ".pin"), shared=True))
+            yield product_ids
+
+    @contextmanager
+    def checkout(self, product_id):
+        """
+        Fetches a product and keeps it from being evicted while in use
+        """
+        with self.pinned([product_id]):
+            yield self.get(product_id)
+
+    def _download(self, product_id):
+        # files are completed next to the store and the product folder is
+        # only moved into place once every file is there
+        staging = os.path.join(self.root, ".incoming",
+                               "{}.SAFE".format(product_id))
+        files = self.backend.list_files(product_id)
+        futures = [self._pool.submit(self._download_file, product_id,
+                                     staging, path, size)
+                   for path, size in files]
+        total = sum(future.result() for future in futures)
+        final = self.path(product_id)
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.replace(staging, final)
+        return total
+
+    def _download_file(self, product_id, staging, path, size):
+        dst_file = os.path.join(staging, path)
+        if os.path.exists(dst_file):
+            return os.path.getsize(dst_file)
+        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+        part = dst_file + ".part"
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if size is None or offset < size:
+            with open(part, "ab") as dst:
+                self.backend.fetch(product_id, path, dst, offset)
+        os.replace(part, dst_file)
+        return os.path.getsize(dst_file)
+
+    def _evict(self, keep=None):
+        total = sum(entry['bytes'] for entry in self._index.values())
+        by_age = sorted(self._index.items(),
+                        key=lambda item: item[1]['last_used'])
+        for product_id, entry in by_age:
+            if total <= self.max_bytes:
+                break
+            if product_id == keep:
+                continue
+            with file_lock(self._lock_path(product_id + ".pin"),
+                           blocking=False) as unpinned:
+                if not unpinned:
+                    continue
+                shutil.rmtree(self.path(product_id), ignore_errors=True)
+            del self._index[product_id]
+            total -= entry['bytes']
+
+    def _save_index(self):
+        index_file = os.path.join(self.root, self.index_name)
+        with atomic_write(index_file) as dst:
+            json.dump(self._index, dst)
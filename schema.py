@@ -0,0 +1,106 @@
+"""
+Description     : Validation of JSON request bodies against a schema. A
+                  schema is compiled once into nested checking functions so
+                  validating a request does not walk the schema again
+Libraries       : re
+"""
+
+
+import re
+# ---------------------
+
+
+TYPES = {'object': dict, 'array': list, 'string': str, 'integer': int,
+         'number': (int, float), 'boolean': bool}
+TYPE_NAMES = {'object': 'a json object', 'array': 'a list',
+              'string': 'a str', 'integer': 'an int', 'number': 'a number',
+              'boolean': 'a bool'}
+
+
+# compile a schema into a validator
+def compile_schema(schema):
+    """
+    schema          ->      the subset of JSON schema used by the tasking
+                            requests: type, properties, required, items,
+                            minItems, enum and pattern
+
+    Returns function(value) returning the list of problems found
+    """
+    check = _compile(schema)
+
+    def validate(value):
+        errors = []
+        check(value, 'request body', errors)
+        return errors
+    return validate
+
+
+def _compile(schema):
+    checks = []
+    kind = schema.get('type')
+    if kind is not None:
+        python_type = TYPES[kind]
+        message = '{{}} must be {}'.format(TYPE_NAMES[kind])
+        # bool is an int in python but not in json
+        strict = kind in ('integer', 'number')
+
+        def check_type(value, where, errors):
+            if (not isinstance(value, python_type)
+                    or strict and isinstance(value, bool)):
+                errors.append(message.format(where))
+                return False
+            return True
+    else:
+        def check_type(value, where, errors):
+            return True
+
+    if 'enum' in schema:
+        allowed = frozenset(schema['enum'])
+
+        def check_enum(value, where, errors):
+            if value not in allowed:
+                errors.append('{} must be one of {}'.format(
+                    where, sorted(allowed)))
+        checks.append(check_enum)
+
+    if 'pattern' in schema:
+        pattern = re.compile(schema['pattern'])
+
+        def check_pattern(value, where, errors):
+            if not pattern.match(value):
+                errors.append('{} does not match {}'.format(
+                    where, pattern.pattern))
+        checks.append(check_pattern)
+
+    if 'properties' in schema or 'required' in schema:
+        properties = [(name, _compile(sub)) for name, sub
+                      in schema.get('properties', {}).items()]
+        required = tuple(schema.get('required', ()))
+
+        def check_object(value, where, errors):
+            prefix = '' if where == 'request body' else where + '.'
+            for name in required:
+                if name not in value:
+                    errors.append('{}{} is required'.format(prefix, name))
+            for name, check in properties:
+                if name in value:
+                    check(value[name], prefix + name, errors)
+        checks.append(check_object)
+
+    if 'items' in schema or 'minItems' in schema:
+        item_check = _compile(schema.get('items', {}))
+        min_items = schema.get('minItems', 0)
+
+        def check_array(value, where, errors):
+            if len(value) < min_items:
+                errors.append('{} must hold at least {} item(s)'.format(
+                    where, min_items))
+            for i, item in enumerate(value):
+                item_check(item, '{}[{}]'.format(where, i), errors)
+        checks.append(check_array)
+
+    def check(value, where, errors):
+        if check_type(value, where, errors):
+            for sub_check in checks:
+                sub_check(value, where, errors)
+    return check
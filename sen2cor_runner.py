@@ -0,0 +1,211 @@
+"""
+Description     : Runs sen2cor (L1C to L2A) on downloaded Sentinel 2
+                  products. The number of runs at the same time is capped
+                  by the available memory, outputs are cached by product id
+                  and processor version and jobs asking for a product being
+                  processed share its run. Processes sharing the cache
+                  (e.g. gunicorn workers) share the runs and their slots
+                  through file locks
+Libraries       : collections, concurrent, contextlib, glob, os, re, shutil,
+                  subprocess, threading, time
+"""
+
+
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+import glob
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+from locks import file_lock
+# ---------------------
+
+
+# timing of a request for the L2A output of a product
+RunTiming = namedtuple('RunTiming', [
+    'product_id', 'version', 'waited', 'seconds', 'cached'])
+
+
+# memory available to new processes in bytes, None when unknown
+def available_memory():
+    try:
+        with open('/proc/meminfo') as src:
+            for line in src:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# sen2cor execution stage
+class Sen2CorRunner(object):
+    """
+    cache_root      ->      folder of the L2A outputs, kept as
+                            cache_root/<version>/<product_id>/<L2A>.SAFE
+    executable      ->      the sen2cor command, a path or a list of
+                            arguments, e.g. a stub script writing a SAFE
+                            folder into --output_dir for offline tests
+    version         ->      the processor version, read from
+                            `executable --help` when None
+    mem_per_run     ->      peak memory of one run in bytes
+    max_runs        ->      upper bound of runs at the same time, one per
+                            core when None; the slots are shared by every
+                            process using cache_root
+    resolution      ->      resolution passed to sen2cor, None for all
+    postprocess     ->      function(l2a_folder) run once on every new
+                            output before it is cached, e.g.
+                            raster_resampling
+    """
+
+    def __init__(self, cache_root, executable='L2A_Process', version=None,
+                 mem_per_run=4 * 1024 ** 3, max_runs=None, resolution=None,
+                 postprocess=None):
+        self.cache_root = cache_root
+        self.command = ([executable] if isinstance(executable, str)
+                        else list(executable))
+        self._version = version
+        self.resolution = resolution
+        self.postprocess = postprocess
+        self.slots = self._slots(mem_per_run, max_runs)
+        self.timings = deque(maxlen=256)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        os.makedirs(os.path.join(cache_root, ".incoming"), exist_ok=True)
+
+    @staticmethod
+    def _slots(mem_per_run, max_runs):
+        max_runs = max_runs or os.cpu_count() or 1
+        memory = available_memory()
+        if memory is None:
+            return max_runs
+        return max(1, min(max_runs, memory // mem_per_run))
+
+    @property
+    def version(self):
+        if self._version is None:
+            try:
+                reply = subprocess.run(self.command + ['--help'],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       universal_newlines=True, timeout=60)
+                match = re.search(r'\d+\.\d+(?:\.\d+)?', reply.stdout)
+            except (OSError, subprocess.TimeoutExpired):
+                match = None
+            self._version = match.group(0) if match else 'unknown'
+        return self._version
+
+    def output(self, product_id):
+        """
+        Returns the cached L2A folder of a product, None when it has not
+        been processed with this version
+        """
+        outputs = glob.glob(os.path.join(self.cache_root, self.version,
+                                         product_id, '*.SAFE'))
+        return outputs[0] if outputs else None
+
+    def run(self, l1c_folder, product_id=None):
+        """
+        Returns the L2A folder of the product in l1c_folder, running sen2cor
+        only when it is neither cached nor being processed
+        """
+        if product_id is None:
+            product_id = os.path.basename(os.path.normpath(l1c_folder))
+            if product_id.endswith('.SAFE'):
+                product_id = product_id[:-5]
+        requested = time.time()
+        key = (product_id, self.version)
+        with self._lock:
+            l2a_folder = self.output(product_id)
+            if l2a_folder is not None:
+                self.timings.append(RunTiming(product_id, self.version,
+                                              0., 0., True))
+                return l2a_folder
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+
+        if not owner:
+            l2a_folder = future.result()
+            self.timings.append(RunTiming(product_id, self.version,
+                                          time.time() - requested, 0., True))
+            return l2a_folder
+
+        try:
+            # another process may be running, or have run, the product
+            with file_lock(self._lock_path("{}_{}".format(product_id,
+                                                          self.version))):
+                l2a_folder = self.output(product_id)
+                if l2a_folder is not None:
+                    self.timings.append(RunTiming(
+                        product_id, self.version, time.time() - requested,
+                        0., True))
+                else:
+                    with self._slot():
+                        started = time.time()
+                        l2a_folder = self._process(l1c_folder, product_id)
+                    self.timings.append(RunTiming(
+                        product_id, self.version, started - requested,
+                        time.time() - started, False))
+            future.set_result(l2a_folder)
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        return l2a_folder
+
+    def _lock_path(self, name):
+        return os.path.join(self.cache_root, ".locks", name)
+
+    @contextmanager
+    def _slot(self):
+        # a run holds one of the slot lock files until it ends
+        while True:
+            for slot in range(self.slots):
+                with file_lock(self._lock_path("slot_{}".format(slot)),
+                               blocking=False) as locked:
+                    if locked:
+                        yield slot
+                        return
+            time.sleep(0.5)
+
+    def _process(self, l1c_folder, product_id):
+        # sen2cor writes next to the cache and the output is only moved in
+        # once it is complete
+        staging = os.path.join(self.cache_root, ".incoming",
+                               "{}_{}".format(product_id, self.version))
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+
+        command = self.command + ['--output_dir', staging]
+        if self.resolution is not None:
+            command += ['--resolution', str(self.resolution)]
+        reply = subprocess.run(command + [l1c_folder],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+        outputs = glob.glob(os.path.join(staging, '*.SAFE'))
+        if reply.returncode != 0 or not outputs:
+            raise RuntimeError("sen2cor failed on {} ({}): {}".format(
+                product_id, reply.returncode, reply.stdout[-2000:]))
+        if self.postprocess is not None:
+            self.postprocess(outputs[0])
+
+        final = os.path.join(self.cache_root, self.version, product_id)
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.replace(staging, final)
+        return os.path.join(final, os.path.basename(outputs[0]))
@@ -4,241 +4,1155 @@ Script Created  : 4 Sep 2018
 Author          : Hafiz Magnus
 Description     : Script for the Generation of the Agricultural Indices
                   from Sentinel 2 Data
-Libraries       : ast, fiona, gdal2tiles, geopandas, jenkspy, numpy, osgeo,
-                  os, pathlib, rasterio, shutil, skimage, subprocess, sys
+Libraries       : collections, concurrent, contextlib, fiona, functools,
+                  gdal2tiles,
+                  hashlib, importlib, jenkspy, json, numpy, osgeo, os,
+                  pathlib, rasterio, re, shutil, tempfile, threading,
+                  time, warnings, xml, instrumentation
 """
 
 
 # importing the necessary modules
 from __future__ import absolute_import
-import ast
-import fiona
-import gdal2tiles
-import jenkspy
-import geopandas
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+import hashlib
+import importlib
+import json
 import numpy as np
 import os
-from osgeo import gdal, gdal_array, gdalconst, gdalnumeric, ogr, osr
 from pathlib import Path
-import rasterio
-import rasterio.features
-from rasterio.mask import mask
-import rasterio.warp
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+import re
 import shutil
-import skimage
-import subprocess
-import sys
+import tempfile
+import threading
+import time
+import warnings
+from xml.etree import ElementTree
+from instrumentation import instrumented
+from locks import atomic_write, temp_path
+
+
+# seconds spent importing each lazily loaded module
+IMPORT_TIMES = OrderedDict()
+
+
+# stand-in for a heavy module, imported on first attribute access
+class _LazyModule(object):
+    """
+    name            ->      the module to import
+    submodules      ->      submodules imported with it, so that e.g.
+                            rasterio.features resolves on the proxy
+    """
+
+    def __init__(self, name, submodules=()):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                start = time.perf_counter()
+                module = importlib.import_module(self._name)
+                for submodule in self._submodules:
+                    importlib.import_module(
+                        "{}.{}".format(self._name, submodule))
+                IMPORT_TIMES[self._name] = time.perf_counter() - start
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._module or self._load(), attribute)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return "<lazy module '{}' ({})>".format(self._name, state)
+
+
+# the geo libraries only load when a stage needs them
+fiona = _LazyModule('fiona')
+gdal = _LazyModule('osgeo.gdal')
+gdal2tiles = _LazyModule('gdal2tiles')
+gdalconst = _LazyModule('osgeo.gdalconst')
+jenkspy = _LazyModule('jenkspy')
+rasterio = _LazyModule('rasterio', ('crs', 'enums', 'errors', 'features',
+                                    'io', 'mask', 'shutil', 'transform',
+                                    'vrt', 'warp', 'windows'))
 # ---------------------
 
 
+# band images of a sen2corr product, e.g. T48NUH_20180903T031541_B04_10m.jp2
+PRODUCT_BAND = re.compile(r'^(?P<product>(?:L2A_)?T(?P<tile>\d{2}[A-Z]{3})_'
+                          r'(?P<sensing>\d{8}T\d{6}))_'
+                          r'(?P<band>B(?:\d{2}|8A))_(?P<resolution>\d{2})m'
+                          r'\.jp2$')
+
+# the bands used by the indices, at their native resolution
+CONSOLIDATED_BANDS = (('B02', 10), ('B03', 10), ('B04', 10), ('B05', 20),
+                      ('B06', 20), ('B07', 20), ('B08', 10), ('B8A', 20),
+                      ('B11', 20), ('B12', 20))
+
+# Sentinel 2 band and native resolution of the band names used by the
+# index formulas
+INDEX_BANDS = {'blue': ('B02', 10),
+               'green': ('B03', 10),
+               'red': ('B04', 10),
+               're5': ('B05', 20),
+               're6': ('B06', 20),
+               'nir': ('B08', 10),
+               'swir11': ('B11', 20)}
+
+# side in pixels of a Sentinel 2 tile at every resolution
+S2_GRID_SIZE = {10: 10980, 20: 5490, 60: 1830}
+
+
+# catalog of the bands of a sen2corr product
+class ProductCatalog(object):
+    """
+    Band, resolution, path and grid of every band image of a product,
+    built once from the file names listed in the manifest (or a single
+    walk of the folder) and persisted in catalog.json next to the product
+    so later stages and reruns look bands up without reopening files.
+    product_folder  ->      the output folder of the sen2corr algorithm
+    bands           ->      dictionary of "band_resolution" to the band
+                            entry: band, resolution, path relative to the
+                            product folder and grid (resolution, size)
+    """
+    file_name = "catalog.json"
+
+    def __init__(self, product_folder, bands, product=None, tile=None,
+                 sensing=None):
+        self.product_folder = product_folder
+        self.bands = bands
+        self.product = product
+        self.tile = tile
+        self.sensing = sensing
+
+    @staticmethod
+    def _key(band, resolution):
+        return "{}_{}".format(band, int(resolution))
+
+    @classmethod
+    def build(cls, product_folder):
+        names = cls._manifest_files(product_folder)
+        if not names:
+            names = []
+            for root, dirs, files in os.walk(product_folder):
+                names.extend(os.path.relpath(os.path.join(root, afile),
+                                             product_folder)
+                             for afile in files)
+
+        catalog = cls(product_folder, OrderedDict())
+        for name in names:
+            match = PRODUCT_BAND.match(os.path.basename(name))
+            if match is None:
+                continue
+            resolution = int(match.group('resolution'))
+            catalog.product = match.group('product')
+            catalog.tile = match.group('tile')
+            catalog.sensing = match.group('sensing')
+            catalog.bands[cls._key(match.group('band'), resolution)] = {
+                'band': match.group('band'),
+                'resolution': resolution,
+                'path': os.path.normpath(name),
+                'grid': {'resolution': resolution,
+                         'size': S2_GRID_SIZE.get(resolution)}}
+        return catalog
+
+    @staticmethod
+    def _manifest_files(product_folder):
+        manifest = os.path.join(product_folder, "manifest.safe")
+        if not os.path.exists(manifest):
+            return []
+        names = []
+        for element in ElementTree.parse(manifest).iter():
+            if element.tag.endswith('fileLocation'):
+                href = element.get('href', '')
+                if href.endswith('.jp2') and os.path.exists(
+                        os.path.join(product_folder, href)):
+                    names.append(href)
+        return names
+
+    @classmethod
+    def load(cls, product_folder):
+        """
+        Returns the persisted catalog of the product, building and saving
+        it on the first call
+        """
+        path = os.path.join(product_folder, cls.file_name)
+        if os.path.exists(path):
+            with open(path) as src:
+                saved = json.load(src)
+            return cls(product_folder, OrderedDict(saved['bands']),
+                       saved.get('product'), saved.get('tile'),
+                       saved.get('sensing'))
+        catalog = cls.build(product_folder)
+        catalog.save()
+        return catalog
+
+    def save(self):
+        path = os.path.join(self.product_folder, self.file_name)
+        with atomic_write(path) as dst:
+            json.dump({'product': self.product,
+                       'tile': self.tile,
+                       'sensing': self.sensing,
+                       'bands': self.bands}, dst, indent=1)
+
+    def entry(self, band, resolution):
+        return self.bands.get(self._key(band, resolution))
+
+    def path(self, band, resolution):
+        """
+        Returns the absolute path of a band, None when it is not in the
+        product
+        """
+        band_entry = self.entry(band, resolution)
+        if band_entry is None:
+            return None
+        return os.path.join(self.product_folder, band_entry['path'])
+
+    def relocate(self, band, resolution, new_path):
+        self.entry(band, resolution)['path'] = os.path.relpath(
+            new_path, self.product_folder)
+
+    def regrid(self, band, resolution, grid):
+        self.entry(band, resolution)['grid'] = dict(grid)
+
+    def selected(self, bands=CONSOLIDATED_BANDS):
+        return [self.entry(band, resolution) for band, resolution in bands
+                if self.entry(band, resolution) is not None]
+
+
 # consolidating the sen2corr outputs into a single folder
+@instrumented()
 def raster_consolidate(raster_folder):
     """
     Helper function that consolidates the key outputs from the sen2corr
     algorithm into a single folder
     raster_folder       ->      The output folder from the sen2corr algorithm
     """
-    bands = ['_B02_10m.jp2',
-             '_B03_10m.jp2',
-             '_B04_10m.jp2',
-             '_B05_20m.jp2',
-             '_B06_20m.jp2',
-             '_B07_20m.jp2',
-             '_B08_10m.jp2',
-             '_B8A_20m.jp2',
-             '_B11_20m.jp2',
-             '_B12_20m.jp2']
+    catalog = ProductCatalog.load(raster_folder)
 
     img_folder = os.path.join(raster_folder, "CONSOLIDATED")
-    os.mkdir(img_folder)
-
-    for root, dirs, files in os.walk(raster_folder):
-        for afile in files:
-            for band in bands:
-                if afile.endswith(band):
-                    ori = os.path.join(root, afile)
-                    mvd = os.path.join(img_folder, afile)
-                    os.rename(ori, mvd)
+    if not os.path.exists(img_folder):
+        os.mkdir(img_folder)
+
+    for band_entry in catalog.selected():
+        ori = os.path.join(raster_folder, band_entry['path'])
+        mvd = os.path.join(img_folder, os.path.basename(ori))
+        if ori != mvd:
+            os.rename(ori, mvd)
+            catalog.relocate(band_entry['band'], band_entry['resolution'],
+                             mvd)
+    catalog.save()
 
     return img_folder
 
 
 # get the list of rasters which needs to be resampled up
-def raster_sorter(raster_folder):
+def raster_sorter(raster_folder, catalog=None):
     """
     Helper function for raster resampling
     raster_folder       ->      A folder where the raw sentinel 2
                                 images are located
-    """
-    for aroot, adirs, afiles in os.walk(raster_folder):
-        fine_resolution = 1000.0
-        best_rasters = []
-        course_rasters = []
-        raster_dict = {}
-        sm_file = sys.maxsize
-
-        for afile in afiles:
-            raster = os.path.join(aroot, afile)
-            sz = os.path.getsize(raster)
-            src = rasterio.open(raster)
-            resolution = float(src.res[0])
-            raster_dict[raster] = (resolution, sz)
-            if fine_resolution > resolution:
-                fine_resolution = resolution
-            src = None
-
-        for key, values in raster_dict.items():
-            if fine_resolution == values[0]:
-                if sm_file > values[1]:
-                    sm_file = values[1]
-
-        for ikey, ivalues in raster_dict.items():
-            if fine_resolution == ivalues[0]:
-                if sm_file == ivalues[1]:
-                    best_rasters.append(ikey)
-            else:
-                course_rasters.append(ikey)
+    catalog             ->      the ProductCatalog of the bands, built from
+                                the file names in raster_folder when None
 
-        return course_rasters, best_rasters[0]
+    Returns the rasters not on the finest grid and the reference raster
+    """
+    if catalog is None:
+        catalog = ProductCatalog.build(raster_folder)
+    selected = catalog.selected()
+    fine_resolution = min(band_entry['grid']['resolution']
+                          for band_entry in selected)
+
+    course_rasters = []
+    best_raster = None
+    for band_entry in selected:
+        raster = os.path.join(catalog.product_folder, band_entry['path'])
+        if band_entry['grid']['resolution'] != fine_resolution:
+            course_rasters.append(raster)
+        elif best_raster is None:
+            best_raster = raster
+    return course_rasters, best_raster
+
+
+# warp a coarse raster onto the reference grid, replacing it atomically
+def _resample_raster(raster, grid, resampling):
+    """
+    raster          ->      the raster to be resampled
+    grid            ->      (projection, geotransform, width, height) of
+                            the reference raster
+    resampling      ->      the gdal resampling method
+    """
+    match_proj, match_geotrans, wide, high = grid
+    x_min = match_geotrans[0]
+    y_max = match_geotrans[3]
+    x_max = x_min + wide * match_geotrans[1]
+    y_min = y_max + high * match_geotrans[5]
+
+    # the result is written once, next to the original, then swapped in
+    r_folder, r_name = os.path.split(raster)
+    dst_filename = os.path.join(r_folder, ".{}.resampled".format(r_name))
+    dst = gdal.Warp(dst_filename,
+                    raster,
+                    format='GTiff',
+                    outputBounds=(x_min, y_min, x_max, y_max),
+                    width=wide,
+                    height=high,
+                    dstSRS=match_proj,
+                    resampleAlg=resampling,
+                    outputType=gdalconst.GDT_UInt16)
+    if dst is None:
+        raise RuntimeError("could not resample {}".format(raster))
+    dst = None
+    os.replace(dst_filename, raster)
+    return raster
 
 
 # resampling rasters
-def raster_resampling(raster_folder):
+@instrumented()
+def raster_resampling(raster_folder, resampling='lanczos', workers=None):
     """
     Increasing the resolution of low resolution rasters.
     This function will replace the low resolution rasters
     in the original folder.
+    resampling      ->      the gdal resampling method, lanczos by default
+    workers         ->      number of rasters warped concurrently, None for
+                            one per core
     """
     img_folder = raster_consolidate(raster_folder)
-    inputs = raster_sorter(img_folder)
+    catalog = ProductCatalog.load(raster_folder)
+    inputs = raster_sorter(img_folder, catalog)
     raster_list = inputs[0]
     match_filename = inputs[1]
 
     if len(raster_list) > 0:
-        for raster in raster_list:
-            r_name = os.path.basename(raster)
-            dst_filename = str(Path.cwd() / "temp" / r_name)
-
-            # source
-            src = gdal.Open(raster, gdalconst.GA_ReadOnly)
-            src_proj = src.GetProjection()
-            src_geotrans = src.GetGeoTransform()
-
-            # to match
-            match_ds = gdal.Open(match_filename, gdalconst.GA_ReadOnly)
-            match_proj = match_ds.GetProjection()
-            match_geotrans = match_ds.GetGeoTransform()
-            wide = match_ds.RasterXSize
-            high = match_ds.RasterYSize
-
-            # destination
-            dst = gdal.GetDriverByName('GTiff').Create(
-                dst_filename, wide, high, 1, gdalconst.GDT_UInt16)
-            dst.SetGeoTransform(match_geotrans)
-            dst.SetProjection(match_proj)
-
-            # resample the raster
-            gdal.ReprojectImage(
-                src,
-                dst,
-                src_proj,
-                match_proj,
-                gdalconst.GRA_Lanczos)
-
-            # closing opened files
-            src = None
-            dst = None
-            match_ds = None
-
-            # replace original file with resampled
-            os.remove(raster)
-            shutil.copy2(dst_filename, raster)
-            os.remove(dst_filename)
+        # the reference grid is only read once
+        match_ds = gdal.Open(match_filename, gdalconst.GA_ReadOnly)
+        grid = (match_ds.GetProjection(),
+                match_ds.GetGeoTransform(),
+                match_ds.RasterXSize,
+                match_ds.RasterYSize)
+        match_ds = None
+
+        workers = min(workers or os.cpu_count() or 1, len(raster_list))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda raster: _resample_raster(
+                raster, grid, resampling), raster_list))
+
+        # record the new grid so reruns do not resample again
+        match_entry = [band_entry for band_entry in catalog.selected()
+                       if catalog.path(band_entry['band'],
+                                       band_entry['resolution'])
+                       == match_filename][0]
+        for band_entry in catalog.selected():
+            if catalog.path(band_entry['band'],
+                            band_entry['resolution']) in raster_list:
+                catalog.regrid(band_entry['band'], band_entry['resolution'],
+                               match_entry['grid'])
+        catalog.save()
     return
 
 
+# identity of an estate AOI file, changes whenever the file is rewritten
+def aoi_identity(aoi):
+    a_path = os.path.abspath(aoi)
+    a_stat = os.stat(a_path)
+    return a_path, a_stat.st_mtime, a_stat.st_size
+
+
+# estate boundaries, their reprojections and rasterised masks
+class AoiService(object):
+    """
+    Loads an estate boundary once, reprojects it once per target CRS and
+    keeps the rasterised mask of every grid it is clipped on, so repeated
+    clips on the same grid are a cheap array operation. Reprojections and
+    masks are evicted in least recently used order.
+    max_geometries  ->      number of reprojected boundaries kept
+    max_mask_bytes  ->      memory budget of the rasterised masks
+    """
+
+    def __init__(self, max_geometries=32, max_mask_bytes=512 * 1024 ** 2):
+        self.max_geometries = max_geometries
+        self.max_mask_bytes = max_mask_bytes
+        self.mask_bytes = 0
+        self._geometries = OrderedDict()
+        self._masks = OrderedDict()
+        self._lock = threading.RLock()
+
+    def geometries(self, aoi, crs):
+        """
+        Returns the geometries of the estate AOI in the crs
+        """
+        crs = rasterio.crs.CRS.from_user_input(crs)
+        aoi_id = aoi_identity(aoi)
+        key = (aoi_id, crs.to_string())
+        with self._lock:
+            geo_features = self._geometries.get(key)
+            if geo_features is not None:
+                self._geometries.move_to_end(key)
+                return geo_features
+
+        v_crs, geo_features = self._boundary(aoi, aoi_id)
+        if v_crs != crs:
+            geo_features = rasterio.warp.transform_geom(v_crs, crs,
+                                                        geo_features)
+
+        with self._lock:
+            self._geometries[key] = geo_features
+            while len(self._geometries) > self.max_geometries:
+                self._geometries.popitem(last=False)
+        return geo_features
+
+    def _boundary(self, aoi, aoi_id):
+        key = (aoi_id, None)
+        with self._lock:
+            boundary = self._geometries.get(key)
+        if boundary is None:
+            with fiona.open(aoi, 'r') as cutter:
+                v_crs = rasterio.crs.CRS.from_user_input(cutter.crs)
+                boundary = (v_crs, [feature["geometry"]
+                                    for feature in cutter])
+            with self._lock:
+                self._geometries[key] = boundary
+        return boundary
+
+    def mask(self, aoi, src):
+        """
+        aoi             ->      the estate AOI
+        src             ->      an open rasterio dataset
+
+        Returns the window of the dataset covering the AOI and the read
+        only mask of that window, True outside the AOI, as used by
+        rasterio.mask.mask with crop=True and all_touched=True
+        """
+        key = (aoi_identity(aoi), src.crs.to_string(), tuple(src.transform),
+               src.shape)
+        with self._lock:
+            entry = self._masks.get(key)
+            if entry is not None:
+                self._masks.move_to_end(key)
+                return entry
+
+        geo_features = self.geometries(aoi, src.crs)
+        window = rasterio.features.geometry_window(src, geo_features)
+        outside = rasterio.features.geometry_mask(
+            geo_features,
+            out_shape=(int(window.height), int(window.width)),
+            transform=src.window_transform(window),
+            all_touched=True)
+        outside.flags.writeable = False
+        entry = (window, outside)
+
+        with self._lock:
+            if key not in self._masks and outside.nbytes <= \
+                    self.max_mask_bytes:
+                while self._masks and (self.mask_bytes + outside.nbytes
+                                       > self.max_mask_bytes):
+                    old = self._masks.popitem(last=False)[1]
+                    self.mask_bytes -= old[1].nbytes
+                self._masks[key] = entry
+                self.mask_bytes += outside.nbytes
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._geometries.clear()
+            self._masks.clear()
+            self.mask_bytes = 0
+
+
+AOI_SERVICE = AoiService()
+
+
 # reproject vector file
 def reproj_vector(in_crs, out_crs, vector):
     """
     Function to reproject the vector
-    in_crs      ->      the in CRS
-    out_crs     ->      the CRS to projet to
+    in_crs      ->      the in CRS, taken from the vector file
+    out_crs     ->      the CRS to projet to, e.g. an EPSG code
     vector      ->      the vector file
+
+    Returns a GeoJSON like feature collection
     """
-    in_vector = geopandas.read_file(vector)
-    df = in_vector.to_crs({'init': u'epsg:{}'.format(out_crs)})
-    proj_df = ast.literal_eval(df.to_json())
-    return proj_df
+    if isinstance(out_crs, int):
+        out_crs = 'EPSG:{}'.format(out_crs)
+    return {'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'properties': {},
+                          'geometry': geometry}
+                         for geometry in AOI_SERVICE.geometries(vector,
+                                                                out_crs)]}
 
 
 # check if estate AOI and input rasters are in the same projection
 def proj_check(in_raster, aoi):
-    r_crs = int(rasterio.open(in_raster).crs['init'].split(":")[-1])
-    v_crs = int(fiona.open(aoi, 'r').meta['crs']['init'].split(":")[-1])
-    if r_crs != v_crs:
-        aoi_proj = reproj_vector(v_crs, r_crs, aoi)
-        geo_features = [feature["geometry"]
-                        for feature in aoi_proj['features']]
-    else:
-        cutter = fiona.open(aoi, 'r')
-        geo_features = [feature["geometry"] for feature in cutter]
-    return geo_features
+    """
+    Returns the geometries of the AOI in the projection of in_raster
+    """
+    with rasterio.open(in_raster) as src:
+        r_crs = src.crs
+    return AOI_SERVICE.geometries(aoi, r_crs)
 
 
-# clip inputs to estate AOI
-def raster_mask(raster, vector):
-    geo_features = proj_check(raster, vector)
+# per job cache of clipped bands
+class BandCache(object):
+    """
+    Holds the clipped band arrays of a job so that every index function
+    reads, reprojects and masks a band only once. Entries are evicted in
+    least recently used order once the memory budget is exceeded.
+    max_bytes       ->      memory budget for the cached arrays
+    """
+
+    def __init__(self, max_bytes=2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, raster, vector):
+        with rasterio.open(raster) as src:
+            r_crs = src.crs.to_string()
+        return os.path.abspath(raster), aoi_identity(vector), r_crs
+
+    def load(self, raster, vector):
+        """
+        Returns the clipped band, its transform and a copy of its meta,
+        reading the band from disk only on a cache miss
+        """
+        key = self.key(raster, vector)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            entry = _clip_band(raster, vector)
+            entry[0].flags.writeable = False
+            self._store(key, entry)
+        out_img, out_transform, out_meta = entry
+        return out_img, out_transform, out_meta.copy()
+
+    def _store(self, key, entry):
+        size = entry[0].nbytes
+        with self._lock:
+            self.misses += 1
+            if key in self._entries or size > self.max_bytes:
+                return
+            while self._entries and self.nbytes + size > self.max_bytes:
+                old = self._entries.popitem(last=False)[1]
+                self.nbytes -= old[0].nbytes
+            self._entries[key] = entry
+            self.nbytes += size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# read a band and clip it to the estate AOI
+def _clip_band(raster, vector):
     with rasterio.open(raster) as src:
-        out_img, out_transform = rasterio.mask.mask(src,
-                                                    geo_features, crop=True,
-                                                    all_touched=True)
-        out_img = (out_img.astype(float)) / 10000
+        window, outside = AOI_SERVICE.mask(vector, src)
+        out_img = src.read(window=window, out_dtype=np.float32)
+        out_img[:, outside] = src.nodata or 0
+        out_img /= 10000
+        out_transform = src.window_transform(window)
         out_meta = src.meta.copy()
         return out_img, out_transform, out_meta
 
 
+# clip inputs to estate AOI
+@instrumented()
+def raster_mask(raster, vector, cache=None):
+    """
+    raster          ->      the band to be clipped
+    vector          ->      the estate AOI
+    cache           ->      optional BandCache shared by the job, the
+                            returned array is read only when it is used
+    """
+    if cache is not None:
+        return cache.load(raster, vector)
+    return _clip_band(raster, vector)
+
+
+# ---------------------
+# job work folders and index images
+
+_WORK = threading.local()
+
+
+# folder of the temporary and raw images of the current job
+def work_dir():
+    folder = getattr(_WORK, 'folder', None)
+    return folder if folder is not None else str(Path.cwd() / "temp")
+
+
+# run a job with its own work folder, so concurrent jobs never share files
+@contextmanager
+def job_work_dir(folder):
+    """
+    folder          ->      the work folder of the job, created if missing;
+                            it applies to the calling thread only
+    """
+    os.makedirs(folder, exist_ok=True)
+    previous = getattr(_WORK, 'folder', None)
+    _WORK.folder = folder
+    try:
+        yield folder
+    finally:
+        _WORK.folder = previous
+
+
+# index images are written as Cloud Optimized GeoTIFFs
+# IMAGE_DTYPE       ->      float32, or int16 scaled by a power of ten
+# IMAGE_COMPRESS    ->      deflate, or zstd with GDAL >= 2.3
+# IMAGE_LEVEL       ->      compression level, the fastest by default: the
+#                           predictor does most of the work on index values
+# IMAGE_BLOCK       ->      side of the internal tiles
+# OVERVIEW_FACTORS  ->      decimation factors of the overviews, those
+#                           leaving less than a tile are skipped
+IMAGE_DTYPE = 'float32'
+IMAGE_COMPRESS = 'deflate'
+IMAGE_LEVEL = 1
+IMAGE_BLOCK = 512
+OVERVIEW_FACTORS = (2, 4, 8, 16, 32, 64)
+INT16_NODATA = -32768
+
+
+# largest power of ten keeping values up to limit within int16
+def int16_scale(limit):
+    limit = max(abs(float(limit)), 1e-6)
+    return 10.0 ** int(np.floor(np.log10(32767 / limit)))
+
+
+# staged creation options of an index image, _finish_cog compresses it
+def _staged(meta):
+    staged = meta.copy()
+    del staged['compress'], staged['predictor']
+    return staged
+
+
+# creation options of an index image
+def cog_meta(out_meta, height, width, dtype=None, compress=None):
+    dtype = dtype or IMAGE_DTYPE
+    meta = out_meta.copy()
+    meta.update({'driver': 'GTiff',
+                 'height': height,
+                 'width': width,
+                 'dtype': dtype,
+                 'tiled': True,
+                 'blockxsize': IMAGE_BLOCK,
+                 'blockysize': IMAGE_BLOCK,
+                 'compress': compress or IMAGE_COMPRESS,
+                 'predictor': 3 if dtype.startswith('float') else 2,
+                 'interleave': 'band',
+                 'BIGTIFF': 'IF_SAFER'})
+    if dtype == 'int16':
+        meta['nodata'] = INT16_NODATA
+    elif dtype == 'uint8':
+        # class rasters, differences of classes do not compress better
+        meta.update({'nodata': CLASS_NODATA, 'predictor': 1})
+    return meta
+
+
+# GDAL color table of a class palette
+def _colormap(palette):
+    return {c: tuple(int(v) for v in palette[c])
+            for c in range(N_CLASSES + 1)}
+
+
+# values of a window as written to an image of the given dtype
+def _encode(img, dtype, scale=None):
+    if dtype != 'int16':
+        return img.astype(dtype, copy=False)
+    encoded = np.full(img.shape, INT16_NODATA, dtype=np.int16)
+    finite = np.isfinite(img)
+    encoded[finite] = np.clip(np.rint(img[finite] * scale), -32767, 32767)
+    return encoded
+
+
+# move the overviews ahead of the data, the layout of a COG, compressing
+# the staged uncompressed image once. d_range, the unscaled (min, max) of
+# the values, is kept in the band tags for renderers reading a part only
+def _finish_cog(temp, f_image, meta, resampling='nearest', d_range=None):
+    with rasterio.open(temp, "r+") as dest:
+        if d_range is not None and not np.isnan(d_range[0]):
+            dest.update_tags(1, VALUE_MIN=repr(float(d_range[0])),
+                             VALUE_MAX=repr(float(d_range[1])))
+        size = min(dest.height, dest.width)
+        factors = [f for f in OVERVIEW_FACTORS
+                   if size // f >= IMAGE_BLOCK // 2]
+        if factors:
+            dest.build_overviews(factors,
+                                 getattr(rasterio.enums.Resampling,
+                                         resampling))
+    options = {key: meta[key] for key in ('tiled', 'blockxsize',
+                                          'blockysize', 'compress',
+                                          'predictor', 'interleave',
+                                          'BIGTIFF')}
+    level = 'zstd_level' if meta['compress'] == 'zstd' else 'zlevel'
+    options[level] = IMAGE_LEVEL
+    rasterio.shutil.copy(temp, f_image, driver='GTiff',
+                         copy_src_overviews=True, num_threads='ALL_CPUS',
+                         **options)
+    os.remove(temp)
+    return f_image
+
+
 # convert processed numpy array to raster
-def imager(img, out_transform, out_meta, f_image):
-    out_meta.update({'driver': 'GTiff',
-                     'height': img.shape[1],
-                     'width': img.shape[2],
-                     'transform': out_transform,
-                     'dtype': 'float64'})
-    with rasterio.open(f_image, "w", **out_meta) as dest:
-        dest.write(img)
-    return
+@instrumented()
+def imager(img, out_transform, out_meta, f_image, dtype=None, compress=None,
+           resampling='nearest', palette=None):
+    """
+    Writes img as a tiled, compressed GeoTIFF with internal overviews.
+    dtype           ->      IMAGE_DTYPE when None; int16 images store the
+                            values times a power of ten, with the inverse
+                            as the band scale. uint8 class rasters from
+                            classify_index are written as they are
+    compress        ->      IMAGE_COMPRESS when None
+    resampling      ->      resampling of the overviews, nearest for the
+                            classified indices
+    palette         ->      optional class_palette of a class raster,
+                            written as its color table
+    """
+    if img.dtype == np.uint8:
+        dtype = 'uint8'
+    dtype = dtype or IMAGE_DTYPE
+    height, width = img.shape[-2:]
+    meta = cog_meta(out_meta, height, width, dtype, compress)
+    meta.update({'count': 1, 'transform': out_transform})
+    out_meta.update({'height': height, 'width': width,
+                     'transform': out_transform, 'dtype': dtype})
+
+    scale = None
+    if dtype == 'int16':
+        finite = img[np.isfinite(img)]
+        scale = int16_scale(np.abs(finite).max() if finite.size else 1)
+    temp = temp_path(f_image, ".tmp.tif")
+    with rasterio.open(temp, "w", **_staged(meta)) as dest:
+        dest.write(_encode(img.reshape(1, height, width), dtype, scale))
+        if scale is not None:
+            dest.scales = (1 / scale,)
+        if palette is not None:
+            dest.write_colormap(1, _colormap(palette))
+    d_range = None if dtype == 'uint8' else nan_range(img)
+    return _finish_cog(temp, f_image, meta, resampling, d_range)
+
+
+# read the first band of an image as float32, undoing int16 scaling
+def read_image(src, window=None):
+    return decode_image(src.read(1, window=window), src.scales[0],
+                        src.nodata)
+
+
+# values read from an index image as float32, int16 values are multiplied
+# by the band scale and their nodata becomes NaN
+def decode_image(in_array, scale, nodata):
+    if in_array.dtype == np.int16 and scale != 1:
+        values = in_array.astype(np.float32)
+        values *= scale
+        values[in_array == nodata] = np.nan
+        return values
+    return in_array
+
+
+# (min, max) of the values of an image, as render_array computes them for
+# percentage ramp entries, from the band tags when the image has them
+def image_range(src):
+    tags = src.tags(1)
+    if 'VALUE_MIN' in tags and 'VALUE_MAX' in tags:
+        return float(tags['VALUE_MIN']), float(tags['VALUE_MAX'])
+    d_range = (np.inf, -np.inf)
+    for ij, window in src.block_windows(1):
+        d_range = _merge_range(d_range, read_image(src, window))
+    if d_range[0] > d_range[1]:
+        return np.nan, np.nan
+    return d_range
+
+
+# color ramp in the gdaldem color-relief format
+# values            ->      the ramp values, sorted
+# colors            ->      (n, 4) RGBA color of every value
+# percent           ->      True where the value is a percentage of the
+#                           range of the data, e.g. 50%
+# nodata_color      ->      RGBA color of the nv entry, None without one
+ColorRamp = namedtuple('ColorRamp', ['values', 'colors', 'percent',
+                                     'nodata_color'])
+
+
+# parse a gdaldem color ramp, cached for as long as the file is unchanged
+@lru_cache(maxsize=64)
+def _parse_ramp(ramp, mtime):
+    entries = []
+    nodata_color = None
+    with open(ramp) as src:
+        for line in src:
+            parts = re.split(r'[\s,:]+', line.strip())
+            if not parts[0] or parts[0].startswith('#'):
+                continue
+            rgba = [int(c) for c in parts[1:5]]
+            if len(rgba) < 3:
+                # "value grey" is a grey level
+                rgba = rgba[:1] * 3
+            if len(rgba) == 3:
+                rgba.append(255)
+            if parts[0].lower() == 'nv':
+                nodata_color = tuple(rgba)
+            elif parts[0].endswith('%'):
+                entries.append((float(parts[0][:-1]), True, rgba))
+            else:
+                entries.append((float(parts[0]), False, rgba))
+    entries.sort(key=lambda entry: (entry[1], entry[0]))
+    return ColorRamp(values=np.array([e[0] for e in entries]),
+                     colors=np.array([e[2] for e in entries], dtype=np.uint8),
+                     percent=np.array([e[1] for e in entries]),
+                     nodata_color=nodata_color)
+
 
+# load a color ramp file once
+def load_ramp(ramp):
+    return _parse_ramp(os.path.abspath(ramp), os.path.getmtime(ramp))
 
-# render raster with a color ramp
-def renderer(in_raster, out_raster, ramp):
-    cmd = 'gdaldem color-relief {} {} {}'.format(in_raster, ramp, out_raster)
-    subprocess.call(cmd)
+
+# color an index array with a color ramp, as gdaldem color-relief
+@instrumented()
+def render_array(in_array, ramp, alpha=False, nodata=None, d_range=None,
+                 chunk_rows=1024):
+    """
+    in_array        ->      the index, a 2d array or a single band 3d array
+    ramp            ->      a ColorRamp or the path to a ramp file
+    alpha           ->      add the alpha band, as gdaldem -alpha
+    nodata          ->      the nodata value of the index, NaN pixels are
+                            always treated as nodata
+    d_range         ->      (min, max) of the data for percentage entries,
+                            computed from in_array when not given
+
+    Returns an uint8 array of 3 or 4 bands
+    """
+    if not isinstance(ramp, ColorRamp):
+        ramp = load_ramp(ramp)
+    if in_array.ndim == 3:
+        in_array = in_array[0]
+
+    if ramp.percent.any():
+        d_range = d_range or nan_range(in_array)
+    values, colors = _ramp_stops(ramp, d_range)
+    out = np.empty((4 if alpha else 3,) + in_array.shape, dtype=np.uint8)
+    for start in range(0, in_array.shape[0], chunk_rows):
+        _color_rows(in_array[start:start + chunk_rows], values, colors,
+                    ramp.nodata_color, nodata,
+                    out[:, start:start + chunk_rows])
+    return out
+
+
+# the values and colors of a ramp, percentage entries placed in d_range
+def _ramp_stops(ramp, d_range=None):
+    if not ramp.percent.any():
+        return ramp.values, ramp.colors
+    d_min, d_max = d_range
+    values = ramp.values.copy()
+    values[ramp.percent] = (d_min + values[ramp.percent] / 100.0
+                            * (d_max - d_min))
+    order = np.argsort(values, kind='mergesort')
+    return values[order], ramp.colors[order]
+
+
+# color rows of an index into out, (bands, rows, columns) uint8
+def _color_rows(chunk, values, colors, nodata_color, nodata, out):
+    nodata_color = nodata_color or (0, 0, 0, 0)
+    invalid = np.isnan(chunk)
+    if nodata is not None:
+        invalid |= chunk == nodata
+    for band in range(out.shape[0]):
+        # linear interpolation clamped to the ends of the ramp,
+        # rounded as gdaldem does
+        channel = np.interp(chunk, values, colors[:, band]) + 0.45
+        channel[invalid] = nodata_color[band]
+        out[band] = channel
+    return out
+
+
+# Byte GTiff holding a rendering of count bands, alpha last when 4
+def _rendered_meta(count, height, width, crs, out_transform):
+    return {'driver': 'GTiff',
+            'height': height,
+            'width': width,
+            'count': count,
+            'dtype': 'uint8',
+            'crs': crs,
+            'transform': out_transform,
+            'nodata': None,
+            'tiled': True,
+            'blockxsize': 256,
+            'blockysize': 256}
+
+
+def _alpha_last(dest):
+    if dest.count == 4:
+        interp = rasterio.enums.ColorInterp
+        dest.colorinterp = [interp.red, interp.green, interp.blue,
+                            interp.alpha]
+
+
+# write a rendered array as a Byte GTiff
+def _write_rendered(rgb, out_transform, out_meta, out_raster):
+    meta = _rendered_meta(rgb.shape[0], rgb.shape[1], rgb.shape[2],
+                          out_meta['crs'], out_transform)
+    with rasterio.open(out_raster, "w", **meta) as dest:
+        dest.write(rgb)
+        _alpha_last(dest)
+    return out_raster
+
+
+# float32 layers of a window held while rendering it: the band read and
+# its decoded values, the float64 channel np.interp returns, its mask and
+# the output bands
+RENDER_LAYERS = 7
+
+
+# render raster with a color ramp, one window at a time
+@instrumented()
+def renderer(in_raster, out_raster, ramp, alpha=False, block_size=None,
+             memory_limit=256 * 1024 ** 2):
+    """
+    In process replacement of gdaldem color-relief in_raster ramp out_raster,
+    class rasters are colored with the class_palette of the ramp
+    block_size      ->      side of the windows rendered at a time, e.g.
+                            the windows stream_indices wrote the raster
+                            with; from memory_limit when None
+
+    Percentage ramp entries use the range of the whole raster, from its
+    band tags or a first pass over its blocks
+    """
+    with rasterio.open(in_raster) as src:
+        count = 4 if alpha else 3
+        classes = src.dtypes[0] == 'uint8'
+        if classes:
+            palette = class_palette(ramp)
+        else:
+            ramp = load_ramp(ramp)
+            values, colors = _ramp_stops(
+                ramp, image_range(src) if ramp.percent.any() else None)
+            # scaled images come back with NaN where there is no data
+            scaled = src.dtypes[0] == 'int16' and src.scales[0] != 1
+            nodata = None if scaled else src.nodata
+        meta = _rendered_meta(count, src.height, src.width, src.crs,
+                              src.transform)
+        block_size = block_size or _block_side(memory_limit, RENDER_LAYERS)
+        with rasterio.open(out_raster, "w", **meta) as dest:
+            _alpha_last(dest)
+            for window in _sub_windows(
+                    rasterio.windows.Window(0, 0, src.width, src.height),
+                    block_size):
+                chunk = read_image(src, window)
+                if classes:
+                    rgb = render_classes(chunk, palette, alpha=alpha)
+                else:
+                    rgb = _color_rows(chunk, values, colors,
+                                      ramp.nodata_color, nodata,
+                                      np.empty((count,) + chunk.shape,
+                                               dtype=np.uint8))
+                dest.write(rgb, window=window)
     return out_raster
 
 
 # create raster tiles
-def tiler(in_raster, out_raster, ramp, folder):
-    options = {'zoom': (8, 18), 'resampling': 'near', 'webviewer': 'none'}
-    rend = renderer(in_raster, out_raster, ramp)
-    gdal2tiles.generate_tiles(rend, folder, **options)
+def tiler(in_raster, out_raster, ramp, folder, block_size=None):
+    rend = renderer(in_raster, out_raster, ramp, alpha=True,
+                    block_size=block_size)
+    generate_tiles(rend, folder)
     return
 
 
+# processes used by generate_tiles, None for one per core
+TILE_WORKERS = None
+# whether image_tiler pre-renders the zoom 8 to 18 pyramid of every index,
+# read from the environment so that pool processes agree
+PRETILE = os.environ.get('ADATOS_PRETILE', '1') == '1'
+
+
+# create raster tiles from a rendered raster
+@instrumented()
+def generate_tiles(rendered, folder, workers=None):
+    """
+    Tiles zoom 8 to 18 with gdal2tiles spread over workers processes into
+    a staging folder, then only moves the tiles which changed since the
+    last run into folder, see sync_tiles
+
+    rendered        ->      the rendered raster
+    folder          ->      the tile folder
+    workers         ->      number of processes, None for one per core
+
+    Returns the statistics of sync_tiles
+    """
+    workers = workers or TILE_WORKERS or os.cpu_count() or 1
+    options = {'zoom': (8, 18), 'resampling': 'near', 'webviewer': 'none',
+               'nb_processes': workers}
+    staging = tempfile.mkdtemp(prefix="tiles_", dir=work_dir())
+    try:
+        gdal2tiles.generate_tiles(rendered, staging, **options)
+        return sync_tiles(staging, folder, workers)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+# content hash of a tile, None for a fully transparent tile
+def _tile_digest(tile):
+    with open(tile, "rb") as src:
+        content = src.read()
+    # a transparent 256 x 256 png compresses to a few hundred bytes, only
+    # those small tiles are decoded to check their alpha band
+    if len(content) < 2048:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore",
+                                  rasterio.errors.NotGeoreferencedWarning)
+            with rasterio.open(tile) as src:
+                if src.count in (2, 4) and not src.read(src.count).any():
+                    return None
+    return hashlib.sha1(content).hexdigest()
+
+
+# move the new or changed tiles of a staging folder into the tile folder
+def sync_tiles(staging, folder, workers=None):
+    """
+    The hash of every tile written is kept in folder/tiles.json. Tiles
+    with an unchanged hash are not rewritten, fully transparent tiles are
+    skipped and tiles no longer produced are removed.
+
+    Returns a dictionary with the number of tiles written, unchanged,
+    transparent and removed
+    """
+    manifest_file = os.path.join(folder, "tiles.json")
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as src:
+            manifest = json.load(src)
+
+    tiles = []
+    for root, dirs, files in os.walk(staging):
+        for afile in files:
+            staged = os.path.join(root, afile)
+            rel = os.path.relpath(staged, staging)
+            if afile.endswith(".png"):
+                tiles.append(rel)
+            else:
+                dst = os.path.join(folder, rel)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.move(staged, dst)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = pool.map(_tile_digest,
+                           [os.path.join(staging, rel) for rel in tiles])
+        digests = dict(zip(tiles, digests))
+
+    stats = {"written": 0, "unchanged": 0, "transparent": 0, "removed": 0}
+    new_manifest = {}
+    for rel, digest in digests.items():
+        dst = os.path.join(folder, rel)
+        if digest is None:
+            stats["transparent"] += 1
+            continue
+        new_manifest[rel] = digest
+        if manifest.get(rel) == digest and os.path.exists(dst):
+            stats["unchanged"] += 1
+            continue
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.move(os.path.join(staging, rel), dst)
+        stats["written"] += 1
+
+    for rel in manifest:
+        if rel not in new_manifest:
+            stale = os.path.join(folder, rel)
+            if os.path.exists(stale):
+                os.remove(stale)
+                stats["removed"] += 1
+
+    os.makedirs(folder, exist_ok=True)
+    with atomic_write(manifest_file) as dst:
+        json.dump(new_manifest, dst)
+    return stats
+
+
+# rows start:stop of an array, the last axis but one holds the rows
+def _rows(in_array, start, stop):
+    if in_array.ndim < 2:
+        return in_array[start:stop]
+    return in_array[..., start:stop, :]
+
+
+# minimum and maximum of the finite values, NaN and the infinities of zero
+# denominators are skipped, read chunk_rows rows at a time
+def nan_range(in_array, chunk_rows=None):
+    rows = in_array.shape[-2] if in_array.ndim >= 2 else in_array.shape[0]
+    chunk_rows = chunk_rows or rows
+    d_min = np.inf
+    d_max = -np.inf
+    for start in range(0, rows, chunk_rows):
+        chunk = _rows(in_array, start, start + chunk_rows)
+        valid = chunk[np.isfinite(chunk)]
+        if valid.size:
+            d_min = min(d_min, valid.min())
+            d_max = max(d_max, valid.max())
+    if d_min > d_max:
+        return np.nan, np.nan
+    return d_min, d_max
+
+
+# rescale an array from d_min..d_max to f_min..f_max
+def _rescale(in_array, d_min, d_max, f_min=0, f_max=100, out=None):
+    if out is None:
+        out = in_array
+    scale = np.divide(np.float64(f_max - f_min), d_max - d_min)
+    np.subtract(in_array, d_min, out=out)
+    np.multiply(out, scale, out=out)
+    np.add(out, f_min, out=out)
+    return out
+
+
 # standardising array to 0 to 100
-def std_array(in_array, d_min=None, d_max=None, f_min=0, f_max=100):
-    if d_min is None:
-        d_min = np.min(in_array)
-    if d_max is None:
-        d_max = np.amax(in_array)
+@instrumented(nested=False)
+def std_array(in_array, d_min=None, d_max=None, f_min=0, f_max=100,
+              inplace=False, out=None, chunk_rows=None):
+    """
+    in_array        ->      the array to be standardised
+    d_min, d_max    ->      the range of the input, the minimum and maximum
+                            of the finite values when not given
+    f_min, f_max    ->      the range of the output
+    inplace         ->      write the result into in_array itself
+    out             ->      optional array to write the result into, e.g. a
+                            numpy memmap for arrays that don't fit in memory
+    chunk_rows      ->      process the array this many rows at a time
+
+    Returns the standardised array, float32 unless written in place
+    """
+    if d_min is None or d_max is None:
+        a_min, a_max = nan_range(in_array, chunk_rows)
+        d_min = a_min if d_min is None else d_min
+        d_max = a_max if d_max is None else d_max
+
+    if inplace:
+        out = in_array
+    elif out is None:
+        out = np.empty(in_array.shape, dtype=np.float32)
 
-    def scaler(x): return (((x - d_min)
-                            / (d_max - d_min))
-                           * (f_max - f_min)
-                           + f_min)
-    vfunc = np.vectorize(scaler)
-    out_array = vfunc(in_array)
-    return out_array
+    rows = in_array.shape[-2] if in_array.ndim >= 2 else in_array.shape[0]
+    chunk_rows = chunk_rows or rows
+    for start in range(0, rows, chunk_rows):
+        stop = start + chunk_rows
+        _rescale(_rows(in_array, start, stop), d_min, d_max, f_min, f_max,
+                 out=_rows(out, start, stop))
+    return out
 
 
 # function to create the raster tiles
@@ -261,245 +1175,764 @@ def raster_executor(
 
     Returns the path to the created image
     """
-    # write the created index into a temporary file
-    f_image = str(Path.cwd() / "temp" / p_image)
-    imager(in_array, out_transform, out_meta, f_image)
+    # write the created index into a temporary file, class rasters with
+    # the colors of their classes
+    palette = None
+    if in_array.dtype == np.uint8:
+        palette = class_palette(str(Path.cwd() / "ramps" / i_ramp))
+    f_image = os.path.join(work_dir(), p_image)
+    imager(in_array, out_transform, out_meta, f_image, palette=palette)
+    image_tiler(f_image, i_ramp, tile_folder, i_folder,
+                in_array, out_transform, out_meta)
+
+    return f_image
+
+
+# function to render and tile an index image
+def image_tiler(f_image, i_ramp, tile_folder, i_folder, in_array=None,
+                out_transform=None, out_meta=None, block_size=None):
+    """
+    f_image         -> the index image
+    i_ramp          -> the color ramp to be used when rendering the index
+    tile_folder     -> the base tile folder path
+    i_folder        -> where all the tiles will be created in the tile_folder
+    in_array        -> optional index array already in memory, rendered
+                       directly instead of reading f_image back
+    block_size      -> side of the windows f_image is rendered with when
+                       it is read back, see renderer
 
+    Does nothing when PRETILE is off, the tiles are then rendered on
+    request from f_image by tile_server
+    """
+    if not PRETILE:
+        return
     # generating the inputs for the color ramps
     ramp = str(Path.cwd() / "ramps" / i_ramp)
-    temp_raster = str(Path.cwd() / "temp" / "rendered_temp_image.tif")
+    temp_raster = os.path.join(work_dir(), "rendered_{}".format(
+        os.path.basename(f_image)))
 
     # tiling the raw raster
     folder = os.path.join(tile_folder, i_folder)
     if not os.path.exists(folder):
         os.mkdir(folder)
-    tiler(f_image, temp_raster, ramp, folder)
+    if in_array is None:
+        tiler(f_image, temp_raster, ramp, folder, block_size)
+    else:
+        if in_array.dtype == np.uint8:
+            rgb = render_classes(in_array, class_palette(ramp), alpha=True)
+        else:
+            rgb = render_array(in_array, ramp, alpha=True)
+        _write_rendered(rgb, out_transform, out_meta, temp_raster)
+        del rgb
+        generate_tiles(temp_raster, folder)
 
     # delete unnecessary temporary file
     os.remove(temp_raster)
+    return
 
-    return f_image
 
+# ---------------------
+# natural breaks
 
-# natural breaks classification for visual display
-def natural_breaks(input_array):
-    copy_array = np.copy(input_array)
-    copy_array = copy_array[~np.isnan(copy_array)]
+# name of a band file without the band and resolution, e.g.
+# T48NUH_20180903T031541 for T48NUH_20180903T031541_B04_10m.jp2
+BAND_FILE = re.compile(r'^(?P<product>.+)_B(?:\d{2}|8A)_\d{2}m\.\w+$')
 
-    rdm_array = np.random.choice(copy_array, size=100000)
-    rdm_list = rdm_array.tolist()
-    breaks = jenkspy.jenks_breaks(rdm_list, nb_class=101)
 
-    del copy_array
-    del rdm_array
+# the product a band file belongs to
+def product_key(band_file):
+    match = BAND_FILE.match(os.path.basename(band_file))
+    if match is None:
+        return os.path.abspath(band_file)
+    return match.group('product')
 
-    return breaks
 
+# cache of computed breaks, keyed by (product, index, AOI, method, classes)
+class BreaksCache(object):
+    """
+    Keeps the breaks computed for an index so that reruns of a job do not
+    classify the same product again. Entries are evicted in least recently
+    used order.
+    path            ->      optional json file the cache is persisted to,
+                            loaded when it exists
+    max_entries     ->      number of breaks kept
+    """
 
-# function to calculate weighted Normalised Difference Water Index.
-# this index measures water stress in plants.
-def wndwi_f(nir_band, swir11_band, aoi, tile_folder):
-    nir, out_transform, out_meta = raster_mask(nir_band, aoi)
-    swir11 = raster_mask(swir11_band, aoi)[0]
-    wndwi = ((2 * nir - swir11)
-             / (2 * nir + swir11))
+    def __init__(self, path=None, max_entries=1024):
+        self.path = path
+        self.max_entries = max_entries
+        self._breaks = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as src:
+                self._breaks = json.load(src, object_pairs_hook=OrderedDict)
+            self._trim()
 
-    # creating the standard array
-    wndwi_std = std_array(in_array=wndwi, d_min=-1.0, d_max=1.0)
+    def __len__(self):
+        return len(self._breaks)
 
-    # categorising the wNDWI array for visualisation
-    classes = natural_breaks(wndwi)
-    wndwi[(wndwi <= classes[30])] = 1.1
-    wndwi[(wndwi <= classes[50])] = 2
-    wndwi[(wndwi <= classes[60])] = 3
-    wndwi[(wndwi <= classes[75])] = 4
-    wndwi[(wndwi >= classes[75]) & (wndwi <= 1.0)] = 5
-    wndwi[(wndwi == 1.1)] = 1
+    @staticmethod
+    def _key(key):
+        return "|".join(str(part) for part in key)
 
-    # rendering and tiling the raw index
-    wndwi_img = raster_executor("raw_wndwi.tif",
-                                wndwi, out_transform,
-                                out_meta, "wndwi_color.txt",
-                                tile_folder, "wNDWI")
+    def _trim(self):
+        while len(self._breaks) > self.max_entries:
+            self._breaks.popitem(last=False)
 
-    return wndwi_img, wndwi_std, out_transform, out_meta
+    def get(self, key):
+        key = self._key(key)
+        with self._lock:
+            breaks = self._breaks.get(key)
+            if breaks is not None:
+                self._breaks.move_to_end(key)
+            return breaks
 
+    def put(self, key, breaks):
+        key = self._key(key)
+        with self._lock:
+            self._breaks[key] = [float(b) for b in breaks]
+            self._breaks.move_to_end(key)
+            self._trim()
+            if self.path is not None:
+                with atomic_write(self.path) as dst:
+                    json.dump(self._breaks, dst)
 
-# function to calculate Wide Dynamic Range Vegetation Index.
-# this index measures plant biomass.
-def wdrvi_f(nir_band, red_band, aoi, tile_folder):
-    nir, out_transform, out_meta = raster_mask(nir_band, aoi)
-    red = raster_mask(red_band, aoi)[0]
-    wdrvi = (0.2 * nir - red) / (0.2 * nir + red)
+    def clear(self):
+        with self._lock:
+            self._breaks.clear()
 
-    # creating the standard array
-    wdrvi_std = std_array(in_array=wdrvi, d_min=-1.0, d_max=1.0)
 
-    # categorising the WDRVI array for visualisation
-    classes = natural_breaks(wndwi)
-    wdrvi[(wdrvi <= classes[30])] = 1.1
-    wdrvi[(wdrvi <= classes[50])] = 2
-    wdrvi[(wdrvi <= classes[60])] = 3
-    wdrvi[(wdrvi <= classes[75])] = 4
-    wdrvi[(wdrvi >= classes[75]) & (wdrvi <= 1.0)] = 5
-    wdrvi[(wdrvi == 1.1)] = 1
+BREAKS_CACHE = BreaksCache()
 
-    # rendering and tiling the raw index
-    wdrvi_img = raster_executor("raw_wdrvi.tif",
-                                wdrvi, out_transform,
-                                out_meta, "wdrvi_color.txt",
-                                tile_folder, "WDRVI")
 
-    return wdrvi_img, wdrvi_std, out_transform, out_meta
+# key of the breaks of an index in a BreaksCache
+def breaks_key(product, index, aoi_id, method="jenks_hist", n_classes=101):
+    return product, index, aoi_id, method, n_classes
 
 
-# function to calculate Enhanced Vegetation Index
-# this index measures late stage LAI
-def evi_f(nir_band, red_band, blue_band, aoi, tile_folder):
-    nir, out_transform, out_meta = raster_mask(nir_band, aoi)
-    red = raster_mask(red_band, aoi)[0]
-    blue = raster_mask(blue_band, aoi)[0]
-    evi = ((2.5 * (nir - red))
-           / (nir + (6 * red)
-              - (7.5 * blue) + 1.0))
+BREAKS_ENGINES = OrderedDict()
 
-    # creating the standard array
-    evi_std = std_array(in_array=evi, d_min=-1.0, d_max=1.0)
 
-    # categorising the EVI array for visualisation
-    classes = natural_breaks(evi)
-    evi[(evi <= classes[30])] = 1.1
-    evi[(evi <= classes[50])] = 2
-    evi[(evi <= classes[60])] = 3
-    evi[(evi <= classes[75])] = 4
-    evi[(evi >= classes[75]) & (evi <= 1.0)] = 5
-    evi[(evi == 1.1)] = 1
+# decorator registering a breaks engine
+# an engine is called as engine(values, n_classes, options), values being
+# the finite values of the index, and returns n_classes + 1 breaks
+def register_breaks(name):
+    def decorator(engine):
+        BREAKS_ENGINES[name] = engine
+        return engine
+    return decorator
 
-    # rendering and tiling the raw index
-    evi_img = raster_executor("raw_evi.tif",
-                              evi, out_transform,
-                              out_meta, "evi_color.txt",
-                              tile_folder, "EVI")
 
-    return evi_img, evi_std, out_transform, out_meta
+# jenks natural breaks of weighted, sorted values (Fisher's algorithm)
+def jenks_weighted(values, weights, n_classes):
+    """
+    values          ->      sorted 1d array of distinct values
+    weights         ->      number of pixels holding each value
+    n_classes       ->      number of classes, at most len(values)
 
+    Returns the index in values of the upper bound of every class
+    """
+    n = len(values)
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    cw = np.concatenate(([0.0], np.cumsum(weights)))
+    cwx = np.concatenate(([0.0], np.cumsum(weights * values)))
+    cwxx = np.concatenate(([0.0], np.cumsum(weights * values * values)))
+
+    # sum of squared deviations of every run of values i..j
+    start = np.arange(n)[:, None]
+    end = np.arange(n)[None, :] + 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ssd = ((cwxx[end] - cwxx[start])
+               - (cwx[end] - cwx[start]) ** 2 / (cw[end] - cw[start]))
+    ssd[start >= end] = np.inf
+
+    cost = ssd[0].copy()
+    back = np.zeros((n_classes, n), dtype=np.intp)
+    prev = np.empty(n)
+    total = np.empty((n, n))
+    for k in range(1, n_classes):
+        prev[0] = np.inf
+        prev[1:] = cost[:-1]
+        np.add(prev[:, None], ssd, out=total)
+        back[k] = np.argmin(total, axis=0)
+        cost = total[back[k], np.arange(n)]
+
+    ends = [n - 1]
+    for k in range(n_classes - 1, 0, -1):
+        ends.append(back[k][ends[-1]] - 1)
+    return ends[::-1]
+
+
+# pixel counts and value sums of a histogram over d_min..d_max
+def value_histogram(values, bins, d_min, d_max):
+    counts, edges = np.histogram(values, bins=bins, range=(d_min, d_max))
+    sums = np.histogram(values, bins=bins, range=(d_min, d_max),
+                        weights=values)[0]
+    return counts, sums, edges
+
+
+# natural breaks from a histogram of the index
+def histogram_breaks(counts, sums, edges, n_classes, d_min, d_max):
+    """
+    counts          ->      number of pixels in every bin
+    sums            ->      sum of the pixel values in every bin
+    edges           ->      the bin edges
+    d_min, d_max    ->      the range of the data
 
-# function to calculate Normaliased Differentiated Vegetation Index
-# this index measures the amount of Photosythetically Active Radiation
-def ndvi_f(nir_band, red_band, aoi, tile_folder):
-    nir, out_transform, out_meta = raster_mask(nir_band, aoi)
-    red = raster_mask(red_band, aoi)[0]
-    ndvi = ((nir - red) / (nir + red))
+    Returns n_classes + 1 breaks, the inner breaks are upper bin edges
+    """
+    filled = counts > 0
+    means = sums[filled] / counts[filled]
+    uppers = edges[1:][filled]
+    m = len(means)
+    if m == 0:
+        return [np.nan] * (n_classes + 1)
+    if m <= n_classes:
+        return ([d_min] + list(uppers[:m - 1])
+                + [d_max] * (n_classes - m + 1))
+    ends = jenks_weighted(means, counts[filled], n_classes)
+    return [d_min] + [uppers[end] for end in ends[:-1]] + [d_max]
+
+
+# exact jenks on a random sample of the pixels
+@register_breaks("jenks")
+def _jenks_breaks(values, n_classes, options):
+    rng = np.random.RandomState(options.get("seed"))
+    sample = rng.choice(values, size=options.get("sample_size", 100000))
+    # the class count is positional, its keyword was renamed across
+    # jenkspy versions
+    return jenkspy.jenks_breaks(sample.tolist(), n_classes)
+
+
+# approximate jenks on a histogram of every pixel
+@register_breaks("jenks_hist")
+def _jenks_hist_breaks(values, n_classes, options):
+    d_min, d_max = values.min(), values.max()
+    counts, sums, edges = value_histogram(values, options.get("bins", 512),
+                                          d_min, d_max)
+    return histogram_breaks(counts, sums, edges, n_classes, d_min, d_max)
+
+
+# classes holding the same number of pixels
+@register_breaks("quantile")
+def _quantile_breaks(values, n_classes, options):
+    return np.quantile(values, np.linspace(0.0, 1.0, n_classes + 1)).tolist()
+
+
+# breaks given in the options, equal intervals over the data otherwise
+@register_breaks("fixed")
+def _fixed_breaks(values, n_classes, options):
+    breaks = options.get("breaks")
+    if breaks is None:
+        return np.linspace(values.min(), values.max(),
+                           n_classes + 1).tolist()
+    if len(breaks) != n_classes + 1:
+        raise ValueError("fixed breaks need {} values, got {}".format(
+            n_classes + 1, len(breaks)))
+    return list(breaks)
 
-    # creating the standard array
-    ndvi_std = std_array(in_array=ndvi, d_min=-1.0, d_max=1.0)
 
-    # categorising the NDVI array for visualisation
-    classes = natural_breaks(ndvi)
-    ndvi[(ndvi <= classes[30])] = 1.1
-    ndvi[(ndvi <= classes[50])] = 2
-    ndvi[(ndvi <= classes[60])] = 3
-    ndvi[(ndvi <= classes[75])] = 4
-    ndvi[(ndvi >= classes[75]) & (ndvi <= 1.0)] = 5
-    ndvi[(ndvi == 1.1)] = 1
+# natural breaks classification for visual display
+@instrumented()
+def natural_breaks(input_array, n_classes=101, method="jenks_hist",
+                   key=None, cache=BREAKS_CACHE, **options):
+    """
+    input_array     ->      the raw index
+    n_classes       ->      the number of classes
+    method          ->      one of BREAKS_ENGINES: jenks (exact, on a
+                            sample of sample_size pixels), jenks_hist
+                            (histogram of bins bins), quantile or fixed
+                            (the given breaks)
+    key             ->      optional (product, index, AOI) the breaks are
+                            cached under
+    cache           ->      the BreaksCache used together with key
+    options         ->      seed (default 0), sample_size, bins, breaks
+
+    Returns a list of n_classes + 1 breaks
+    """
+    if key is not None:
+        key = breaks_key(*key, method=method, n_classes=n_classes)
+        breaks = cache.get(key)
+        if breaks is not None:
+            return breaks
+
+    options.setdefault("seed", 0)
+    values = input_array[np.isfinite(input_array)]
+    if values.size == 0:
+        breaks = [np.nan] * (n_classes + 1)
+    else:
+        breaks = BREAKS_ENGINES[method](values, n_classes, options)
+    del values
 
-    # rendering and tiling the raw index
-    ndvi_img = raster_executor("raw_ndvi.tif",
-                               ndvi, out_transform,
-                               out_meta, "ndvi_color.txt",
-                               tile_folder, "NDVI")
+    if key is not None and not np.isnan(breaks[0]):
+        cache.put(key, breaks)
+    return breaks
 
-    return ndvi_img, ndvi_std, out_transform, out_meta
 
+# the natural breaks closing the display classes 1 to 4 from above, values
+# above the last one are class 5; class CLASS_NODATA is kept for NaN
+CLASS_BOUNDS = (30, 50, 60, 75)
+N_CLASSES = len(CLASS_BOUNDS) + 1
+CLASS_NODATA = 0
 
-# function to calculate Optimised Soil Adjusted Vegetation Index
-# this index measures early stage LAI
-def osavi_f(nir_band, red_band, aoi, tile_folder):
-    nir, out_transform, out_meta = raster_mask(nir_band, aoi)
-    red = raster_mask(red_band, aoi)[0]
-    osavi = (nir - red) / (nir + red + 0.16)
 
-    # creating the standard array
-    osavi_std = std_array(in_array=osavi, d_min=-1.0, d_max=1.0)
+# reclassify an index array into the five display classes
+@instrumented(nested=False)
+def classify_index(index_array, classes, out=None, chunk_rows=64):
+    """
+    index_array     ->      the raw index, left unchanged
+    classes         ->      the output of natural_breaks
+    out             ->      optional uint8 array the classes are written to
+
+    Returns an uint8 array of the classes, value v is in class c when
+    bound c - 1 < v <= bound c. The class is one plus the number of bounds
+    below the value, counted over chunk_rows rows small enough to stay in
+    cache
+    """
+    # compared in the dtype of the index, as the breaks were computed
+    bounds = np.array([classes[i] for i in CLASS_BOUNDS],
+                      dtype=index_array.dtype)
+    if out is None:
+        out = np.empty(index_array.shape, dtype=np.uint8)
+    rows = (index_array.shape[-2] if index_array.ndim >= 2
+            else index_array.shape[0])
+    for start in range(0, rows, chunk_rows):
+        chunk = _rows(index_array, start, start + chunk_rows)
+        target = _rows(out, start, start + chunk_rows)
+        np.greater(chunk, bounds[0], out=target, casting='unsafe')
+        for bound in bounds[1:]:
+            target += chunk > bound
+        target += 1
+        target[np.isnan(chunk)] = CLASS_NODATA
+    return out
+
+
+# RGBA color table of the classes, as the ramp of the index colors them
+def class_palette(ramp):
+    """
+    ramp            ->      a ColorRamp or the path to a ramp file
 
-    # categorising the OSAVI array for visualisation
-    classes = natural_breaks(osavi)
-    osavi[(osavi <= classes[30])] = 1.1
-    osavi[(osavi <= classes[50])] = 2
-    osavi[(osavi <= classes[60])] = 3
-    osavi[(osavi <= classes[75])] = 4
-    osavi[(osavi >= classes[75]) & (osavi <= 1.0)] = 5
-    osavi[(osavi == 1.1)] = 1
+    Returns a (256, 4) uint8 array holding the color of class c at row c
+    """
+    if not isinstance(ramp, ColorRamp):
+        ramp = load_ramp(ramp)
+    palette = np.zeros((256, 4), dtype=np.uint8)
+    levels = np.arange(1, N_CLASSES + 1, dtype=np.float32)[None]
+    palette[1:N_CLASSES + 1] = render_array(levels, ramp, alpha=True,
+                                            d_range=(1, N_CLASSES))[:, 0].T
+    palette[CLASS_NODATA] = ramp.nodata_color or (0, 0, 0, 0)
+    return palette
+
+
+# color a class raster with its palette
+def render_classes(class_array, palette, alpha=False):
+    """
+    Returns an uint8 array of 3 or 4 bands, as render_array
+    """
+    if class_array.ndim == 3:
+        class_array = class_array[0]
+    return palette.T[:4 if alpha else 3, class_array]
 
-    # rendering and tiling the raw index
-    osavi_img = raster_executor("raw_osavi.tif",
-                                osavi, out_transform,
-                                out_meta, "osavi_color.txt",
-                                tile_folder, "OSAVI")
 
-    return osavi_img, osavi_std, out_transform, out_meta
+# ---------------------
+# index registry
+
+# declaration of an index
+# name              ->      the name of the index, also the key in the registry
+# bands             ->      names of the input bands used by the formula
+# formula           ->      function(bands, out, scratch) writing the index
+#                           into out using only in place operations
+# std_range         ->      (d_min, d_max) used to standardise the index,
+#                           None to use the range of the data
+# ramp              ->      the color ramp in the ramps folder
+# folder            ->      the folder created in the tile folder
+# image             ->      the name of the temporary output image
+# scratch           ->      number of scratch buffers needed by the formula
+IndexSpec = namedtuple('IndexSpec', ['name', 'bands', 'formula', 'std_range',
+                                     'ramp', 'folder', 'image', 'scratch'])
+
+INDEX_REGISTRY = OrderedDict()
+
+
+# decorator registering an index formula
+def register_index(name, bands, std_range, ramp, folder=None, scratch=1):
+    def decorator(formula):
+        INDEX_REGISTRY[name] = IndexSpec(name=name,
+                                         bands=tuple(bands),
+                                         formula=formula,
+                                         std_range=std_range,
+                                         ramp=ramp,
+                                         folder=folder or name,
+                                         image="raw_{}.tif".format(
+                                             name.lower()),
+                                         scratch=scratch)
+        return formula
+    return decorator
+
+
+# weighted Normalised Difference Water Index.
+# this index measures water stress in plants.
+@register_index("wNDWI", ("nir", "swir11"), (-1.0, 1.0), "wndwi_color.txt")
+def _wndwi(b, out, scratch):
+    t0 = scratch[0]
+    np.multiply(b["nir"], 2.0, out=t0)
+    np.subtract(t0, b["swir11"], out=out)
+    np.add(t0, b["swir11"], out=t0)
+    np.divide(out, t0, out=out)
 
 
-# function to calculate Plant Senescence Reflectance Index
-# this index measures the level of senescence in the plants
-def psri_f(red_band, blue_band, re6_band, aoi, tile_folder):
-    red, out_transform, out_meta = raster_mask(red_band, aoi)
-    blue = raster_mask(blue_band, aoi)[0]
-    re6 = raster_mask(re6_band, aoi)[0]
-    psri = (red - blue) / re6
+# Wide Dynamic Range Vegetation Index.
+# this index measures plant biomass.
+@register_index("WDRVI", ("nir", "red"), (-1.0, 1.0), "wdrvi_color.txt")
+def _wdrvi(b, out, scratch):
+    t0 = scratch[0]
+    np.multiply(b["nir"], 0.2, out=t0)
+    np.subtract(t0, b["red"], out=out)
+    np.add(t0, b["red"], out=t0)
+    np.divide(out, t0, out=out)
 
-    # creating the standard array
-    psri_std = std_array(in_array=psri, d_min=-1.0, d_max=1.0)
 
-    # categorising the PSRI array for visualisation
-    classes = natural_breaks(psri)
-    psri[(psri <= classes[30])] = 1.1
-    psri[(psri <= classes[50])] = 2
-    psri[(psri <= classes[60])] = 3
-    psri[(psri <= classes[75])] = 4
-    psri[(psri >= classes[75]) & (psri <= 1.0)] = 5
-    psri[(psri == 1.1)] = 1
+# Enhanced Vegetation Index
+# this index measures late stage LAI
+@register_index("EVI", ("nir", "red", "blue"), (-1.0, 1.0), "evi_color.txt",
+                scratch=2)
+def _evi(b, out, scratch):
+    t0, t1 = scratch[:2]
+    np.subtract(b["nir"], b["red"], out=out)
+    np.multiply(out, 2.5, out=out)
+    np.multiply(b["red"], 6.0, out=t0)
+    np.add(t0, b["nir"], out=t0)
+    np.multiply(b["blue"], 7.5, out=t1)
+    np.subtract(t0, t1, out=t0)
+    np.add(t0, 1.0, out=t0)
+    np.divide(out, t0, out=out)
+
+
+# Normaliased Differentiated Vegetation Index
+# this index measures the amount of Photosythetically Active Radiation
+@register_index("NDVI", ("nir", "red"), (-1.0, 1.0), "ndvi_color.txt")
+def _ndvi(b, out, scratch):
+    t0 = scratch[0]
+    np.subtract(b["nir"], b["red"], out=out)
+    np.add(b["nir"], b["red"], out=t0)
+    np.divide(out, t0, out=out)
 
-    # rendering and tiling the raw index
-    psri_img = raster_executor("raw_psri.tif",
-                               psri, out_transform,
-                               out_meta, "psri_color.txt",
-                               tile_folder, "PSRI")
 
-    return psri_img, psri_std, out_transform, out_meta
+# Optimised Soil Adjusted Vegetation Index
+# this index measures early stage LAI
+@register_index("OSAVI", ("nir", "red"), (-1.0, 1.0), "osavi_color.txt")
+def _osavi(b, out, scratch):
+    t0 = scratch[0]
+    np.subtract(b["nir"], b["red"], out=out)
+    np.add(b["nir"], b["red"], out=t0)
+    np.add(t0, 0.16, out=t0)
+    np.divide(out, t0, out=out)
 
 
-# function to calculate Inverted Red-Edge Chlorophyll Index
+# Plant Senescence Reflectance Index
+# this index measures the level of senescence in the plants
+@register_index("PSRI", ("red", "blue", "re6"), (-1.0, 1.0), "psri_color.txt",
+                scratch=0)
+def _psri(b, out, scratch):
+    np.subtract(b["red"], b["blue"], out=out)
+    np.divide(out, b["re6"], out=out)
+
+
+# Inverted Red-Edge Chlorophyll Index
 # this index is a measure of leaf chlorophyll concentration
-def ireci_f(nir_band, red_band, re5_band, re6_band, aoi, tile_folder):
-    red, out_transform, out_meta = raster_mask(red_band, aoi)
-    nir = raster_mask(nir_band, aoi)[0]
-    re5 = raster_mask(re5_band, aoi)[0]
-    re6 = raster_mask(re6_band, aoi)[0]
-    ireci = ((nir - red) / (re5 / re6))
+@register_index("IRECI", ("nir", "red", "re5", "re6"), (-1.0, 2.5),
+                "ireci_color.txt")
+def _ireci(b, out, scratch):
+    t0 = scratch[0]
+    np.subtract(b["nir"], b["red"], out=out)
+    np.divide(b["re5"], b["re6"], out=t0)
+    np.divide(out, t0, out=out)
+
+
+# Forest Canopy Density, built from the standardised Advance Vegetation,
+# Bare Soil and Shadow Indices
+@register_index("FCD", ("nir", "red", "green", "blue", "swir11"), None,
+                "fcd_color.txt", scratch=3)
+def _fcd(b, out, scratch):
+    t0, t1, t2 = scratch[:3]
+    nir, red, green, blue = b["nir"], b["red"], b["green"], b["blue"]
+
+    # Advance Vegetation Index
+    np.subtract(1.0, red, out=t0)
+    np.multiply(t0, nir, out=t0)
+    np.subtract(nir, red, out=t1)
+    np.multiply(t0, t1, out=t0)
+    np.power(t0, 1.0 / 3.0, out=t0)
+    std_array(t0, d_min=-1.0, d_max=1.0, inplace=True)
+
+    # Bare Soil Index
+    np.add(b["swir11"], red, out=t1)
+    np.add(nir, blue, out=t2)
+    np.subtract(t1, t2, out=out)
+    np.add(t1, t2, out=t1)
+    np.divide(out, t1, out=out)
+    std_array(out, d_min=-1.0, d_max=1.0, inplace=True)
+
+    # Shadow Index
+    np.subtract(1.0, blue, out=t1)
+    np.subtract(1.0, green, out=t2)
+    np.multiply(t1, t2, out=t1)
+    np.subtract(1.0, red, out=t2)
+    np.multiply(t1, t2, out=t1)
+    np.power(t1, 1.0 / 3.0, out=t1)
+    std_array(t1, d_min=0.0, d_max=1.0, inplace=True)
+
+    # forest canopy density
+    np.multiply(t1, out, out=t1)
+    np.divide(t0, t1, out=out)
+
+
+# evaluate several indices in a single pass over the input bands
+@instrumented(nested=False)
+def evaluate_indices(names, bands, block_rows=256, outputs=None):
+    """
+    names           ->      names of registered indices
+    bands           ->      dictionary of band name to float32 array, all
+                            bands must share the same shape
+    block_rows      ->      number of rows evaluated at a time, every index
+                            is computed on a block before moving on so the
+                            inputs are only streamed through once
+    outputs         ->      optional dictionary of index name to the
+                            float32 array the index is written into
+
+    Returns a dictionary of index name to float32 array
+    """
+    specs = [INDEX_REGISTRY[name] for name in names]
+    shape = next(iter(bands.values())).shape
+    if outputs is None:
+        outputs = OrderedDict((spec.name, np.empty(shape, dtype=np.float32))
+                              for spec in specs)
+
+    rows = shape[-2]
+    block_shape = shape[:-2] + (min(block_rows, rows), shape[-1])
+    n_scratch = max(spec.scratch for spec in specs)
+    buffers = [np.empty(block_shape, dtype=np.float32)
+               for i in range(n_scratch)]
+
+    for start in range(0, rows, block_rows):
+        stop = min(start + block_rows, rows)
+        n = stop - start
+        block = {key: value[..., start:stop, :]
+                 for key, value in bands.items()}
+        scratch = [buf[..., :n, :] for buf in buffers]
+        for spec in specs:
+            spec.formula(block, outputs[spec.name][..., start:stop, :],
+                         scratch)
+
+    return outputs
+
+
+# standardise, classify and tile an evaluated index
+def _finish_index(spec, index_array, out_transform, out_meta, tile_folder,
+                  classes=None, std_out=None):
+    """
+    spec            ->      the IndexSpec of the index
+    index_array     ->      the evaluated index
+    classes         ->      the breaks, computed when None
+    std_out         ->      optional array the standard array is written to
 
+    Returns (image, std array, breaks)
+    """
     # creating the standard array
-    ireci_std = std_array(in_array=ireci, d_min=-1.0, d_max=2.5)
+    if spec.std_range is None:
+        index_std = std_array(in_array=index_array, out=std_out)
+    else:
+        index_std = std_array(in_array=index_array,
+                              d_min=spec.std_range[0],
+                              d_max=spec.std_range[1],
+                              out=std_out)
+
+    # categorising the index array for visualisation
+    if classes is None:
+        classes = natural_breaks(index_array)
+    class_array = classify_index(index_array, classes)
+
+    # rendering and tiling the classes
+    index_img = raster_executor(spec.image,
+                                class_array, out_transform,
+                                out_meta.copy(), spec.ramp,
+                                tile_folder, spec.folder)
+    return index_img, index_std, classes
+
+
+# process pool task finishing an index held in a memory mapped file
+def _finish_index_task(task):
+    # the pool already uses every core, and its workers may not start
+    # processes of their own
+    global TILE_WORKERS
+    TILE_WORKERS = 1
+    (name, value_file, std_file, shape, out_transform, out_meta,
+     tile_folder, classes, folder) = task
+    _WORK.folder = folder
+    index_array = np.memmap(value_file, dtype=np.float32, mode='r',
+                            shape=shape)
+    std_out = np.memmap(std_file, dtype=np.float32, mode='w+', shape=shape)
+    index_img, index_std, classes = _finish_index(
+        INDEX_REGISTRY[name], index_array, out_transform, out_meta,
+        tile_folder, classes, std_out)
+    std_out.flush()
+    del index_array, std_out
+    return name, index_img, [float(b) for b in classes]
+
+
+# calculate, classify and tile several registered indices
+@instrumented()
+def indices_f(names, band_paths, aoi, tile_folder, cache=None, workers=1):
+    """
+    names           ->      names of registered indices
+    band_paths      ->      dictionary of band name to band file, must hold
+                            every band needed by the indices
+    aoi             ->      the estate AOI
+    tile_folder     ->      the base tile folder path
+    cache           ->      optional BandCache shared by the job
+    workers         ->      number of processes finishing the indices, None
+                            for one per core. With more than one worker the
+                            indices are evaluated into memory mapped files
+                            that the workers open instead of receiving
+                            copies of the arrays
+
+    Returns a dictionary of index name to
+    (image, std array, out_transform, out_meta)
+    """
+    needed = []
+    for name in names:
+        for band in INDEX_REGISTRY[name].bands:
+            if band not in needed:
+                needed.append(band)
+
+    bands = {}
+    for band in needed:
+        bands[band], out_transform, out_meta = raster_mask(
+            band_paths[band], aoi, cache)
+
+    product = product_key(band_paths[needed[0]])
+    aoi_id = aoi_identity(aoi)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(names))
+
+    results = OrderedDict()
+    if workers <= 1:
+        values = evaluate_indices(names, bands)
+        del bands
+        for name, index_array in values.items():
+            key = (product, name, aoi_id)
+            classes = natural_breaks(index_array, key=key)
+            index_img, index_std = _finish_index(
+                INDEX_REGISTRY[name], index_array, out_transform, out_meta,
+                tile_folder, classes)[:2]
+            results[name] = (index_img, index_std, out_transform, out_meta)
+        return results
+
+    shape = next(iter(bands.values())).shape
+    map_folder = tempfile.mkdtemp(prefix="indices_", dir=work_dir())
+    try:
+        value_files = OrderedDict(
+            (name, os.path.join(map_folder, "{}.f32".format(name)))
+            for name in names)
+        outputs = OrderedDict(
+            (name, np.memmap(path, dtype=np.float32, mode='w+', shape=shape))
+            for name, path in value_files.items())
+        evaluate_indices(names, bands, outputs=outputs)
+        del bands
+        for output in outputs.values():
+            output.flush()
+        del outputs
+
+        tasks = []
+        for name, value_file in value_files.items():
+            classes = BREAKS_CACHE.get(breaks_key(product, name, aoi_id))
+            tasks.append((name, value_file, value_file + ".std", shape,
+                          out_transform, out_meta, tile_folder, classes,
+                          work_dir()))
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for name, index_img, classes in pool.map(_finish_index_task,
+                                                     tasks):
+                # an AOI without finite values has no breaks to keep
+                if np.isfinite(classes[0]):
+                    BREAKS_CACHE.put(breaks_key(product, name, aoi_id),
+                                     classes)
+                std_map = np.memmap(value_files[name] + ".std",
+                                    dtype=np.float32, mode='r', shape=shape)
+                results[name] = (index_img, np.array(std_map),
+                                 out_transform, out_meta)
+                del std_map
+    finally:
+        shutil.rmtree(map_folder, ignore_errors=True)
+
+    return results
+
+
+# calculate, classify and tile a single registered index
+def index_f(name, band_paths, aoi, tile_folder, cache=None):
+    return indices_f([name], band_paths, aoi, tile_folder, cache)[name]
+
+
+# ---------------------
+
+
+# function to calculate weighted Normalised Difference Water Index.
+@instrumented()
+def wndwi_f(nir_band, swir11_band, aoi, tile_folder, cache=None):
+    return index_f("wNDWI", {"nir": nir_band, "swir11": swir11_band},
+                   aoi, tile_folder, cache)
+
+
+# function to calculate Wide Dynamic Range Vegetation Index.
+@instrumented()
+def wdrvi_f(nir_band, red_band, aoi, tile_folder, cache=None):
+    return index_f("WDRVI", {"nir": nir_band, "red": red_band},
+                   aoi, tile_folder, cache)
+
+
+# function to calculate Enhanced Vegetation Index
+@instrumented()
+def evi_f(nir_band, red_band, blue_band, aoi, tile_folder, cache=None):
+    return index_f("EVI", {"nir": nir_band, "red": red_band,
+                           "blue": blue_band},
+                   aoi, tile_folder, cache)
+
+
+# function to calculate Normaliased Differentiated Vegetation Index
+@instrumented()
+def ndvi_f(nir_band, red_band, aoi, tile_folder, cache=None):
+    return index_f("NDVI", {"nir": nir_band, "red": red_band},
+                   aoi, tile_folder, cache)
+
+
+# function to calculate Optimised Soil Adjusted Vegetation Index
+@instrumented()
+def osavi_f(nir_band, red_band, aoi, tile_folder, cache=None):
+    return index_f("OSAVI", {"nir": nir_band, "red": red_band},
+                   aoi, tile_folder, cache)
+
 
-    # categorising the IRECI array for visualisation
-    classes = natural_breaks(ireci)
-    ireci[(ireci <= classes[30])] = 1.1
-    ireci[(ireci <= classes[50])] = 2
-    ireci[(ireci <= classes[60])] = 3
-    ireci[(ireci <= classes[75])] = 4
-    ireci[(ireci >= classes[75]) & (ireci <= 1.0)] = 5
-    ireci[(ireci == 1.1)] = 1
+# function to calculate Plant Senescence Reflectance Index
+@instrumented()
+def psri_f(red_band, blue_band, re6_band, aoi, tile_folder, cache=None):
+    return index_f("PSRI", {"red": red_band, "blue": blue_band,
+                            "re6": re6_band},
+                   aoi, tile_folder, cache)
 
-    # rendering and tiling the raw index
-    ireci_img = raster_executor("raw_ireci.tif",
-                                ireci, out_transform,
-                                out_meta, "ireci_color.txt",
-                                tile_folder, "IRECI")
 
-    return ireci_img, ireci_std, out_transform, out_meta
+# function to calculate Inverted Red-Edge Chlorophyll Index
+@instrumented()
+def ireci_f(nir_band, red_band, re5_band, re6_band, aoi, tile_folder,
+            cache=None):
+    return index_f("IRECI", {"nir": nir_band, "red": red_band,
+                             "re5": re5_band, "re6": re6_band},
+                   aoi, tile_folder, cache)
 
 
 # function to calculate Forest Canopy Density
+@instrumented()
 def fcd_f(
         nir_band,
         red_band,
@@ -507,48 +1940,16 @@ def fcd_f(
         blue_band,
         swir11_band,
         aoi,
-        tile_folder):
-    nir, out_transform, out_meta = raster_mask(nir_band, aoi)
-    red = raster_mask(red_band, aoi)[0]
-    green = raster_mask(green_band, aoi)[0]
-    blue = raster_mask(blue_band, aoi)[0]
-    red = raster_mask(red_band, aoi)[0]
-    swir11 = raster_mask(swir11_band, aoi)[0]
-
-    # calculate the Advance Vegetation Index
-    avi = ((nir * (1.0 - red) * (nir - red)) ** (1.0 / 3.0))
-    avi_std = std_array(in_array=avi, d_min=-1.0, d_max=1.0)
-
-    # calculate the Bare Soil Index
-    bsi = ((swir11 + red) - (nir + blue)) / ((swir11 + red) + (nir + blue))
-    bsi_std = std_array(in_array=bsi, d_min=-1.0, d_max=1.0)
-
-    # calculate the Shadow Index
-    si = ((1.0 - blue) * (1.0 - green) * (1.0 - red)) ** (1.0 / 3.0)
-    si_std = std_array(in_array=si, d_min=0.0, d_max=1.0)
-
-    # calculate forest canopy density
-    fcd = (avi_std / (si_std * bsi_std))
-    fcd_std = std_array(in_array=fcd)
-
-    # categorising the fcd array for visualisation
-    classes = natural_breaks(fcd)
-    fcd[(fcd <= classes[30])] = 1.1
-    fcd[(fcd <= classes[50])] = 2
-    fcd[(fcd <= classes[60])] = 3
-    fcd[(fcd <= classes[75])] = 4
-    fcd[(fcd >= classes[75]) & (fcd <= 1.0)] = 5
-    fcd[(fcd == 1.1)] = 1
-
-    # rendering and tiling the raw index
-    ireci_img = raster_executor("raw_fcd.tif",
-                                fcd, out_transform,
-                                out_meta, "fcd_color.txt",
-                                tile_folder, "FCD")
-
-    return fcd_std
+        tile_folder,
+        cache=None):
+    return index_f("FCD", {"nir": nir_band, "red": red_band,
+                           "green": green_band, "blue": blue_band,
+                           "swir11": swir11_band},
+                   aoi, tile_folder, cache)
+
 
 # generate basemap tiles
+@instrumented()
 def rgb_tiles(tci_img, tile_root_folder, aoi):
     temp_img = os.path.join(tile_root_folder, os.path.basename(tci_img))
     p_aoi = proj_check(tci_img, aoi)
@@ -562,16 +1963,28 @@ def rgb_tiles(tci_img, tile_root_folder, aoi):
                          "transform": out_transform})
     with rasterio.open(temp_img, "w", **out_meta) as dest:
         dest.write(out_image)
-    options = {'zoom': (8, 18), 'resampling': 'near', 'webviewer': 'none'}
     basemap_folder = os.path.join(tile_root_folder, "BASEMAP")
     if not os.path.exists(basemap_folder):
         os.makedirs(basemap_folder)
-    gdal2tiles.generate_tiles(temp_img, basemap_folder, **options)
+    generate_tiles(temp_img, basemap_folder)
     os.remove(temp_img)
     return
 
 
+# indices combined into the yield propensity score
+YIELD_INDICES = ("wNDWI", "WDRVI", "EVI", "NDVI", "OSAVI", "PSRI", "IRECI",
+                 "FCD")
+
+
+# yield propensity from the standardised indices
+@instrumented(nested=False)
+def yield_propensity(wndwi, wdrvi, evi, ndvi, osavi, psri, ireci, fcd):
+    return (wndwi + wdrvi + ((0.5 * evi) + (0.5 * osavi)) + ndvi
+            + (ireci / psri) + fcd)
+
+
 # function to calculate yield propensity score
+@instrumented()
 def yield_f(
         nir_band,
         red_band,
@@ -581,23 +1994,49 @@ def yield_f(
         re6_band,
         swir11_band,
         aoi,
-        tile_folder):
-
-    # calculating the inputs for the Yield Propensity Score
-    out_transform = wndwi_f(nir_band, swir11_band, aoi, tile_folder)[2]
-    out_meta = wndwi_f(nir_band, swir11_band, aoi, tile_folder)[3]
-    wndwi = wndwi_f(nir_band, swir11_band, aoi, tile_folder)[1]
-    wdrvi = wdrvi_f(nir_band, red_band, aoi, tile_folder)[1]
-    evi = evi_f(nir_band, red_band, blue_band, aoi, tile_folder)[1]
-    ndvi = ndvi_f(nir_band, red_band, aoi, tile_folder)[1]
-    osavi = osavi_f(nir_band, red_band, aoi, tile_folder)[1]
-    psri = psri_f(red_band, blue_band, re6_band, aoi, tile_folder)[1]
-    ireci = ireci_f(nir_band, red_band, re5_band, re6_band, aoi, tile_folder)[1]
-    fcd = fcd_f(nir_band, red_band, green_band, blue_band, swir11_band, aoi, tile_folder)[1]
-    
+        tile_folder,
+        cache=None,
+        stream=False,
+        memory_limit=256 * 1024 ** 2,
+        workers=1):
+    """
+    cache           ->      optional BandCache, a new one is created for
+                            the job when none is given
+    workers         ->      processes finishing the indices, see indices_f
+    stream          ->      process the bands window by window with
+                            stream_indices, memory use then depends on
+                            memory_limit rather than on the AOI size
+    """
+    band_paths = {"nir": nir_band,
+                  "red": red_band,
+                  "green": green_band,
+                  "blue": blue_band,
+                  "re5": re5_band,
+                  "re6": re6_band,
+                  "swir11": swir11_band}
+    if stream:
+        return stream_indices(YIELD_INDICES, band_paths, aoi, tile_folder,
+                              with_yield=True, memory_limit=memory_limit)
+
+    own_cache = cache is None
+    if own_cache:
+        cache = BandCache()
+
+    # calculating the inputs for the Yield Propensity Score,
+    # all indices share their bands and are evaluated in a single pass
+    results = indices_f(YIELD_INDICES, band_paths, aoi, tile_folder, cache,
+                        workers)
+    if own_cache:
+        cache.clear()
+
+    out_transform, out_meta = results["wNDWI"][2:]
+    wndwi, wdrvi, evi, ndvi, osavi, psri, ireci, fcd = [
+        results[name][1] for name in YIELD_INDICES]
+
     # calculating the yield propensity
-    yield_prop = wndwi + wdrvi + ((0.5 * evi) + (0.5 * osavi)) + ndvi + (ireci / psri) + fcd
-    std_yield = std_array(in_array=yield_prop)
+    yield_prop = yield_propensity(wndwi, wdrvi, evi, ndvi, osavi, psri,
+                                  ireci, fcd)
+    std_yield = std_array(in_array=yield_prop, inplace=True)
 
     raster_executor(
         "raw_yield.tif",
@@ -611,6 +2050,249 @@ def yield_f(
     return
 
 
+# ---------------------
+# windowed processing
+
+
+# side of the square windows that keep layers float32 arrays within
+# memory_limit bytes
+def _block_side(memory_limit, layers):
+    side = int((memory_limit / (4.0 * layers)) ** 0.5)
+    return max(256, side // 256 * 256)
+
+
+# windows of at most block_size pixels covering a window
+def _sub_windows(window, block_size):
+    height, width = int(window.height), int(window.width)
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield rasterio.windows.Window(col, row,
+                                          min(block_size, width - col),
+                                          min(block_size, height - row))
+
+
+# merge the finite range of an array into a running (min, max)
+def _merge_range(d_range, in_array):
+    a_min, a_max = nan_range(in_array)
+    if np.isnan(a_min):
+        return d_range
+    return min(d_range[0], a_min), max(d_range[1], a_max)
+
+
+# calculate, classify and tile indices window by window
+@instrumented()
+def stream_indices(names, band_paths, aoi, tile_folder, with_yield=False,
+                   memory_limit=256 * 1024 ** 2, bins=512):
+    """
+    Streaming counterpart of indices_f for AOIs that do not fit in memory.
+    The bands are read, indexed, classified and written one window at a
+    time in three passes over temporary float32 rasters:
+        1. evaluate the indices and record their range
+        2. build the histograms for the breaks and sum the yield
+        3. classify the indices and standardise the yield
+
+    names           ->      names of registered indices, all bands must
+                            share the same grid
+    band_paths      ->      dictionary of band name to band file
+    aoi             ->      the estate AOI
+    tile_folder     ->      the base tile folder path
+    with_yield      ->      also create the yield propensity score, names
+                            must then be YIELD_INDICES
+    memory_limit    ->      bytes of window arrays held at any one time
+    bins            ->      histogram bins used for the jenks breaks
+
+    Returns a dictionary of index name (and YIELD) to the created image
+    """
+    needed = []
+    for name in names:
+        for band in INDEX_REGISTRY[name].bands:
+            if band not in needed:
+                needed.append(band)
+    specs = [INDEX_REGISTRY[name] for name in names]
+    layers = len(needed) + 2 * len(specs) + max(s.scratch for s in specs)
+    block_size = _block_side(memory_limit, layers)
+
+    temp = Path(work_dir())
+    geo_features = proj_check(band_paths[needed[0]], aoi)
+    sources = OrderedDict((band, rasterio.open(band_paths[band]))
+                          for band in needed)
+    try:
+        ref = sources[needed[0]]
+        for band, src in sources.items():
+            if src.transform != ref.transform or src.shape != ref.shape:
+                raise ValueError("{} is not on the grid of {}, run "
+                                 "raster_resampling first".format(
+                                     band_paths[band], band_paths[needed[0]]))
+
+        aoi_window = rasterio.features.geometry_window(ref, geo_features)
+        fill = ref.nodata or 0
+        out_meta = ref.meta.copy()
+        out_meta.update({'driver': 'GTiff',
+                         'count': 1,
+                         'dtype': 'float32',
+                         'nodata': None,
+                         'height': int(aoi_window.height),
+                         'width': int(aoi_window.width),
+                         'transform': ref.window_transform(aoi_window),
+                         'tiled': True,
+                         'blockxsize': 256,
+                         'blockysize': 256})
+
+        # pass 1, evaluate the indices window by window
+        value_files = OrderedDict((s.name, str(temp / "index_{}.tif".format(
+            s.name.lower()))) for s in specs)
+        ranges = {name: (np.inf, -np.inf) for name in names}
+        dests = {name: rasterio.open(path, "w", **out_meta)
+                 for name, path in value_files.items()}
+        try:
+            for window in _sub_windows(aoi_window, block_size):
+                src_window = rasterio.windows.Window(
+                    aoi_window.col_off + window.col_off,
+                    aoi_window.row_off + window.row_off,
+                    window.width, window.height)
+                outside = rasterio.features.geometry_mask(
+                    geo_features,
+                    out_shape=(int(window.height), int(window.width)),
+                    transform=ref.window_transform(src_window),
+                    all_touched=True)
+                bands = {}
+                for band, src in sources.items():
+                    b_array = src.read(1, window=src_window,
+                                       out_dtype=np.float32)
+                    b_array[outside] = fill
+                    b_array /= 10000
+                    bands[band] = b_array[None]
+                values = evaluate_indices(names, bands)
+                for name, index_array in values.items():
+                    ranges[name] = _merge_range(ranges[name], index_array)
+                    dests[name].write(index_array, window=window)
+                del bands, values
+        finally:
+            for dest in dests.values():
+                dest.close()
+    finally:
+        for src in sources.values():
+            src.close()
+
+    # pass 2, histograms for the breaks and the summed yield
+    edges = {}
+    counts = {}
+    sums = {}
+    for name in names:
+        if ranges[name][0] > ranges[name][1]:
+            ranges[name] = (0.0, 0.0)
+        counts[name] = np.zeros(bins)
+        sums[name] = np.zeros(bins)
+
+    yield_file = str(temp / "index_yield.tif")
+    yield_range = (np.inf, -np.inf)
+    readers = {name: rasterio.open(path)
+               for name, path in value_files.items()}
+    yield_dest = (rasterio.open(yield_file, "w", **out_meta)
+                  if with_yield else None)
+    try:
+        for window in _sub_windows(aoi_window, block_size):
+            stds = []
+            for spec in specs:
+                index_array = readers[spec.name].read(window=window)
+                w_counts, w_sums, edges[spec.name] = value_histogram(
+                    index_array[np.isfinite(index_array)], bins,
+                    *ranges[spec.name])
+                counts[spec.name] += w_counts
+                sums[spec.name] += w_sums
+                if with_yield:
+                    d_min, d_max = spec.std_range or ranges[spec.name]
+                    stds.append(std_array(index_array, d_min=d_min,
+                                          d_max=d_max, inplace=True))
+            if with_yield:
+                yield_prop = yield_propensity(*stds)
+                yield_range = _merge_range(yield_range, yield_prop)
+                yield_dest.write(yield_prop, window=window)
+    finally:
+        for reader in readers.values():
+            reader.close()
+        if yield_dest is not None:
+            yield_dest.close()
+
+    product = product_key(band_paths[needed[0]])
+    aoi_id = aoi_identity(aoi)
+    classes = {}
+    for name in names:
+        key = breaks_key(product, name, aoi_id)
+        classes[name] = BREAKS_CACHE.get(key)
+        if classes[name] is None:
+            classes[name] = histogram_breaks(counts[name], sums[name],
+                                             edges[name], 101,
+                                             *ranges[name])
+            if np.isfinite(classes[name][0]):
+                BREAKS_CACHE.put(key, classes[name])
+
+    # pass 3, classify the indices and standardise the yield
+    images = OrderedDict((s.name, str(temp / s.image)) for s in specs)
+    if with_yield:
+        images["YIELD"] = str(temp / "raw_yield.tif")
+        value_files["YIELD"] = yield_file
+    readers = {name: rasterio.open(path)
+               for name, path in value_files.items()}
+    # uint8 class rasters, the yield as an index image
+    image_meta = cog_meta(out_meta, out_meta['height'], out_meta['width'])
+    class_meta = cog_meta(out_meta, out_meta['height'], out_meta['width'],
+                          'uint8')
+    metas = {name: image_meta if name == "YIELD" else class_meta
+             for name in images}
+    scales = {}
+    if with_yield and image_meta['dtype'] == 'int16':
+        scales["YIELD"] = int16_scale(100)
+    staged = {name: temp_path(path, ".tmp.tif")
+              for name, path in images.items()}
+    yield_std_range = (np.inf, -np.inf)
+    dests = {name: rasterio.open(path, "w", **_staged(metas[name]))
+             for name, path in staged.items()}
+    try:
+        for spec in specs:
+            dests[spec.name].write_colormap(1, _colormap(class_palette(
+                str(Path.cwd() / "ramps" / spec.ramp))))
+        for window in _sub_windows(aoi_window, block_size):
+            for name in images:
+                index_array = readers[name].read(window=window)
+                if name == "YIELD":
+                    std_array(index_array, d_min=yield_range[0],
+                              d_max=yield_range[1], inplace=True)
+                    yield_std_range = _merge_range(yield_std_range,
+                                                   index_array)
+                    dests[name].write(_encode(index_array,
+                                              image_meta['dtype'],
+                                              scales.get(name)),
+                                      window=window)
+                else:
+                    dests[name].write(classify_index(index_array,
+                                                     classes[name]),
+                                      window=window)
+        if "YIELD" in scales:
+            dests["YIELD"].scales = (1 / scales["YIELD"],)
+    finally:
+        for handle in list(readers.values()) + list(dests.values()):
+            handle.close()
+    for path in value_files.values():
+        os.remove(path)
+    for name, path in images.items():
+        if name == "YIELD":
+            _finish_cog(staged[name], path, image_meta, 'average',
+                        yield_std_range)
+        else:
+            _finish_cog(staged[name], path, class_meta)
+
+    # rendering and tiling the images
+    for spec in specs:
+        image_tiler(images[spec.name], spec.ramp, tile_folder, spec.folder,
+                    block_size=block_size)
+    if with_yield:
+        image_tiler(images["YIELD"], "yield_color.txt", tile_folder, "YIELD",
+                    block_size=block_size)
+
+    return images
+
+
 # ---------------------
 
 # ignore errors related to dividing null raster regions
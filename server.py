@@ -0,0 +1,82 @@
+"""
+Description     : Serving of the bottle apps. ADATOS_SERVER selects the
+                  development server (dev, with the reloader when
+                  ADATOS_RELOADER=1), a multi-threaded waitress server
+                  (threaded) or gunicorn processes with worker threads
+                  (processes). The production servers keep connections
+                  alive and serve compact JSON
+Libraries       : bottle, functools, json, os
+"""
+
+
+from functools import partial
+import json
+import os
+
+import bottle
+# ---------------------
+
+
+SERVER = os.environ.get('ADATOS_SERVER', 'dev')
+RELOADER = os.environ.get('ADATOS_RELOADER', '0') == '1'
+HOST = os.environ.get('ADATOS_HOST', 'localhost')
+PORT = int(os.environ.get('ADATOS_PORT', 8000))
+THREADS = int(os.environ.get('ADATOS_THREADS', 8))
+PROCESSES = int(os.environ.get('ADATOS_PROCESSES', os.cpu_count() or 1))
+KEEPALIVE = int(os.environ.get('ADATOS_KEEPALIVE', 5))
+
+
+# serve dict responses without the whitespace of the default encoder
+def compact_json(app):
+    app.uninstall(bottle.JSONPlugin)
+    app.install(bottle.JSONPlugin(
+        json_dumps=partial(json.dumps, separators=(',', ':'))))
+    return app
+
+
+# run an app with the configured server
+def serve(app=None, host=None, port=None, mode=None, on_start=None):
+    """
+    app             ->      the bottle app, the default app when None
+    mode            ->      dev, threaded or processes, ADATOS_SERVER when
+                            None
+    on_start        ->      function() starting the background work of the
+                            app (e.g. the job workers) once in every
+                            process serving requests
+    """
+    app = app or bottle.default_app()
+    host = host or HOST
+    port = port or PORT
+    mode = mode or SERVER
+
+    if mode == 'dev':
+        # with the reloader only the child process serves requests
+        if on_start is not None and (not RELOADER
+                                     or os.environ.get('BOTTLE_CHILD')):
+            on_start()
+        bottle.run(app, host=host, port=port, reloader=RELOADER, debug=True)
+        return
+
+    bottle.debug(False)
+    compact_json(app)
+    if mode == 'threaded':
+        if on_start is not None:
+            on_start()
+        # waitress keeps HTTP/1.1 connections alive by default
+        bottle.run(app, server='waitress', host=host, port=port,
+                   threads=THREADS, channel_timeout=KEEPALIVE * 12)
+    elif mode == 'processes':
+        options = {'workers': PROCESSES, 'worker_class': 'gthread',
+                   'threads': THREADS, 'keepalive': KEEPALIVE}
+        if on_start is not None:
+            # threads do not survive the fork, so start in every worker;
+            # what the workers share on disk is guarded by file locks.
+            # What they keep in memory is per worker: a job is queued in
+            # the worker that accepted it, the queue size and the /metrics
+            # counters are those of one worker, and the jobs of a worker
+            # that died are only failed when its replacement starts
+            options['post_fork'] = lambda server, worker: on_start()
+        bottle.run(app, server='gunicorn', host=host, port=port, **options)
+    else:
+        raise ValueError("unknown ADATOS_SERVER {}, expected dev, threaded "
+                         "or processes".format(mode))
@@ -0,0 +1,87 @@
+"""
+Description     : Checks that clipping bands through the AOI service, with
+                  its cached reprojections and masks, gives the clip of the
+                  baseline: the AOI reprojected with geopandas for every
+                  band and rasterio.mask.mask with crop and all_touched
+Libraries       : geopandas, json, numpy, pytest, rasterio
+"""
+
+
+import json
+import os
+import sys
+
+import geopandas
+import numpy as np
+import pytest
+import rasterio
+import rasterio.mask
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+import sentinel2index_py3 as s2  # noqa: E402
+from synthetic import make_dataset  # noqa: E402
+# ---------------------
+
+
+# the per request clip of the baseline raster_mask
+def baseline_clip(raster, vector):
+    with rasterio.open(raster) as src:
+        r_crs = src.crs.to_epsg()
+    aoi = geopandas.read_file(vector)
+    if aoi.crs.to_epsg() != r_crs:
+        aoi = aoi.to_crs(epsg=r_crs)
+    geo_features = [feature["geometry"]
+                    for feature in json.loads(aoi.to_json())["features"]]
+    with rasterio.open(raster) as src:
+        out_img, out_transform = rasterio.mask.mask(src, geo_features,
+                                                    crop=True,
+                                                    all_touched=True)
+        return out_img.astype(float) / 10000, out_transform
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("aoi")
+    dataset = make_dataset(str(folder), 200)
+    # the same estate in geographic coordinates
+    geographic = str(folder / "aoi_4326.shp")
+    geopandas.read_file(dataset["aoi"]).to_crs(epsg=4326).to_file(geographic)
+    dataset["aoi_4326"] = geographic
+    return dataset
+
+
+@pytest.fixture
+def service(monkeypatch):
+    service = s2.AoiService()
+    monkeypatch.setattr(s2, "AOI_SERVICE", service)
+    return service
+
+
+@pytest.mark.parametrize("aoi", ["aoi", "aoi_4326"])
+def test_clip_matches_the_baseline(dataset, service, aoi):
+    for name in ("nir", "red", "re5"):
+        raster = dataset["bands"][name]
+        expected, expected_transform = baseline_clip(raster, dataset[aoi])
+        for repeat in range(2):
+            out_img, out_transform, out_meta = s2.raster_mask(raster,
+                                                              dataset[aoi])
+            assert out_transform == expected_transform
+            assert out_img.shape == expected.shape
+            np.testing.assert_allclose(out_img, expected, rtol=1e-6)
+    # the boundary as read and in the crs of the bands, one mask of the
+    # grid, shared by the bands
+    assert len(service._geometries) == 2
+    assert len(service._masks) == 1
+
+
+def test_evicted_masks_are_rebuilt(dataset, service):
+    service.max_mask_bytes = 1
+    raster = dataset["bands"]["nir"]
+    expected, expected_transform = baseline_clip(raster, dataset["aoi"])
+    for repeat in range(2):
+        out_img, out_transform, out_meta = s2.raster_mask(raster,
+                                                          dataset["aoi"])
+        np.testing.assert_allclose(out_img, expected, rtol=1e-6)
+    assert service.mask_bytes == 0 and not service._masks
@@ -0,0 +1,65 @@
+"""
+Description     : Checks of the breaks engines and of the breaks cache,
+                  which keeps at most max_entries breaks, evicting the
+                  least recently used ones, in memory and in the json file
+                  it is persisted to
+Libraries       : numpy, pytest
+"""
+
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sentinel2index_py3 as s2  # noqa: E402
+# ---------------------
+
+
+@pytest.mark.parametrize("method", sorted(s2.BREAKS_ENGINES))
+def test_every_engine_breaks_the_values(method):
+    values = np.random.default_rng(0).normal(0.4, 0.2, (200, 150))
+    values = values.astype(np.float32)
+    values[:10] = np.nan
+    breaks = s2.natural_breaks(values, n_classes=5, method=method,
+                               cache=None, sample_size=2000)
+    finite = values[np.isfinite(values)]
+    assert len(breaks) == 6
+    assert np.all(np.diff(breaks) >= 0)
+    # the sampled engine may not reach the extremes
+    assert finite.min() <= breaks[0] < breaks[-1] <= finite.max()
+    # the same seed gives the same breaks
+    assert breaks == s2.natural_breaks(values, n_classes=5, method=method,
+                                       cache=None, sample_size=2000)
+
+
+def key(product):
+    return s2.breaks_key(product, "NDVI", "aoi")
+
+
+def test_least_recently_used_breaks_are_evicted():
+    cache = s2.BreaksCache(max_entries=2)
+    cache.put(key("P1"), [0, 1])
+    cache.put(key("P2"), [0, 2])
+    # P1 becomes the most recently used
+    assert cache.get(key("P1")) == [0.0, 1.0]
+    cache.put(key("P3"), [0, 3])
+    assert len(cache) == 2
+    assert cache.get(key("P2")) is None
+    assert cache.get(key("P1")) == [0.0, 1.0]
+
+
+def test_persisted_cache_keeps_its_bound(tmp_path):
+    path = str(tmp_path / "breaks.json")
+    cache = s2.BreaksCache(path, max_entries=3)
+    for product in ("P1", "P2", "P3"):
+        cache.put(key(product), [0, 1])
+    cache.get(key("P1"))
+    cache.put(key("P1"), [0, 1])
+
+    reloaded = s2.BreaksCache(path, max_entries=2)
+    assert len(reloaded) == 2
+    assert reloaded.get(key("P2")) is None
+    assert reloaded.get(key("P1")) == [0.0, 1.0]
@@ -0,0 +1,102 @@
+"""
+Description     : Checks of the one pass classification into uint8 class
+                  rasters against the float classes of the baseline, and of
+                  the palette written with the class raster
+Libraries       : numpy, pytest, rasterio
+"""
+
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sentinel2index_py3 as s2  # noqa: E402
+# ---------------------
+
+
+RAMP = ("nv 0 0 0 0\n"
+        "0% 215 25 28\n"
+        "25% 253 174 97\n"
+        "50% 255 255 191\n"
+        "75% 166 217 106\n"
+        "100% 26 150 65\n")
+
+
+# the classification of the baseline index functions, in place on a copy
+def baseline_classes(index, classes):
+    index = index.copy()
+    index[(index <= classes[30])] = 1.1
+    index[(index <= classes[50])] = 2
+    index[(index <= classes[60])] = 3
+    index[(index <= classes[75])] = 4
+    index[(index >= classes[75]) & (index <= 1.0)] = 5
+    index[(index == 1.1)] = 1
+    return index
+
+
+@pytest.fixture
+def index():
+    rng = np.random.default_rng(0)
+    index = rng.uniform(-1, 1, (300, 200)).astype(np.float32)
+    index[:5] = np.nan
+    index[5:10] = rng.uniform(1, 3, (5, 200))
+    index[10:15] = rng.uniform(-5, -1, (5, 200))
+    return index
+
+
+@pytest.fixture
+def classes(index):
+    finite = index[np.isfinite(index) & (index <= 1) & (index >= -1)]
+    return s2.natural_breaks(finite, method="quantile", cache=None)
+
+
+def test_classes_match_the_baseline(index, classes):
+    # values on the breaks close their class
+    bounds = [classes[i] for i in s2.CLASS_BOUNDS]
+    index[20, :4] = bounds
+    index[21, :4] = np.nextafter(np.float32(bounds), np.float32(np.inf))
+
+    expected = baseline_classes(index, classes)
+    before = index.copy()
+    out = s2.classify_index(index, classes, chunk_rows=7)
+    assert out.dtype == np.uint8
+
+    classified = np.isfinite(index) & (index <= 1.0)
+    assert (out[classified] == expected[classified]).all()
+    assert list(out[20, :4]) == [1, 2, 3, 4]
+    assert list(out[21, :4]) == [2, 3, 4, 5]
+    assert (out[np.isnan(index)] == s2.CLASS_NODATA).all()
+    # the baseline left values above 1 unclassified, they are class 5
+    assert (out[index > 1.0] == 5).all()
+    np.testing.assert_array_equal(index, before)
+
+
+def test_class_raster_palette(tmp_path, index, classes):
+    ramp = tmp_path / "ramp.txt"
+    ramp.write_text(RAMP)
+    class_array = s2.classify_index(index, classes)
+    palette = s2.class_palette(str(ramp))
+    meta = {'driver': 'GTiff', 'crs': 'EPSG:32648', 'height': 300,
+            'width': 200, 'count': 1, 'dtype': 'float32', 'nodata': None}
+    path = str(tmp_path / "classes.tif")
+    s2.imager(class_array, from_origin(500000, 1000000, 10, 10), meta, path,
+              palette=palette)
+
+    with rasterio.open(path) as src:
+        assert src.dtypes[0] == 'uint8'
+        assert src.nodata == s2.CLASS_NODATA
+        assert (src.read(1) == class_array).all()
+        colormap = src.colormap(1)
+
+    # the colors the baseline gave its float classes 1 to 5
+    levels = np.arange(1, s2.N_CLASSES + 1, dtype=np.float32)[None]
+    rendered = s2.render_array(levels, str(ramp), alpha=True)[:, 0].T
+    for c in range(1, s2.N_CLASSES + 1):
+        assert colormap[c] == tuple(rendered[c - 1])
+        assert tuple(palette[c]) == tuple(rendered[c - 1])
+    assert colormap[s2.CLASS_NODATA] == (0, 0, 0, 0)
@@ -0,0 +1,104 @@
+"""
+Description     : Checks that the float32 formulas of the index registry
+                  agree with the float64 formulas of the baseline index
+                  functions, zero denominators included
+Libraries       : numpy, pytest
+"""
+
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sentinel2index_py3 as s2  # noqa: E402
+# ---------------------
+
+
+# reflectance ranges of the synthetic bands
+RANGES = {"blue": (0.01, 0.1), "green": (0.02, 0.15), "red": (0.02, 0.2),
+          "re5": (0.05, 0.3), "re6": (0.1, 0.5), "nir": (0.1, 0.6),
+          "swir11": (0.05, 0.4)}
+
+
+def std(values, d_min=None, d_max=None, f_min=0, f_max=100):
+    if d_min is None:
+        d_min = np.min(values)
+    if d_max is None:
+        d_max = np.amax(values)
+    return (values - d_min) / (d_max - d_min) * (f_max - f_min) + f_min
+
+
+# the formulas of the baseline index functions
+def fcd(b):
+    avi = (b["nir"] * (1.0 - b["red"]) * (b["nir"] - b["red"])) ** (1.0 / 3.0)
+    bsi = (((b["swir11"] + b["red"]) - (b["nir"] + b["blue"]))
+           / ((b["swir11"] + b["red"]) + (b["nir"] + b["blue"])))
+    si = ((1.0 - b["blue"]) * (1.0 - b["green"])
+          * (1.0 - b["red"])) ** (1.0 / 3.0)
+    return (std(avi, -1.0, 1.0)
+            / (std(si, 0.0, 1.0) * std(bsi, -1.0, 1.0)))
+
+
+BASELINE = {
+    "wNDWI": lambda b: ((2 * b["nir"] - b["swir11"])
+                        / (2 * b["nir"] + b["swir11"])),
+    "WDRVI": lambda b: ((0.2 * b["nir"] - b["red"])
+                        / (0.2 * b["nir"] + b["red"])),
+    "EVI": lambda b: ((2.5 * (b["nir"] - b["red"]))
+                      / (b["nir"] + (6 * b["red"]) - (7.5 * b["blue"])
+                         + 1.0)),
+    "NDVI": lambda b: (b["nir"] - b["red"]) / (b["nir"] + b["red"]),
+    "OSAVI": lambda b: (b["nir"] - b["red"]) / (b["nir"] + b["red"] + 0.16),
+    "PSRI": lambda b: (b["red"] - b["blue"]) / b["re6"],
+    "IRECI": lambda b: (b["nir"] - b["red"]) / (b["re5"] / b["re6"]),
+    "FCD": fcd}
+
+
+@pytest.fixture
+def bands():
+    rng = np.random.default_rng(0)
+    bands = {name: rng.uniform(low, high, (120, 90)).astype(np.float32)
+             for name, (low, high) in RANGES.items()}
+    # zero denominators, with values exact in float32
+    zero = {(0, 0): {"nir": 0.0, "red": 0.0, "swir11": 0.0},
+            (0, 1): {"nir": 0.5, "red": 0.375, "blue": 0.5},
+            (0, 2): {"re6": 0.0},
+            (0, 3): {"re5": 0.0},
+            (0, 4): {"red": 0.25, "blue": 0.25, "re6": 0.0}}
+    for pixel, values in zero.items():
+        for name, value in values.items():
+            bands[name][pixel] = value
+    return bands
+
+
+def test_registry_is_the_baseline():
+    assert set(s2.INDEX_REGISTRY) == set(BASELINE)
+
+
+@pytest.mark.parametrize("name", sorted(BASELINE))
+def test_index_matches_the_baseline(bands, name):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = BASELINE[name]({band: values.astype(np.float64)
+                                   for band, values in bands.items()})
+        actual = s2.evaluate_indices([name], bands, block_rows=32)[name]
+    assert actual.dtype == np.float32
+
+    for special in (np.isnan, np.isposinf, np.isneginf):
+        np.testing.assert_array_equal(special(actual), special(expected))
+    finite = np.isfinite(expected)
+    np.testing.assert_allclose(actual[finite], expected[finite],
+                               rtol=1e-4, atol=1e-5)
+
+
+def test_zero_denominators(bands):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        indices = s2.evaluate_indices(list(BASELINE), bands)
+    assert np.isnan(indices["NDVI"][0, 0])
+    assert np.isnan(indices["wNDWI"][0, 0])
+    assert np.isinf(indices["EVI"][0, 1])
+    assert np.isinf(indices["PSRI"][0, 2])
+    assert np.isinf(indices["IRECI"][0, 3])
+    assert np.isnan(indices["PSRI"][0, 4])
@@ -0,0 +1,53 @@
+"""
+Description     : Checks that the kernels run once per block, e.g.
+                  std_array, are timed as a stage of their own only when
+                  called outside the stages of the pipeline
+Libraries       : numpy, pytest
+"""
+
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+from instrumentation import trace  # noqa: E402
+import sentinel2index_py3 as s2  # noqa: E402
+from synthetic import make_dataset  # noqa: E402
+# ---------------------
+
+
+KERNELS = {"std_array", "classify_index", "yield_propensity",
+           "evaluate_indices"}
+
+
+@pytest.fixture
+def scene(tmp_path, monkeypatch):
+    dataset = make_dataset(str(tmp_path), size=600)
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(s2, "PRETILE", False)
+    return dataset
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_no_span_per_block(scene, tmp_path, stream):
+    bands = scene["bands"]
+    with trace() as spans, s2.job_work_dir(str(tmp_path / "job")):
+        # windows of 256 pixels, several blocks over the scene
+        s2.yield_f(bands["nir"], bands["red"], bands["green"],
+                   bands["blue"], bands["re5"], bands["re6"],
+                   bands["swir11"], scene["aoi"], scene["tiles"],
+                   stream=stream, memory_limit=1024 ** 2)
+    names = [record["name"] for record in spans]
+    assert "yield_f" in names
+    assert not KERNELS & set(names)
+
+
+def test_kernel_called_alone_is_a_stage():
+    with trace() as spans:
+        s2.std_array(np.zeros((2, 2), dtype=np.float32), -1.0, 1.0)
+    assert [record["name"] for record in spans] == ["std_array"]
@@ -0,0 +1,102 @@
+"""
+Description     : Checks of the job planner: duplicate data_s2 products
+                  collapse to one download, analyses share their indices
+                  and band reads, and the requested, planned and saved
+                  counts of every stage
+Libraries       : pytest
+"""
+
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from job_planner import parse_product, plan_job  # noqa: E402
+from sentinel2index_py3 import (INDEX_BANDS, INDEX_REGISTRY,  # noqa: E402
+                                YIELD_INDICES)
+# ---------------------
+
+
+L1C = "S2A_MSIL1C_20180903T031541_N0206_R118_T48NUH_20180903T061615"
+L2A = "S2B_MSIL2A_20180908T031539_N0206_R118_T48NUH_20180908T071234"
+
+
+def entry(product_name, **tile):
+    return dict({"product_name": product_name}, **tile)
+
+
+def bands_of(name):
+    return [INDEX_BANDS[band][0] for band in INDEX_REGISTRY[name].bands]
+
+
+def test_duplicate_products_are_planned_once():
+    plan = plan_job({"data_s2": [entry(L1C), entry(L1C, utm_zone=48),
+                                 entry(L2A)],
+                     "analysis_key": ["flood_risk", "foilar_moisture"]})
+    assert list(plan.products) == [L1C, L2A]
+    assert [record.product_name for record in plan.downloads] == [L1C, L2A]
+    assert [record.product_name for record in plan.sen2cor] == [L1C]
+    # both analyses need wNDWI, computed once per product
+    assert plan.indices == ["wNDWI"]
+    assert plan.band_reads == bands_of("wNDWI")
+    assert not plan.yield_score and plan.unknown == []
+
+    summary = plan.summary()
+    assert summary["requested"] == {"downloads": 3, "sen2cor_runs": 2,
+                                    "band_reads": 2 * 2 * 3,
+                                    "index_computations": 2 * 3}
+    assert summary["planned"] == {"downloads": 2, "sen2cor_runs": 1,
+                                  "band_reads": 2 * 2,
+                                  "index_computations": 2}
+    assert summary["saved"] == {"downloads": 1, "sen2cor_runs": 1,
+                                "band_reads": 8, "index_computations": 4}
+
+
+def test_yield_shares_its_components():
+    plan = plan_job({"data_s2": [entry(L1C), entry(L1C)],
+                     "analysis_key": ["flood_risk", "plant_productivity",
+                                      "no_such_script"]})
+    assert plan.analyses == {"flood_risk": ["wNDWI"],
+                             "plant_productivity": ["YIELD"]}
+    assert plan.unknown == ["no_such_script"]
+    assert plan.yield_score
+    assert set(plan.indices) == set(YIELD_INDICES)
+    assert len(plan.indices) == len(YIELD_INDICES)
+    bands = set(band for name in YIELD_INDICES for band in bands_of(name))
+    assert sorted(plan.band_reads) == sorted(bands)
+
+    naive_reads = (len(bands_of("wNDWI"))
+                   + sum(len(bands_of(name)) for name in YIELD_INDICES))
+    summary = plan.summary()
+    assert summary["requested"]["index_computations"] == (
+        (1 + len(YIELD_INDICES)) * 2)
+    assert summary["requested"]["band_reads"] == naive_reads * 2
+    assert summary["planned"] == {"downloads": 1, "sen2cor_runs": 1,
+                                  "band_reads": len(bands),
+                                  "index_computations": len(YIELD_INDICES)}
+
+
+def test_known_analyses_from_the_scripts():
+    req = {"data_s2": [entry(L2A)],
+           "analysis_key": ["vigour", "needs_missing_index", "flood_risk"]}
+    plan = plan_job(req, {"vigour": ("NDVI", "EVI"),
+                          "needs_missing_index": ("NDRE",)})
+    assert plan.analyses == {"vigour": ["NDVI", "EVI"]}
+    assert plan.unknown == ["needs_missing_index", "flood_risk"]
+    assert plan.sen2cor == []
+    assert plan.to_dict()["unknown_analyses"] == plan.unknown
+
+
+def test_parse_product():
+    record = parse_product(entry(L1C, utm_zone=48, latitude_band="N",
+                                 grid_square="UH"))
+    assert (record.level, record.tile, record.date, record.orbit) == (
+        "L1C", "48NUH", "2018-09-03", 118)
+    assert parse_product(L1C + ".SAFE").tile == "48NUH"
+    with pytest.raises(ValueError):
+        parse_product(entry(L1C, utm_zone=47))
+    with pytest.raises(ValueError):
+        plan_job({"data_s2": [entry("not_a_product")],
+                  "analysis_key": ["flood_risk"]})
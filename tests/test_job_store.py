@@ -0,0 +1,143 @@
+"""
+Description     : Checks of the SQLite stores: jobs listed newest first
+                  page by page with filters, jobs left queued or running
+                  failed on restart or when their worker process exited,
+                  and the crud resources paginated in insertion order
+Libraries       : pytest, sqlite3, subprocess
+"""
+
+
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from job_queue import Job  # noqa: E402
+from job_store import JobStore, ResourceStore  # noqa: E402
+# ---------------------
+
+
+def new_job(organization, region="Johor", status="queued"):
+    job = Job({"job_id": "tasking-1", "organization_key": organization,
+               "region_key": region})
+    job.status = status
+    return job
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.db"))
+
+
+def pages(store, limit, **filters):
+    listed, cursor = [], None
+    while True:
+        page, cursor = store.list(limit=limit, cursor=cursor, **filters)
+        listed.append([job["job_id"] for job in page])
+        if cursor is None:
+            return listed
+
+
+def test_pages_newest_first(store):
+    jobs = [new_job("org{}".format(i % 2)) for i in range(7)]
+    for job in jobs:
+        store.save(job)
+    newest = [job.id for job in reversed(jobs)]
+
+    assert pages(store, 3) == [newest[:3], newest[3:6], newest[6:]]
+    assert pages(store, 7) == [newest]
+    assert pages(store, 2, organization="org0") == [
+        [jobs[6].id, jobs[4].id], [jobs[2].id, jobs[0].id]]
+    assert pages(store, 10, region="elsewhere") == [[]]
+
+
+def test_saved_updates_are_listed(store):
+    job = new_job("org0")
+    store.save(job)
+    job.status, job.result = "done", {"layers": {"P1": "job-P1"}}
+    store.save(job)
+
+    saved = store.get(job.id)
+    assert saved["status"] == "done"
+    assert saved["result"] == {"layers": {"P1": "job-P1"}}
+    assert saved["tasking_job_id"] == "tasking-1"
+    assert pages(store, 5, status="done") == [[job.id]]
+    assert pages(store, 5, status="queued") == [[]]
+    assert store.counts() == {"done": 1}
+    assert store.get("missing") is None
+
+
+def test_interrupt_on_restart(store, tmp_path):
+    statuses = ("queued", "running", "done", "failed")
+    jobs = {status: new_job("org0", status=status) for status in statuses}
+    for job in jobs.values():
+        store.save(job)
+
+    # a new process opens the same database
+    restarted = JobStore(str(tmp_path / "jobs.db"))
+    assert restarted.interrupt() == 2
+    for status in ("queued", "running"):
+        job = restarted.get(jobs[status].id)
+        assert job["status"] == "failed"
+        assert job["error"] == "interrupted by a restart"
+    assert restarted.get(jobs["done"].id)["status"] == "done"
+    assert restarted.counts() == {"done": 1, "failed": 3}
+    assert restarted.interrupt() == 0
+
+
+def test_interrupt_dead_workers(store, tmp_path):
+    live = new_job("org0")
+    store.save(live)
+    # a worker process that has exited since queueing its jobs
+    worker = subprocess.Popen([sys.executable, "-c", "pass"])
+    worker.wait()
+    dead = [new_job("org1"), new_job("org1", status="running"),
+            new_job("org1", status="done")]
+    for job in dead:
+        store.save(job)
+    with sqlite3.connect(str(tmp_path / "jobs.db")) as connection:
+        connection.execute("UPDATE jobs SET worker = ? WHERE id IN (?, ?, ?)",
+                           [worker.pid] + [job.id for job in dead])
+
+    assert store.interrupt(dead_only=True) == 2
+    assert store.get(live.id)["status"] == "queued"
+    assert [store.get(job.id)["status"] for job in dead] == [
+        "failed", "failed", "done"]
+    assert store.interrupt(dead_only=True) == 0
+
+
+def test_worker_column_added(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    with sqlite3.connect(path) as connection:
+        connection.execute(JobStore.schema[0].replace(
+            ",\n               worker INTEGER", ""))
+    store = JobStore(path)
+    job = new_job("org0")
+    store.save(job)
+    assert store.get(job.id)["status"] == "queued"
+    assert store.interrupt(dead_only=True) == 0
+
+
+def test_resources_in_insertion_order(tmp_path):
+    path = str(tmp_path / "crud.db")
+    animals = ResourceStore(path, "animals")
+    plants = ResourceStore(path, "plants")
+    for i in range(5):
+        animals.put("a{}".format(i), {"name": "a{}".format(i)})
+    plants.put("p0", {"name": "p0"})
+    animals.put("a1", {"name": "a1", "legs": 4})
+
+    listed, cursor = [], None
+    while True:
+        page, cursor = animals.list(limit=2, cursor=cursor)
+        listed.append(page)
+        if cursor is None:
+            break
+    assert [[item["name"] for item in page] for page in listed] == [
+        ["a0", "a1"], ["a2", "a3"], ["a4"]]
+    assert listed[0][1] == {"name": "a1", "legs": 4}
+    assert len(animals) == 5 and len(plants) == 1
+    assert plants.get("a0") is None
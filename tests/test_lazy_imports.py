@@ -0,0 +1,47 @@
+"""
+Description     : Checks that the modules main.py imports at startup leave
+                  the geo libraries to the lazy proxies of
+                  sentinel2index_py3, so the server starts without them
+Libraries       : ast, json, subprocess
+"""
+
+
+import ast
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# ---------------------
+
+
+HEAVY = ("fiona", "gdal2tiles", "jenkspy", "osgeo", "rasterio")
+
+
+# the top level modules main.py imports
+def startup_modules():
+    with open(os.path.join(ROOT, "main.py")) as src:
+        tree = ast.parse(src.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules.append(node.module)
+    return modules
+
+
+def test_startup_imports_no_geo_library():
+    modules = startup_modules()
+    assert "tile_server" in modules and "sentinel2index_py3" in modules
+    script = ("import importlib, json, sys\n"
+              "for name in {!r}:\n"
+              "    importlib.import_module(name)\n"
+              "print(json.dumps([name for name in {!r}\n"
+              "                  if name in sys.modules]))\n").format(
+                  modules, HEAVY)
+    reply = subprocess.run([sys.executable, "-c", script], cwd=ROOT,
+                           stdout=subprocess.PIPE, check=True,
+                           universal_newlines=True)
+    assert json.loads(reply.stdout.strip().splitlines()[-1]) == []
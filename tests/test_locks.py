@@ -0,0 +1,42 @@
+"""
+Description     : Checks of the atomic writes shared by the catalogs,
+                  caches, traces and stores
+Libraries       : pytest
+"""
+
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from locks import atomic_write  # noqa: E402
+# ---------------------
+
+
+def test_atomic_write_replaces_the_file(tmp_path):
+    path = str(tmp_path / "index.json")
+    with open(path, "w") as dst:
+        dst.write("old")
+    with atomic_write(path) as dst:
+        dst.write("new")
+        # the previous content is readable until the block completes
+        with open(path) as src:
+            assert src.read() == "old"
+    with open(path) as src:
+        assert src.read() == "new"
+    assert os.listdir(str(tmp_path)) == ["index.json"]
+
+
+def test_failed_write_keeps_the_file(tmp_path):
+    path = str(tmp_path / "tile.png")
+    with open(path, "wb") as dst:
+        dst.write(b"old")
+    with pytest.raises(ValueError):
+        with atomic_write(path, "wb") as dst:
+            dst.write(b"partial")
+            raise ValueError("encoding failed")
+    with open(path, "rb") as src:
+        assert src.read() == b"old"
+    assert os.listdir(str(tmp_path)) == ["tile.png"]
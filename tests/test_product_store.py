@@ -0,0 +1,204 @@
+"""
+Description     : Tests of the product store against a local folder of
+                  SAFE products: resumed downloads, the atomic move into
+                  the store, size based LRU eviction with pinned products
+                  and concurrent requests for one product, from threads
+                  and from processes
+Libraries       : multiprocessing, os, pytest, threading, time
+"""
+
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from product_store import LocalBackend, ProductStore  # noqa: E402
+# ---------------------
+
+
+FILES = {"manifest.safe": 1000,
+         os.path.join("GRANULE", "IMG_DATA", "B04.jp2"): 3000}
+PRODUCT_BYTES = sum(FILES.values())
+
+
+def content(product_id, path, size):
+    seed = "{}/{}".format(product_id, path).encode()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+# a LocalBackend counting its listings and the offsets it fetches from
+class CountingBackend(LocalBackend):
+
+    def __init__(self, root, on_fetch=None):
+        super(CountingBackend, self).__init__(root, chunk_size=512)
+        self.on_fetch = on_fetch
+        self.listed = []
+        self.fetched = []
+        self._lock = threading.Lock()
+
+    def list_files(self, product_id):
+        with self._lock:
+            self.listed.append(product_id)
+        return super(CountingBackend, self).list_files(product_id)
+
+    def fetch(self, product_id, path, dst, offset=0):
+        with self._lock:
+            self.fetched.append((product_id, path, offset))
+        if self.on_fetch is not None:
+            self.on_fetch(product_id, path)
+        super(CountingBackend, self).fetch(product_id, path, dst, offset)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    root = tmp_path / "remote"
+    for product_id in ("P1", "P2", "P3"):
+        for path, size in FILES.items():
+            target = root / "{}.SAFE".format(product_id) / path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(content(product_id, path, size))
+    return str(root)
+
+
+def new_store(tmp_path, backend, products=3):
+    return ProductStore(str(tmp_path / "store"), backend,
+                        max_bytes=products * PRODUCT_BYTES, workers=2)
+
+
+def assert_complete(folder, product_id):
+    for path, size in FILES.items():
+        with open(os.path.join(folder, path), "rb") as src:
+            assert src.read() == content(product_id, path, size)
+    for root, dirs, files in os.walk(folder):
+        assert not [name for name in files if name.endswith(".part")]
+
+
+def test_resume_from_part(tmp_path, remote):
+    backend = CountingBackend(remote)
+    store = new_store(tmp_path, backend)
+    path = os.path.join("GRANULE", "IMG_DATA", "B04.jp2")
+    part = os.path.join(store.root, ".incoming", "P1.SAFE", path + ".part")
+    os.makedirs(os.path.dirname(part))
+    with open(part, "wb") as dst:
+        dst.write(content("P1", path, FILES[path])[:1200])
+
+    assert_complete(store.get("P1"), "P1")
+    assert ("P1", path, 1200) in backend.fetched
+    assert ("P1", path, 0) not in backend.fetched
+
+
+def test_atomic_move_into_store(tmp_path, remote):
+    seen = []
+
+    def on_fetch(product_id, path):
+        # nothing of the product is visible before every file is fetched
+        seen.append(os.path.exists(store.path(product_id)))
+
+    store = new_store(tmp_path, CountingBackend(remote, on_fetch))
+    folder = store.get("P1")
+    assert seen and not any(seen)
+    assert folder == store.path("P1")
+    assert_complete(folder, "P1")
+    assert not os.path.exists(os.path.join(store.root, ".incoming",
+                                           "P1.SAFE"))
+    assert "P1" in ProductStore(store.root, store.backend)
+
+
+def test_lru_eviction(tmp_path, remote):
+    store = new_store(tmp_path, CountingBackend(remote), products=2)
+    store.get("P1")
+    store.get("P2")
+    # P1 becomes the most recently used
+    store.get("P1")
+    store.get("P3")
+    assert "P2" not in store and not os.path.exists(store.path("P2"))
+    assert "P1" in store and "P3" in store
+    assert store.size() <= store.max_bytes
+
+
+def test_pinned_products_are_not_evicted(tmp_path, remote):
+    store = new_store(tmp_path, CountingBackend(remote), products=1)
+    with store.checkout("P1") as folder:
+        store.get("P2")
+        store.get("P3")
+        assert_complete(folder, "P1")
+    assert "P1" in store
+
+
+def test_prefetch_keeps_every_product(tmp_path, remote):
+    backend = CountingBackend(remote)
+    store = new_store(tmp_path, backend, products=1)
+    folders = store.prefetch(["P1", "P2"])
+    for folder, product_id in zip(folders, ("P1", "P2")):
+        assert_complete(folder, product_id)
+    with store.pinned(["P1", "P2"]):
+        assert store.prefetch(["P1", "P2"]) == folders
+    assert sorted(backend.listed) == ["P1", "P2"]
+
+
+def test_concurrent_get_fetches_once(tmp_path, remote):
+    release = threading.Event()
+    backend = CountingBackend(remote, lambda product_id, path: release.wait())
+    store = new_store(tmp_path, backend)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        store.get("P1"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    # the other threads reach the download of the first one meanwhile
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [store.path("P1")] * 8
+    assert backend.listed == ["P1"]
+    assert len(backend.fetched) == len(FILES)
+    assert_complete(store.path("P1"), "P1")
+
+
+# a LocalBackend logging its listings to a file, across processes
+class LoggingBackend(LocalBackend):
+
+    def __init__(self, root, log):
+        super(LoggingBackend, self).__init__(root, chunk_size=512)
+        self.log = log
+
+    def list_files(self, product_id):
+        with open(self.log, "a") as dst:
+            dst.write(product_id + "\n")
+        # the other process reaches the download meanwhile
+        time.sleep(0.2)
+        return super(LoggingBackend, self).list_files(product_id)
+
+
+def _fetch_in_process(root, backend, product_ids):
+    store = ProductStore(root, backend, workers=2)
+    for product_id in product_ids:
+        store.get(product_id)
+
+
+def test_processes_share_the_store(tmp_path, remote):
+    backend = LoggingBackend(remote, str(tmp_path / "listed.log"))
+    root = str(tmp_path / "store")
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_fetch_in_process,
+                                 args=(root, backend, product_ids))
+                 for product_ids in (["P1", "P2"], ["P1", "P3"])]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    with open(backend.log) as src:
+        assert sorted(src.read().split()) == ["P1", "P2", "P3"]
+    store = ProductStore(root, backend)
+    for product_id in ("P1", "P2", "P3"):
+        assert product_id in store
+        assert_complete(store.path(product_id), product_id)
@@ -0,0 +1,78 @@
+"""
+Description     : Regression checks of the value ranges of the indices,
+                  with the infinities zero denominators give
+Libraries       : numpy, pytest, rasterio
+"""
+
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import rasterio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+import sentinel2index_py3 as s2  # noqa: E402
+from synthetic import make_dataset  # noqa: E402
+# ---------------------
+
+
+def test_nan_range_skips_infinities():
+    values = np.array([[np.nan, 0.2, np.inf], [-np.inf, -0.4, 0.9]],
+                      dtype=np.float32)
+    assert s2.nan_range(values) == (np.float32(-0.4), np.float32(0.9))
+    assert s2.nan_range(values, chunk_rows=1) == (np.float32(-0.4),
+                                                  np.float32(0.9))
+    assert np.isnan(s2.nan_range(np.array([[np.inf, np.nan]]))[0])
+
+
+def test_merge_range_skips_infinities():
+    d_range = s2._merge_range((np.inf, -np.inf),
+                              np.array([[0.5, np.inf]], dtype=np.float32))
+    assert d_range == (0.5, 0.5)
+    assert s2._merge_range(d_range, np.array([[-np.inf]])) == d_range
+
+
+def test_std_array_range_with_infinity():
+    values = np.array([[0.0, 1.0, np.inf]], dtype=np.float32)
+    out = s2.std_array(values)
+    assert out[0, 0] == 0 and out[0, 1] == 100
+
+
+# a scene where the EVI denominator nir + 6 red - 7.5 blue + 1 is zero
+@pytest.fixture
+def inf_scene(tmp_path, monkeypatch):
+    dataset = make_dataset(str(tmp_path), size=300)
+    for name, value in (("nir", 2000), ("red", 500), ("blue", 2000)):
+        with rasterio.open(dataset["bands"][name], "r+") as dst:
+            band = dst.read(1)
+            band[150:152, 150] = value
+            dst.write(band, 1)
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(s2, "PRETILE", False)
+    return dataset
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_yield_range_with_infinite_evi(inf_scene, tmp_path, stream):
+    bands = inf_scene["bands"]
+    evi = s2.evaluate_indices(["EVI"], {
+        name: s2.raster_mask(bands[name], inf_scene["aoi"])[0]
+        for name in ("nir", "red", "blue")})["EVI"]
+    assert np.isinf(evi).any()
+
+    with s2.job_work_dir(str(tmp_path / "job")):
+        s2.yield_f(bands["nir"], bands["red"], bands["green"],
+                   bands["blue"], bands["re5"], bands["re6"],
+                   bands["swir11"], inf_scene["aoi"], inf_scene["tiles"],
+                   stream=stream)
+    with rasterio.open(str(tmp_path / "job" / "raw_yield.tif")) as src:
+        tags = src.tags(1)
+        values = s2.read_image(src)
+    assert float(tags["VALUE_MIN"]) < float(tags["VALUE_MAX"])
+    finite = values[np.isfinite(values)]
+    assert finite.min() < finite.max()
+    assert np.isclose(finite.max(), 100, atol=0.1)
@@ -0,0 +1,75 @@
+"""
+Description     : Checks that rendering an image window by window gives the
+                  colors of render_array and render_classes on the whole
+                  array, for float, int16 and class images
+Libraries       : numpy, pytest, rasterio
+"""
+
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sentinel2index_py3 as s2  # noqa: E402
+# ---------------------
+
+
+HEIGHT, WIDTH = 600, 530
+META = {'driver': 'GTiff', 'crs': 'EPSG:32648', 'height': HEIGHT,
+        'width': WIDTH, 'count': 1, 'dtype': 'float32', 'nodata': None}
+TRANSFORM = from_origin(500000, 1000000, 10, 10)
+
+
+@pytest.fixture
+def ramps(tmp_path):
+    files = {"absolute": "-1 255 0 0\n0 255 255 0\n1 0 128 0\n",
+             "percent": "nv 0 0 0 0\n0% 200 0 0\n50% 250 250 0\n"
+                        "100% 0 100 0 200\n"}
+    for name, text in files.items():
+        (tmp_path / name).write_text(text)
+    return {name: str(tmp_path / name) for name in files}
+
+
+@pytest.fixture
+def values():
+    values = np.random.default_rng(0).uniform(-1, 1, (HEIGHT, WIDTH))
+    values = values.astype(np.float32)
+    values[10:20, 10:20] = np.nan
+    return values
+
+
+def render(path, ramp, alpha):
+    out = path + ".rendered.tif"
+    s2.renderer(path, out, ramp, alpha=alpha, block_size=256)
+    with rasterio.open(out) as src:
+        return src.read()
+
+
+@pytest.mark.parametrize("dtype", ["float32", "int16"])
+@pytest.mark.parametrize("ramp", ["absolute", "percent"])
+@pytest.mark.parametrize("alpha", [False, True])
+def test_windows_match_render_array(tmp_path, ramps, values, dtype, ramp,
+                                    alpha):
+    path = str(tmp_path / "index.tif")
+    s2.imager(values, TRANSFORM, dict(META), path, dtype=dtype)
+    with rasterio.open(path) as src:
+        expected = s2.render_array(s2.read_image(src), ramps[ramp],
+                                   alpha=alpha, d_range=s2.image_range(src),
+                                   nodata=None if dtype == "int16"
+                                   else src.nodata)
+    assert (render(path, ramps[ramp], alpha) == expected).all()
+
+
+def test_windows_match_render_classes(tmp_path, ramps):
+    classes = np.random.default_rng(1).integers(1, 6, (HEIGHT, WIDTH))
+    path = str(tmp_path / "classes.tif")
+    s2.imager(classes.astype(np.uint8), TRANSFORM, dict(META), path)
+    expected = s2.render_classes(classes.astype(np.uint8),
+                                 s2.class_palette(ramps["absolute"]),
+                                 alpha=True)
+    assert (render(path, ramps["absolute"], True) == expected).all()
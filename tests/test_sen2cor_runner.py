@@ -0,0 +1,140 @@
+"""
+Description     : Offline tests of the sen2cor runner with a stub
+                  L2A_Process: cached outputs, callers of one product
+                  sharing its run, outputs keyed by processor version and
+                  the timings recorded for every request
+Libraries       : pytest, threading
+"""
+
+
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sen2cor_runner import Sen2CorRunner  # noqa: E402
+# ---------------------
+
+
+PRODUCT = "S2A_MSIL1C_20180903T031541_N0206_R118_T48NUH_20180903T083200"
+
+# writes an L2A SAFE folder into --output_dir, logging every run
+STUB = """
+import os, sys, time
+version, log, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+if args == ["--help"]:
+    print("Sen2Cor. Version: {}, created: 2019.12.17".format(version))
+    sys.exit(0)
+output_dir = args[args.index("--output_dir") + 1]
+l1c = os.path.basename(os.path.normpath(args[-1]))
+with open(log, "a") as dst:
+    dst.write("{} {}\\n".format(version, l1c))
+time.sleep(0.3)
+if l1c.startswith("FAIL"):
+    sys.exit(1)
+safe = os.path.join(output_dir, l1c.replace("MSIL1C", "MSIL2A"))
+os.makedirs(safe)
+with open(os.path.join(safe, "MTD_MSIL2A.xml"), "w") as dst:
+    dst.write(version)
+"""
+
+
+@pytest.fixture
+def stub(tmp_path):
+    script = tmp_path / "L2A_Process.py"
+    script.write_text(STUB)
+    log = str(tmp_path / "runs.log")
+
+    def runner(version="2.8.0", **kwargs):
+        return Sen2CorRunner(str(tmp_path / "l2a"),
+                             [sys.executable, str(script), version, log],
+                             max_runs=2, mem_per_run=1, **kwargs)
+
+    def runs():
+        if not os.path.exists(log):
+            return []
+        with open(log) as src:
+            return src.read().split("\n")[:-1]
+
+    l1c = tmp_path / "l1c" / (PRODUCT + ".SAFE")
+    l1c.mkdir(parents=True)
+    return runner, runs, str(l1c)
+
+
+def test_cache_hit(stub):
+    runner_of, runs, l1c = stub
+    processed = []
+    runner = runner_of(postprocess=processed.append)
+    l2a = runner.run(l1c)
+    assert l2a == os.path.join(runner.cache_root, "2.8.0", PRODUCT,
+                               PRODUCT.replace("MSIL1C", "MSIL2A") + ".SAFE")
+    assert os.path.exists(os.path.join(l2a, "MTD_MSIL2A.xml"))
+    assert processed == [os.path.join(
+        runner.cache_root, ".incoming", PRODUCT + "_2.8.0",
+        os.path.basename(l2a))]
+
+    assert runner.run(l1c) == l2a
+    # a new runner, e.g. after a restart, finds the output too
+    assert runner_of().run(l1c) == l2a
+    assert runs() == ["2.8.0 " + PRODUCT + ".SAFE"]
+    assert len(processed) == 1
+
+    first, hit = runner.timings
+    assert (first.product_id, first.version, first.cached) == (
+        PRODUCT, "2.8.0", False)
+    assert first.seconds >= 0.3
+    assert hit.cached and hit.seconds == 0.
+
+
+def test_concurrent_callers_share_one_run(stub):
+    runner_of, runs, l1c = stub
+    runner = runner_of()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        runner.run(l1c))) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(runs()) == 1
+    assert len(set(results)) == 1 and len(results) == 6
+    timings = list(runner.timings)
+    assert [timing.cached for timing in timings].count(False) == 1
+    shared = [timing for timing in timings if timing.cached]
+    assert len(shared) == 5
+    # the callers waited for the run rather than starting their own
+    assert all(timing.waited > 0.1 for timing in shared)
+    assert not runner._inflight
+
+
+def test_outputs_keyed_by_version(stub):
+    runner_of, runs, l1c = stub
+    # the version is read from the --help of the processor
+    old = runner_of("2.8.0")
+    new = runner_of("2.9.0")
+    assert (old.version, new.version) == ("2.8.0", "2.9.0")
+    old_l2a = old.run(l1c)
+    new_l2a = new.run(l1c)
+    assert old_l2a != new_l2a
+    assert os.path.dirname(new_l2a) == os.path.join(new.cache_root, "2.9.0",
+                                                    PRODUCT)
+    assert new.output(PRODUCT) == new_l2a and old.output(PRODUCT) == old_l2a
+    assert sorted(runs()) == ["2.8.0 " + PRODUCT + ".SAFE",
+                              "2.9.0 " + PRODUCT + ".SAFE"]
+
+
+def test_failed_run_is_not_cached(stub, tmp_path):
+    runner_of, runs, l1c = stub
+    failing = tmp_path / "l1c" / "FAIL_MSIL1C.SAFE"
+    failing.mkdir()
+    runner = runner_of()
+    with pytest.raises(RuntimeError):
+        runner.run(str(failing))
+    assert runner.output("FAIL_MSIL1C") is None
+    assert not runner._inflight and not runner.timings
+    with pytest.raises(RuntimeError):
+        runner.run(str(failing))
+    assert len(runs()) == 2
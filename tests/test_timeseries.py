@@ -0,0 +1,141 @@
+"""
+Description     : Checks of the multi-date mode on a synthetic season of
+                  five dates, one of them on a grid shifted by a pixel and
+                  one with a nodata patch: the band stacks, the index
+                  stacks and the composites against nanmax, nanmedian,
+                  argmax and polyfit in memory
+Libraries       : numpy, pytest, rasterio, warnings
+"""
+
+
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+import rasterio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+from synthetic import make_dataset, write_band  # noqa: E402
+import timeseries  # noqa: E402
+# ---------------------
+
+
+SIZE = 60
+DATES = ("2018-01-01", "2018-01-11", "2018-01-16", "2018-02-05",
+         "2018-03-01")
+SHIFTED = 2
+NODATA = 3
+
+
+@pytest.fixture(scope="module")
+def season(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("season")
+    dataset = make_dataset(str(folder), SIZE)
+    scenes = []
+    for t, date in enumerate(DATES):
+        band_paths = {}
+        for name in ("nir", "red"):
+            path = str(folder / "{}_{}.tif".format(name, t))
+            write_band(path, SIZE, name, 10, seed=t + 1)
+            with rasterio.open(path, "r+") as dst:
+                raw = dst.read(1)
+                if t == NODATA:
+                    raw[20:30, 20:30] = 0
+                    dst.write(raw, 1)
+                if t == SHIFTED:
+                    dst.transform = dst.transform * dst.transform.translation(
+                        1, 0)
+            band_paths[name] = path
+        scenes.append((date, band_paths))
+    series = timeseries.TimeSeries.build(str(folder / "series"), scenes,
+                                         dataset["aoi"],
+                                         memory_limit=64 * 1024)
+    return series, scenes
+
+
+def test_band_stacks(season):
+    series, scenes = season
+    assert series.dates == list(DATES)
+    assert series.days.tolist() == [0, 10, 15, 35, 59]
+    nir = np.array(series.stack("nir"))
+    inside = ~np.isnan(nir[0])
+    with rasterio.open(scenes[0][1]["nir"]) as src:
+        window = rasterio.windows.from_bounds(
+            *rasterio.transform.array_bounds(series.shape[1], series.shape[2],
+                                             series.transform),
+            transform=src.transform)
+        window = window.round_offsets().round_lengths()
+    for t, (date, band_paths) in enumerate(scenes):
+        with rasterio.open(band_paths["nir"]) as src:
+            raw = src.read(1)
+        if t == SHIFTED:
+            # a pixel to the east, warped back onto the first grid
+            raw = np.roll(raw, 1, axis=1)
+        raw = raw[window.toslices()]
+        expected = raw.astype(np.float32) / 10000
+        expected[raw == 0] = np.nan
+        values = nir[t]
+        if t == NODATA:
+            assert np.isnan(values[inside & np.isnan(expected)]).all()
+        ok = inside & ~np.isnan(expected)
+        np.testing.assert_allclose(values[ok], expected[ok], rtol=1e-6)
+    assert np.isnan(nir[:, ~inside]).all()
+
+
+def test_index_stacks(season):
+    series, scenes = season
+    series.evaluate(["NDVI"], memory_limit=64 * 1024)
+    nir = np.array(series.stack("nir"), dtype=np.float64)
+    red = np.array(series.stack("red"), dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = (nir - red) / (nir + red)
+    np.testing.assert_allclose(np.array(series.stack("NDVI")), expected,
+                               rtol=1e-5, equal_nan=True)
+
+
+def read(path):
+    with rasterio.open(path) as src:
+        return src.read(1)
+
+
+def test_composites(season, tmp_path):
+    series, scenes = season
+    images = series.composites(("NDVI", "WDRVI"), folder=str(tmp_path),
+                               memory_limit=64 * 1024)
+    ndvi = np.array(series.stack("NDVI"))
+    wdrvi = np.array(series.stack("WDRVI"))
+    valid = ~np.isnan(ndvi).all(axis=0)
+    assert valid.any() and not valid.all()
+    days = series.days
+
+    with warnings.catch_warnings():
+        # pixels outside the AOI have no valid date
+        warnings.simplefilter("ignore", RuntimeWarning)
+        np.testing.assert_allclose(read(images["NDVI", "max"]),
+                                   np.nanmax(ndvi, axis=0), equal_nan=True)
+        np.testing.assert_allclose(read(images["NDVI", "median"]),
+                                   np.nanmedian(ndvi, axis=0),
+                                   rtol=1e-6, equal_nan=True)
+
+    at = np.where(np.isnan(ndvi), -np.inf, ndvi).argmax(axis=0)
+    peak_day = read(images["NDVI", "peak_day"])
+    assert (peak_day[valid] == days[at[valid]]).all()
+    assert np.isnan(peak_day[~valid]).all()
+    max_ndvi = read(images["WDRVI", "max_ndvi"])
+    expected = np.take_along_axis(wdrvi, at[None], axis=0)[0]
+    np.testing.assert_allclose(max_ndvi[valid], expected[valid])
+    assert np.isnan(max_ndvi[~valid]).all()
+
+    trend = read(images["NDVI", "trend"])
+    rows, cols = np.nonzero(valid)
+    for r, c in zip(rows, cols):
+        ok = ~np.isnan(ndvi[:, r, c])
+        if ok.sum() < 2:
+            assert np.isnan(trend[r, c])
+            continue
+        slope = np.polyfit(days[ok], ndvi[ok, r, c].astype(np.float64), 1)[0]
+        assert np.isclose(trend[r, c], slope, rtol=1e-3, atol=1e-6)
@@ -0,0 +1,420 @@
+"""
+Description     : On demand XYZ tiles of the index images of the jobs.
+                  A tile is warped to web mercator from the image overview
+                  closest to its resolution, colored with the ramp of the
+                  index and encoded as PNG. Tiles are kept in a memory LRU
+                  cache in front of a disk LRU cache, and the low zooms of
+                  a finished job can be rendered ahead of the first view
+Libraries       : collections, concurrent.futures, hashlib, math, numpy,
+                  os, rasterio, re, threading
+"""
+
+
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import math
+import os
+import re
+import threading
+
+import numpy as np
+
+from instrumentation import span
+from locks import atomic_write
+from sentinel2index_py3 import (INDEX_REGISTRY, class_palette, decode_image,
+                                image_range, rasterio, render_array,
+                                render_classes)
+# ---------------------
+
+
+TILE_SIZE = 256
+# zooms served, the pre-rendered pyramids stopped at 18
+MIN_ZOOM = 0
+MAX_ZOOM = 20
+# zooms rendered ahead of the first view, from the zoom of a whole tile
+PREWARM_ZOOMS = (8, 12)
+# half the side of the web mercator square
+ORIGIN = 20037508.342789244
+WEB_MERCATOR = 'EPSG:3857'
+JOB_ID = re.compile(r'^[\w-]+$')
+# zlib level of the tiles, as gdal2tiles; lower levels encode faster but
+# make the magnified tiles of high zooms much larger
+PNG_LEVEL = 6
+
+
+# the index images a job folder can hold, by lower case layer name
+def layer_files():
+    files = OrderedDict((spec.name.lower(), (spec.image, spec.ramp))
+                        for spec in INDEX_REGISTRY.values())
+    files['yield'] = ('raw_yield.tif', 'yield_color.txt')
+    return files
+
+
+# web mercator (left, bottom, right, top) of a tile
+def tile_bounds(z, x, y):
+    size = 2 * ORIGIN / 2 ** z
+    left = -ORIGIN + x * size
+    top = ORIGIN - y * size
+    return left, top - size, left + size, top
+
+
+# the (x, y) of the tiles of a zoom covering web mercator bounds
+def tiles_covering(bounds, z):
+    size = 2 * ORIGIN / 2 ** z
+    last = 2 ** z - 1
+
+    def clamp(value):
+        return min(max(int(math.floor(value)), 0), last)
+
+    x0 = clamp((bounds[0] + ORIGIN) / size)
+    x1 = clamp((bounds[2] + ORIGIN) / size - 1e-9)
+    y0 = clamp((ORIGIN - bounds[3]) / size)
+    y1 = clamp((ORIGIN - bounds[1]) / size - 1e-9)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield x, y
+
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def encode_png(rgba):
+    # a pixel grid transform, PNG does not store it but without one
+    # rasterio warns that the tile is not georeferenced
+    transform = rasterio.transform.from_origin(0, rgba.shape[1], 1, 1)
+    with rasterio.io.MemoryFile() as memfile:
+        with memfile.open(driver='PNG', width=rgba.shape[2],
+                          height=rgba.shape[1], count=rgba.shape[0],
+                          dtype='uint8', transform=transform,
+                          ZLEVEL=PNG_LEVEL) as dst:
+            dst.write(rgba)
+        return memfile.read()
+
+
+TRANSPARENT = None
+
+
+# the fully transparent tile, encoded once
+def transparent_png():
+    global TRANSPARENT
+    if TRANSPARENT is None:
+        TRANSPARENT = encode_png(
+            np.zeros((4, TILE_SIZE, TILE_SIZE), dtype=np.uint8))
+    return TRANSPARENT
+
+
+# what a tile render needs to know about an index image
+# path              ->      the image
+# ramp              ->      the ramp file of the index
+# token             ->      changes with the image or the ramp, part of the
+#                           cache keys and of the ETag
+# crs, res          ->      crs and pixel size of the image
+# bounds            ->      web mercator bounds of the image
+# overviews         ->      decimation factors of the internal overviews
+# src_nodata        ->      nodata of the image when warped, NaN for float
+#                           images without one
+# nodata            ->      the nodata given to render_array
+# scale             ->      band scale of int16 images
+# d_range           ->      (min, max) of the values, for percentage ramps
+# classified        ->      True for the uint8 class rasters of the indices,
+#                           colored with the class_palette of the ramp
+Layer = namedtuple('Layer', ['path', 'ramp', 'token', 'crs', 'res', 'bounds',
+                             'overviews', 'src_nodata', 'nodata', 'scale',
+                             'd_range', 'classified'])
+
+
+def open_layer(path, ramp):
+    stat = os.stat(path)
+    token = hashlib.sha1("{}:{}:{}".format(
+        stat.st_mtime_ns, stat.st_size,
+        os.stat(ramp).st_mtime_ns).encode()).hexdigest()[:12]
+    with rasterio.open(path) as src:
+        scaled = src.dtypes[0] == 'int16' and src.scales[0] != 1
+        classified = src.dtypes[0] == 'uint8'
+        if src.nodata is not None:
+            src_nodata = src.nodata
+        else:
+            src_nodata = np.nan if src.dtypes[0].startswith('float') else 0
+        return Layer(path=path,
+                     ramp=ramp,
+                     token=token,
+                     crs=src.crs,
+                     res=src.res[0],
+                     bounds=rasterio.warp.transform_bounds(
+                         src.crs, WEB_MERCATOR, *src.bounds, densify_pts=21),
+                     overviews=src.overviews(1),
+                     src_nodata=src_nodata,
+                     nodata=None if scaled else src.nodata,
+                     scale=src.scales[0],
+                     d_range=None if classified else image_range(src),
+                     classified=classified)
+
+
+# render a tile of an index image
+def render_tile(layer, z, x, y):
+    """
+    Returns the PNG of the tile, None when it holds no data
+    """
+    bounds = tile_bounds(z, x, y)
+    if not _intersects(bounds, layer.bounds):
+        return None
+    # the coarsest overview still at least as fine as the tile
+    left, bottom, right, top = rasterio.warp.transform_bounds(
+        WEB_MERCATOR, layer.crs, *bounds)
+    tile_res = (right - left) / TILE_SIZE
+    level = None
+    for i, factor in enumerate(layer.overviews):
+        if layer.res * factor <= tile_res:
+            level = i
+    transform = rasterio.transform.from_bounds(*bounds, TILE_SIZE, TILE_SIZE)
+    with rasterio.open(layer.path, overview_level=level) as src:
+        with rasterio.vrt.WarpedVRT(
+                src, crs=WEB_MERCATOR, transform=transform,
+                width=TILE_SIZE, height=TILE_SIZE,
+                resampling=rasterio.enums.Resampling.nearest,
+                src_nodata=layer.src_nodata,
+                nodata=layer.src_nodata) as vrt:
+            values = vrt.read(1)
+    if layer.classified:
+        rgba = render_classes(values, class_palette(layer.ramp), alpha=True)
+    else:
+        values = decode_image(values, layer.scale, layer.src_nodata)
+        rgba = render_array(values, layer.ramp, alpha=True,
+                            nodata=layer.nodata, d_range=layer.d_range)
+    if not rgba[3].any():
+        return None
+    return encode_png(rgba)
+
+
+# LRU cache of tiles in memory
+class MemoryCache(object):
+    """
+    max_bytes       ->      the size budget of the cached tiles
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._tiles = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            png = self._tiles.get(key)
+            if png is not None:
+                self._tiles.move_to_end(key)
+            return png
+
+    def put(self, key, png):
+        with self._lock:
+            if key in self._tiles:
+                self._bytes -= len(self._tiles.pop(key))
+            self._tiles[key] = png
+            self._bytes += len(png)
+            while self._bytes > self.max_bytes and self._tiles:
+                self._bytes -= len(self._tiles.popitem(last=False)[1])
+
+    def __len__(self):
+        return len(self._tiles)
+
+
+# LRU cache of tiles on disk, one PNG file per tile
+class DiskCache(object):
+    """
+    root            ->      the cache folder, its tiles are picked up again
+                            oldest first on start
+    max_bytes       ->      the size budget of the cached tiles; every
+                            process keeps to it for the tiles it knows of
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        found = []
+        for folder, dirs, files in os.walk(root):
+            for afile in files:
+                if afile.endswith('.png'):
+                    path = os.path.join(folder, afile)
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, os.path.relpath(path, root),
+                                  stat.st_size))
+        self._tiles = OrderedDict((rel, size) for mtime, rel, size
+                                  in sorted(found))
+        self._bytes = sum(self._tiles.values())
+
+    def get(self, rel):
+        try:
+            with open(os.path.join(self.root, rel), 'rb') as src:
+                png = src.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._bytes -= self._tiles.pop(rel, 0)
+            return None
+        with self._lock:
+            if rel in self._tiles:
+                self._tiles.move_to_end(rel)
+            else:
+                # written by another process
+                self._tiles[rel] = len(png)
+                self._bytes += len(png)
+        return png
+
+    def put(self, rel, png):
+        path = os.path.join(self.root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path, 'wb') as dst:
+            dst.write(png)
+        with self._lock:
+            self._bytes += len(png) - self._tiles.pop(rel, 0)
+            self._tiles[rel] = len(png)
+            stale = []
+            while self._bytes > self.max_bytes and len(self._tiles) > 1:
+                old, size = self._tiles.popitem(last=False)
+                self._bytes -= size
+                stale.append(old)
+        for old in stale:
+            try:
+                os.remove(os.path.join(self.root, old))
+            except FileNotFoundError:
+                pass
+
+    def size(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._tiles)
+
+
+# tiles of the index images left in the job work folders
+class TileServer(object):
+    """
+    work_root       ->      the folder of the job work folders, the images
+                            of a job are read from work_root/<job id>
+    cache_root      ->      the disk cache folder
+    ramp_folder     ->      the folder of the color ramps
+    memory_bytes    ->      size budget of the memory cache
+    disk_bytes      ->      size budget of the disk cache
+    """
+
+    def __init__(self, work_root, cache_root, ramp_folder='ramps',
+                 memory_bytes=64 * 1024 ** 2, disk_bytes=10 * 1024 ** 3):
+        self.work_root = work_root
+        self.ramp_folder = ramp_folder
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = DiskCache(cache_root, disk_bytes)
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'rendered': 0,
+                      'empty': 0, 'prewarmed': 0}
+        self._layers = {}
+        self._lock = threading.Lock()
+        self._prewarm = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='tile-prewarm')
+
+    def layer(self, job_id, index):
+        """
+        Returns the Layer of an index of a job, reopened when the image or
+        its ramp changed. Raises KeyError when the job has no such image
+        """
+        files = layer_files()
+        if not JOB_ID.match(job_id) or index.lower() not in files:
+            raise KeyError("no index {} for job {}".format(index, job_id))
+        image, ramp = files[index.lower()]
+        path = os.path.join(self.work_root, job_id, image)
+        ramp = os.path.join(self.ramp_folder, ramp)
+        try:
+            stat = os.stat(path)
+            ramp_stat = os.stat(ramp)
+        except FileNotFoundError:
+            raise KeyError("no index {} for job {}".format(index, job_id))
+        version = (stat.st_mtime_ns, stat.st_size, ramp_stat.st_mtime_ns)
+        with self._lock:
+            cached = self._layers.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        layer = open_layer(path, ramp)
+        with self._lock:
+            self._layers[path] = (version, layer)
+        return layer
+
+    def tile(self, job_id, index, z, x, y):
+        """
+        Returns (PNG of the tile, token of the image). Raises KeyError for
+        an unknown image and ValueError for a tile outside the zooms served
+        """
+        if not MIN_ZOOM <= z <= MAX_ZOOM or not (0 <= x < 2 ** z
+                                                 and 0 <= y < 2 ** z):
+            raise ValueError("no tile {}/{}/{}".format(z, x, y))
+        layer = self.layer(job_id, index)
+        key = (job_id, index.lower(), layer.token, z, x, y)
+        png = self.memory.get(key)
+        if png is not None:
+            self._count('memory_hits')
+            return png, layer.token
+        rel = self._rel(key)
+        png = self.disk.get(rel)
+        if png is not None:
+            self._count('disk_hits')
+        else:
+            with span('tile', index=index.lower(), z=z):
+                png = render_tile(layer, z, x, y)
+            if png is None:
+                # empty tiles are cheap to tell apart, they stay off disk
+                self._count('empty')
+                png = transparent_png()
+            else:
+                self._count('rendered')
+                self.disk.put(rel, png)
+        self.memory.put(key, png)
+        return png, layer.token
+
+    # the request threads and the prewarm thread count together
+    def _count(self, name, count=1):
+        with self._lock:
+            self.stats[name] += count
+
+    @staticmethod
+    def _rel(key):
+        job_id, index, token, z, x, y = key
+        return os.path.join(job_id, index, token, str(z), str(x),
+                            "{}.png".format(y))
+
+    def prewarm(self, job_id, zooms=PREWARM_ZOOMS):
+        """
+        Renders to disk the tiles of zooms[0] to zooms[-1] of every image
+        of a job not cached yet, returns how many were rendered
+        """
+        count = 0
+        for index in layer_files():
+            try:
+                layer = self.layer(job_id, index)
+            except KeyError:
+                continue
+            for z in range(zooms[0], zooms[-1] + 1):
+                for x, y in tiles_covering(layer.bounds, z):
+                    rel = self._rel((job_id, index, layer.token, z, x, y))
+                    if os.path.exists(os.path.join(self.disk.root, rel)):
+                        continue
+                    with span('tile_prewarm', index=index, z=z):
+                        png = render_tile(layer, z, x, y)
+                    if png is not None:
+                        self.disk.put(rel, png)
+                        count += 1
+        self._count('prewarmed', count)
+        return count
+
+    def prewarm_later(self, job_id, zooms=PREWARM_ZOOMS):
+        """
+        Queues prewarm in the background, one job at a time
+        """
+        return self._prewarm.submit(self.prewarm, job_id, zooms)
+
+    def status(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return dict(stats,
+                    memory_tiles=len(self.memory),
+                    disk_tiles=len(self.disk),
+                    disk_bytes=self.disk.size())
@@ -0,0 +1,430 @@
+"""
+Description     : Multi-date mode of the index pipeline. The bands of every
+                  date of a Sentinel 2 tile are clipped to the AOI on the
+                  grid of the first date and stacked in memory mapped
+                  (time, y, x) float32 files, one per band. The registered
+                  indices are evaluated over the whole time axis at once
+                  and reduced to temporal composites (maximum NDVI,
+                  median, per pixel trend). Every pass works on blocks of
+                  rows sized from the number of dates and only maps the
+                  part of the stacks it works on, so memory use does not
+                  grow with the length of the season
+Libraries       : collections, contextlib, datetime, json, numpy, os,
+                  rasterio, warnings
+"""
+
+
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import warnings
+
+import numpy as np
+import rasterio
+import rasterio.crs
+import rasterio.enums
+import rasterio.features
+import rasterio.vrt
+import rasterio.windows
+
+from instrumentation import instrumented
+from locks import atomic_write
+from sentinel2index_py3 import (INDEX_BANDS, INDEX_REGISTRY, ProductCatalog,
+                                evaluate_indices, imager, proj_check)
+# ---------------------
+
+
+MEMORY_LIMIT = 256 * 1024 ** 2
+
+
+# rows of a block holding layers (time, rows, width) float32 arrays
+# within memory_limit bytes
+def _block_rows(memory_limit, dates, width, layers):
+    return max(1, int(memory_limit // (4 * dates * width * layers)))
+
+
+# an empty float32 stack, sparse on disk until its blocks are written
+def _allocate(path, shape):
+    with open(path, 'wb') as dst:
+        dst.truncate(4 * int(np.prod(shape)))
+    return path
+
+
+# the scenes of L2A products grouped by tile, e.g. the products of a job
+def scenes_by_tile(product_folders):
+    """
+    product_folders ->      the L2A folders, resampled to a single grid
+
+    Returns a dictionary of tile (e.g. 48NUH, the utm_zone, latitude_band
+    and grid_square) to the (date, band paths) of its products in time
+    order, the band paths as yield_f takes them
+    """
+    tiles = OrderedDict()
+    for folder in product_folders:
+        catalog = ProductCatalog.load(folder)
+        band_paths = {}
+        for name, (band, resolution) in INDEX_BANDS.items():
+            path = catalog.path(band, resolution)
+            if path is not None:
+                band_paths[name] = path
+        date = datetime.strptime(catalog.sensing,
+                                 '%Y%m%dT%H%M%S').strftime('%Y-%m-%d')
+        tiles.setdefault(catalog.tile, []).append((date, band_paths))
+    for scenes in tiles.values():
+        scenes.sort(key=lambda scene: scene[0])
+    return tiles
+
+
+# a band on a reference grid, warped to it when it is on another grid
+@contextmanager
+def _aligned(path, grid):
+    crs, transform, width, height = grid
+    with rasterio.open(path) as src:
+        if (src.crs == crs and src.transform == transform
+                and (src.width, src.height) == (width, height)):
+            yield src
+        else:
+            with rasterio.vrt.WarpedVRT(
+                    src, crs=crs, transform=transform, width=width,
+                    height=height,
+                    resampling=rasterio.enums.Resampling.nearest) as vrt:
+                yield vrt
+
+
+# reduction of an index stack over time
+# name              ->      the name of the composite, e.g. median
+# reduce            ->      function(values, days, series) returning the
+#                           (rows, x) composite of the (time, rows, x)
+#                           block values, days holds the day of every
+#                           date and series the blocks of the indices
+# needs             ->      indices the composite reads from series
+Composite = namedtuple('Composite', ['name', 'reduce', 'needs'])
+
+COMPOSITES = OrderedDict()
+
+
+# decorator registering a composite
+def register_composite(name, needs=()):
+    def decorator(reduce):
+        COMPOSITES[name] = Composite(name=name, reduce=reduce,
+                                     needs=tuple(needs))
+        return reduce
+    return decorator
+
+
+# the date index of the maximum of every pixel, -1 where every date is NaN
+def _argmax(values):
+    peak = np.fmax.reduce(values, axis=0)
+    at = np.where(np.isnan(values), -np.inf, values).argmax(axis=0)
+    at[np.isnan(peak)] = -1
+    return at
+
+
+def _take(values, at):
+    out = np.take_along_axis(values, np.maximum(at, 0)[None], axis=0)[0]
+    out[at < 0] = np.nan
+    return out
+
+
+# highest value of the season
+@register_composite("max")
+def _max(values, days, series):
+    return np.fmax.reduce(values, axis=0)
+
+
+# value on the date of the highest NDVI, the greenest pixel composite
+@register_composite("max_ndvi", needs=("NDVI",))
+def _max_ndvi(values, days, series):
+    return _take(values, _argmax(series["NDVI"]))
+
+
+# day of the highest value, counted from the first date
+@register_composite("peak_day")
+def _peak_day(values, days, series):
+    at = _argmax(values)
+    out = np.asarray(days, dtype=np.float32)[np.maximum(at, 0)]
+    out[at < 0] = np.nan
+    return out
+
+
+@register_composite("median")
+def _median(values, days, series):
+    with warnings.catch_warnings():
+        # pixels without a valid date stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(values, axis=0)
+
+
+# slope of the least squares line through the valid dates, per day
+@register_composite("trend")
+def _trend(values, days, series):
+    valid = ~np.isnan(values)
+    n = valid.sum(axis=0)
+    t = np.where(valid, np.asarray(days, dtype=np.float32)[:, None, None],
+                 np.float32(0))
+    t_mean = t.sum(axis=0) / n
+    v = np.where(valid, values, np.float32(0))
+    v_mean = v.sum(axis=0) / n
+    t -= t_mean
+    t[~valid] = 0
+    v -= v_mean
+    slope = (t * v).sum(axis=0) / (t * t).sum(axis=0)
+    slope[n < 2] = np.nan
+    return slope
+
+
+# stacks of the bands and indices of a tile over a season
+class TimeSeries(object):
+    """
+    Built once into a folder with build, then reopened with load.
+    folder          ->      the folder of the stacks and of series.json
+    dates           ->      the sensing dates, YYYY-MM-DD in time order
+    shape           ->      (dates, rows, columns) of every stack
+    transform, crs  ->      the grid of the AOI window
+    bands           ->      the band stacks
+    indices         ->      the index stacks
+    """
+    file_name = "series.json"
+
+    def __init__(self, folder, dates, shape, transform, crs, bands=(),
+                 indices=()):
+        self.folder = folder
+        self.dates = list(dates)
+        self.shape = tuple(shape)
+        self.transform = transform
+        self.crs = crs
+        self.bands = list(bands)
+        self.indices = list(indices)
+
+    @property
+    def days(self):
+        """
+        Days from the first date of every date, as float32
+        """
+        first = datetime.strptime(self.dates[0], '%Y-%m-%d')
+        return np.array([(datetime.strptime(date, '%Y-%m-%d') - first).days
+                         for date in self.dates], dtype=np.float32)
+
+    def _path(self, name):
+        return os.path.join(self.folder, "{}.f32".format(name))
+
+    def stack(self, name, mode='r'):
+        """
+        Returns the memory mapped (time, y, x) stack of a band or index
+        """
+        return np.memmap(self._path(name), dtype=np.float32, mode=mode,
+                         shape=self.shape)
+
+    @classmethod
+    @instrumented('series_build')
+    def build(cls, folder, scenes, aoi, bands=None,
+              memory_limit=MEMORY_LIMIT):
+        """
+        folder          ->      where the stacks are written
+        scenes          ->      (date, band paths) of every date of one
+                                tile, see scenes_by_tile
+        aoi             ->      the estate AOI
+        bands           ->      band names to stack, every band of the
+                                first scene when None
+
+        Pixels outside the AOI and the nodata of the bands are NaN, so
+        that the composites skip them
+        """
+        scenes = sorted(scenes, key=lambda scene: scene[0])
+        if bands is None:
+            bands = [name for name in INDEX_BANDS if name in scenes[0][1]]
+        os.makedirs(folder, exist_ok=True)
+
+        reference = scenes[0][1][bands[0]]
+        geo_features = proj_check(reference, aoi)
+        with rasterio.open(reference) as ref:
+            grid = (ref.crs, ref.transform, ref.width, ref.height)
+            window = rasterio.features.geometry_window(ref, geo_features)
+            transform = ref.window_transform(window)
+        height, width = int(window.height), int(window.width)
+        outside = rasterio.features.geometry_mask(
+            geo_features, out_shape=(height, width), transform=transform,
+            all_touched=True)
+
+        series = cls(folder, [date for date, band_paths in scenes],
+                     (len(scenes), height, width), transform, grid[0])
+        rows = _block_rows(memory_limit, 1, width, 3)
+        for band in bands:
+            _allocate(series._path(band), series.shape)
+            for t, (date, band_paths) in enumerate(scenes):
+                # filled one date at a time
+                stack = series.stack(band, mode='r+')
+                with _aligned(band_paths[band], grid) as src:
+                    nodata = src.nodata if src.nodata is not None else 0
+                    for start in range(0, height, rows):
+                        n = min(rows, height - start)
+                        raw = src.read(1, window=rasterio.windows.Window(
+                            window.col_off, window.row_off + start, width,
+                            n))
+                        values = raw.astype(np.float32)
+                        values /= 10000
+                        values[(raw == nodata)
+                               | outside[start:start + n]] = np.nan
+                        stack[t, start:start + n] = values
+                stack.flush()
+                del stack
+            series.bands.append(band)
+        series.save()
+        return series
+
+    @instrumented('series_evaluate')
+    def evaluate(self, names=None, memory_limit=MEMORY_LIMIT):
+        """
+        Evaluates registered indices over every date into index stacks
+        names           ->      index names, every index the stacked bands
+                                allow when None
+
+        Returns the names of the index stacks
+        """
+        if names is None:
+            names = [name for name, spec in INDEX_REGISTRY.items()
+                     if all(band in self.bands for band in spec.bands)]
+        needed = []
+        for name in names:
+            for band in INDEX_REGISTRY[name].bands:
+                if band not in needed:
+                    needed.append(band)
+        scratch = max(INDEX_REGISTRY[name].scratch for name in names)
+        dates, height, width = self.shape
+        rows = _block_rows(memory_limit, dates, width,
+                           len(needed) + len(names) + scratch)
+
+        for name in names:
+            _allocate(self._path(name), self.shape)
+        for start in range(0, height, rows):
+            stop = min(start + rows, height)
+            # the stacks are mapped whole, the block is the rows start:stop
+            # of every date, a (dates, rows, width) view evaluated in one
+            # call; only its pages are read and written
+            stacks = {band: self.stack(band) for band in needed}
+            outputs = {name: self.stack(name, mode='r+') for name in names}
+            evaluate_indices(
+                names, {band: stack[:, start:stop]
+                        for band, stack in stacks.items()},
+                block_rows=stop - start,
+                outputs={name: stack[:, start:stop]
+                         for name, stack in outputs.items()})
+            for stack in outputs.values():
+                stack.flush()
+            del stacks, outputs
+
+        for name in names:
+            if name not in self.indices:
+                self.indices.append(name)
+        self.save()
+        return names
+
+    @instrumented('series_composites')
+    def composites(self, names=("NDVI",), kinds=None, folder=None,
+                   memory_limit=MEMORY_LIMIT):
+        """
+        Writes the temporal composites of indices as index images
+        names           ->      the indices, evaluated first when missing
+        kinds           ->      names of registered composites, all when
+                                None
+        folder          ->      where the images are written, the series
+                                folder when None
+
+        Returns a dictionary of (index, composite) to the image, named
+        <index>_<composite>.tif
+        """
+        kinds = list(kinds or COMPOSITES)
+        inputs = list(names)
+        for kind in kinds:
+            for name in COMPOSITES[kind].needs:
+                if name not in inputs:
+                    inputs.append(name)
+        missing = [name for name in inputs if name not in self.indices]
+        if missing:
+            self.evaluate(missing, memory_limit)
+
+        folder = folder or self.folder
+        dates, height, width = self.shape
+        days = self.days
+        # the inputs and the temporaries of the trend
+        rows = _block_rows(memory_limit, dates, width, len(inputs) + 4)
+        outputs = OrderedDict(
+            ((name, kind), os.path.join(self.folder, "{}_{}.c32".format(
+                name.lower(), kind)))
+            for name in names for kind in kinds)
+        for path in outputs.values():
+            _allocate(path, (height, width))
+
+        for start in range(0, height, rows):
+            stop = min(start + rows, height)
+            series = {}
+            for name in inputs:
+                stack = self.stack(name)
+                series[name] = np.array(stack[:, start:stop])
+                del stack
+            for (name, kind), path in outputs.items():
+                out = np.memmap(path, dtype=np.float32, mode='r+',
+                                shape=(height, width))
+                out[start:stop] = COMPOSITES[kind].reduce(series[name], days,
+                                                          series)
+                out.flush()
+                del out
+            del series
+
+        out_meta = {'driver': 'GTiff', 'count': 1, 'dtype': 'float32',
+                    'nodata': None, 'crs': self.crs,
+                    'transform': self.transform, 'height': height,
+                    'width': width}
+        images = OrderedDict()
+        for (name, kind), path in outputs.items():
+            composite = np.memmap(path, dtype=np.float32, mode='r',
+                                  shape=(height, width))
+            images[name, kind] = imager(
+                composite, self.transform, dict(out_meta),
+                os.path.join(folder, "{}_{}.tif".format(name.lower(), kind)),
+                dtype='float32', resampling='average')
+            del composite
+            os.remove(path)
+        return images
+
+    def save(self):
+        path = os.path.join(self.folder, self.file_name)
+        with atomic_write(path) as dst:
+            json.dump({'dates': self.dates,
+                       'shape': self.shape,
+                       'transform': list(self.transform)[:6],
+                       'crs': self.crs.to_string(),
+                       'bands': self.bands,
+                       'indices': self.indices}, dst, indent=1)
+
+    @classmethod
+    def load(cls, folder):
+        with open(os.path.join(folder, cls.file_name)) as src:
+            saved = json.load(src)
+        return cls(folder, saved['dates'], saved['shape'],
+                   rasterio.Affine(*saved['transform']),
+                   rasterio.crs.CRS.from_string(saved['crs']),
+                   saved['bands'], saved['indices'])
+
+
+# temporal composites of the indices of every tile of a set of products
+@instrumented()
+def series_f(product_folders, aoi, folder, names=("NDVI",), kinds=None,
+             memory_limit=MEMORY_LIMIT):
+    """
+    product_folders ->      the L2A folders of the season, e.g. the
+                            sen2cor outputs of a job
+    aoi             ->      the estate AOI
+    folder          ->      the series of a tile are built in folder/<tile>
+
+    Returns a dictionary of tile to the images of TimeSeries.composites
+    """
+    results = OrderedDict()
+    for tile, scenes in scenes_by_tile(product_folders).items():
+        series = TimeSeries.build(os.path.join(folder, tile), scenes, aoi,
+                                  memory_limit=memory_limit)
+        results[tile] = series.composites(names, kinds,
+                                          memory_limit=memory_limit)
+    return results